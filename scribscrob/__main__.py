@@ -1,18 +1,33 @@
-from configparser import ConfigParser
 import json
 import logging
 import os
+import signal
 from scribscrob import APP_NAME
-from scribscrob.mpdlistener import MpdListener
-from scribscrob.state import ScrobblingMachine
-from scribscrob.scrobble import LastfmScrobbler
-from scribscrob.transform import TagGuesser
+from scribscrob.backends import ListenBrainzScrobbler, LocalLogScrobbler, LISTENBRAINZ_URL
+from scribscrob.cache import ScrobbleCache
+from scribscrob.dedup import DedupIndex
+from scribscrob.dispatch import DispatchingScrobbler, FanoutScrobbler, DEFAULT_QUEUE_SIZE, DEFAULT_PUT_TIMEOUT
+from scribscrob.history import HistoryStore, HistoryScrobbler
+from scribscrob.metrics import MetricsServer, StatsdPusher, DEFAULT_STATSD_INTERVAL
+from scribscrob.mpdlistener import MpdListener, AsyncMpdListener
+from scribscrob.state import ScrobblingMachine, SnapshotStore, STREAM_DEBOUNCE, reloadtransformer
+from scribscrob.scrobble import LastfmScrobbler, LibrefmScrobbler, TokenBucket, CircuitBreaker, NOWPLAYING_WINDOW, \
+    API_RATE, API_BURST, API_KEY, API_SECRET, BREAKER_THRESHOLD, BREAKER_RESET
+from scribscrob.transform import TagGuesser, Normalizer, TransformerChain, DEFAULT_IDENTITY_MEMO_SIZE
 
 logger = logging.getLogger(APP_NAME)
 
 HOME_DIR = "~/.config/scribscrob"
 CONFIG_FILE = os.path.join(os.path.expanduser(HOME_DIR), "config.ini")
+CONFIG_CACHE_FILE = os.path.join(os.path.expanduser(HOME_DIR), "config.cache")
 LOG_FILE = os.path.join(os.path.expanduser(HOME_DIR), "scribscrob.log")
+MODE_SYNC = "sync"
+MODE_ASYNC = "asyncio"
+CACHE_DIR = os.path.join(os.path.expanduser(HOME_DIR), "cache")
+DEDUP_DIR = os.path.join(os.path.expanduser(HOME_DIR), "dedup")
+SNAPSHOT_FILE = os.path.join(os.path.expanduser(HOME_DIR), "state{:s}.json")
+HISTORY_FILE = os.path.join(os.path.expanduser(HOME_DIR), "history{:s}.sqlite")
+CONTROL_FILE = os.path.join(os.path.expanduser(HOME_DIR), "control.sock")
 
 
 class ScribScrobFactory:
@@ -20,60 +35,338 @@ class ScribScrobFactory:
     SECTION_MPD = 'mpd'
     OPT_MPD_HOST = 'host'
     OPT_MPD_PORT = 'port'
+    OPT_MPD_MODE = 'mode'
+    OPT_MPD_TRACE = 'trace'
+    OPT_MPD_SNAPSHOT = 'snapshot'
+    OPT_MPD_STREAM_DEBOUNCE = 'stream_debounce'
+    OPT_MPD_ACCOUNT = 'account'  # [mpd:<instance>] sections only. Refers to [last.fm:<account>] section
+    # (and [libre.fm:<account>], [listenbrainz:<account>], [locallog:<account>], [history:<account>] ones)
     # last.fm
     SECTION_LASTFM = 'last.fm'
     OPT_LASTFM_USER = 'user'
     OPT_LASTFM_PASS = 'password_hash'
+    OPT_LASTFM_CACHE = 'cache'
+    OPT_LASTFM_DEDUP = 'dedup'
+    OPT_LASTFM_NOWPLAYING_WINDOW = 'nowplaying_window'
+    OPT_LASTFM_RATE = 'rate'
+    OPT_LASTFM_BURST = 'burst'
+    OPT_LASTFM_API_KEY = 'api_key'
+    OPT_LASTFM_API_SECRET = 'api_secret'
+    # other scrobbling services. Options of [last.fm] section not specific to last.fm apply to them too
+    SECTION_LIBREFM = 'libre.fm'
+    SECTION_LISTENBRAINZ = 'listenbrainz'
+    OPT_LISTENBRAINZ_TOKEN = 'token'
+    OPT_LISTENBRAINZ_URL = 'url'
+    SECTION_LOCALLOG = 'locallog'
+    OPT_LOCALLOG_PATH = 'path'
+    SECTION_HISTORY = 'history'
+    OPT_HISTORY_PATH = 'path'
+    OPT_BREAKER_THRESHOLD = 'breaker_threshold'
+    OPT_BREAKER_RESET = 'breaker_reset'
+    # scrobble dispatching
+    SECTION_DISPATCH = 'dispatch'
+    OPT_DISPATCH_QUEUE_SIZE = 'queue_size'
+    OPT_DISPATCH_PUT_TIMEOUT = 'put_timeout'
+    # metrics
+    SECTION_METRICS = 'metrics'
+    OPT_METRICS_HOST = 'host'
+    OPT_METRICS_PORT = 'port'
+    OPT_METRICS_STATSD = 'statsd'
+    OPT_METRICS_STATSD_INTERVAL = 'statsd_interval'
+    # logging
+    SECTION_LOGGING = 'logging'
+    OPT_LOGGING_FILE = 'file'
+    OPT_LOGGING_LEVEL = 'level'
+    OPT_LOGGING_MODULE_LEVEL_PREFIX = 'level.'  # i.e. level.mpd=WARNING
+    OPT_LOGGING_MAX_BYTES = 'max_bytes'
+    OPT_LOGGING_BACKUPS = 'backups'
+    OPT_LOGGING_ROTATE_INTERVAL = 'rotate_interval'
+    OPT_LOGGING_SAMPLE_DEBUG = 'sample_debug'
+    # worker pool of multi-instance daemon
+    SECTION_SUPERVISOR = 'supervisor'
+    OPT_SUPERVISOR_WORKERS = 'workers'
+    OPT_SUPERVISOR_CONTROL = 'control'
+    OPT_SUPERVISOR_REPORT_INTERVAL = 'report_interval'
     # tag guesser
     SECTION_TAGGUESS = 'tagguess'
     OPT_TAGGUESS_REGEX = 'regexps'
+    # song identity normalization
+    SECTION_NORMALIZE = 'normalize'
+    OPT_NORMALIZE_MEMO_SIZE = 'memo_size'
 
-    def __init__(self, config: ConfigParser):
+    INSTANCE_SEPARATOR = ':'
+
+    def __init__(self, config: 'ConfigParser', mpdsection: str=SECTION_MPD, lastfmsection: str=SECTION_LASTFM):
         self.config = config
+        self.mpdsection = mpdsection
+        self.lastfmsection = lastfmsection
+
+    def instances(self):
+        """
+        Factories for instances of multi-instance daemon, declared as [mpd:<instance>] sections
+            returns: generator of (instance name, factory) pairs
+        """
+        prefix = self.SECTION_MPD + self.INSTANCE_SEPARATOR
+        for section in self.config.sections():
+            if section.startswith(prefix):
+                account = self.config.get(section, self.OPT_MPD_ACCOUNT)
+                lastfmsection = self.SECTION_LASTFM + self.INSTANCE_SEPARATOR + account
+                yield section[len(prefix):], ScribScrobFactory(self.config, section, lastfmsection)
+
+    def ismultiinstance(self):
+        return self.mpdsection != self.SECTION_MPD
+
+    def isasync(self):
+        # instances of multi-instance daemon always share one event loop
+        mode = self.config.get(self.mpdsection, self.OPT_MPD_MODE, fallback=MODE_SYNC)
+        return self.ismultiinstance() or mode == MODE_ASYNC
 
     def get_mpd(self):
-        host = self.config.get(self.SECTION_MPD, self.OPT_MPD_HOST)
-        port = self.config.getint(self.SECTION_MPD, self.OPT_MPD_PORT)
-        mpd = MpdListener(host, port)
+        host = self.config.get(self.mpdsection, self.OPT_MPD_HOST)
+        port = self.config.getint(self.mpdsection, self.OPT_MPD_PORT)
+        mpd = AsyncMpdListener(host, port) if self.isasync() else MpdListener(host, port)
+        trace = self.config.get(self.mpdsection, self.OPT_MPD_TRACE, fallback=None)
+        if trace:
+            from scribscrob.trace import TraceRecorder
+            mpd.recorder = TraceRecorder(os.path.expanduser(trace))
         return mpd
 
+    def get_snapshots(self):
+        # instances of multi-instance daemon must not share snapshot
+        suffix = self.mpdsection[len(self.SECTION_MPD):].replace(self.INSTANCE_SEPARATOR, '-')
+        path = self.config.get(self.mpdsection, self.OPT_MPD_SNAPSHOT, fallback=SNAPSHOT_FILE.format(suffix))
+        return SnapshotStore(os.path.expanduser(path))
+
+    def get_streamdebounce(self):
+        """
+            returns: ms new stream title has to hold before it starts a play
+        """
+        return int(self.config.getfloat(self.mpdsection, self.OPT_MPD_STREAM_DEBOUNCE,
+                                        fallback=STREAM_DEBOUNCE / 1000) * 1000)
+
+    def backendsection(self, service: str):
+        """
+        returns: section of given service for the account of this factory, i.e. listenbrainz:alice for last.fm:alice
+        """
+        return service + self.lastfmsection[len(self.SECTION_LASTFM):]
+
+    def get_backends(self):
+        """
+        returns: list of (section, scrobbler) pairs for services configured for the account
+        """
+        getters = ((self.SECTION_LASTFM, self.get_lastfm),
+                   (self.SECTION_LIBREFM, self.get_librefm),
+                   (self.SECTION_LISTENBRAINZ, self.get_listenbrainz),
+                   (self.SECTION_LOCALLOG, self.get_locallog),
+                   (self.SECTION_HISTORY, self.get_history))
+        return [(self.backendsection(service), get()) for service, get in getters
+                if self.config.has_section(self.backendsection(service))]
+
     def get_lastfm(self):
-        user = self.config.get(self.SECTION_LASTFM, self.OPT_LASTFM_USER)
-        password_hash = self.config.get(self.SECTION_LASTFM, self.OPT_LASTFM_PASS)
-        lastfm = LastfmScrobbler(username=user, password_hash=password_hash)
+        return self._get_lastfm(LastfmScrobbler, self.lastfmsection)
+
+    def get_librefm(self):
+        return self._get_lastfm(LibrefmScrobbler, self.backendsection(self.SECTION_LIBREFM))
+
+    def _get_lastfm(self, cls, section):
+        user = self.config.get(section, self.OPT_LASTFM_USER)
+        password_hash = self.config.get(section, self.OPT_LASTFM_PASS)
+        apikey = self.config.get(section, self.OPT_LASTFM_API_KEY, fallback=API_KEY)
+        apisecret = self.config.get(section, self.OPT_LASTFM_API_SECRET, fallback=API_SECRET)
+        window = self.config.getfloat(section, self.OPT_LASTFM_NOWPLAYING_WINDOW, fallback=NOWPLAYING_WINDOW)
+        rate = self.config.getfloat(section, self.OPT_LASTFM_RATE, fallback=API_RATE)
+        burst = self.config.getint(section, self.OPT_LASTFM_BURST, fallback=API_BURST)
+        cachedir, dedupdir = self.statedirs(section, user)
+        lastfm = cls(username=user, password_hash=password_hash, cache=ScrobbleCache(cachedir),
+                     nowplayingwindow=window, bucket=TokenBucket(rate, burst), dedup=DedupIndex(dedupdir),
+                     breaker=self.get_breaker(section), apikey=apikey, apisecret=apisecret)
         return lastfm
 
+    def get_listenbrainz(self):
+        section = self.backendsection(self.SECTION_LISTENBRAINZ)
+        user = self.config.get(section, self.OPT_LASTFM_USER)
+        token = self.config.get(section, self.OPT_LISTENBRAINZ_TOKEN)
+        url = self.config.get(section, self.OPT_LISTENBRAINZ_URL, fallback=LISTENBRAINZ_URL)
+        window = self.config.getfloat(section, self.OPT_LASTFM_NOWPLAYING_WINDOW, fallback=NOWPLAYING_WINDOW)
+        rate = self.config.getfloat(section, self.OPT_LASTFM_RATE, fallback=None)
+        bucket = TokenBucket(rate, self.config.getint(section, self.OPT_LASTFM_BURST, fallback=API_BURST)) \
+            if rate else None
+        cachedir, dedupdir = self.statedirs(section, user)
+        return ListenBrainzScrobbler(user, token, url=url, cache=ScrobbleCache(cachedir), nowplayingwindow=window,
+                                     bucket=bucket, dedup=DedupIndex(dedupdir), breaker=self.get_breaker(section))
+
+    def get_locallog(self):
+        section = self.backendsection(self.SECTION_LOCALLOG)
+        path = os.path.expanduser(self.config.get(section, self.OPT_LOCALLOG_PATH))
+        cachedir, dedupdir = self.statedirs(section, None)
+        return LocalLogScrobbler(path, cache=ScrobbleCache(cachedir), dedup=DedupIndex(dedupdir),
+                                 breaker=self.get_breaker(section))
+
+    def get_history(self):
+        section = self.backendsection(self.SECTION_HISTORY)
+        suffix = section[len(self.SECTION_HISTORY):].replace(self.INSTANCE_SEPARATOR, '-')
+        path = os.path.expanduser(self.config.get(section, self.OPT_HISTORY_PATH, fallback=HISTORY_FILE.format(suffix)))
+        cachedir, _ = self.statedirs(section, None)
+        return HistoryScrobbler(HistoryStore(path), cache=ScrobbleCache(cachedir))
+
+    def statedirs(self, section: str, user: str):
+        """
+        returns: (cache dir, dedup index dir) pair of service section. Services and accounts of multi-instance daemon
+        must not share them
+        """
+        if section == self.SECTION_LASTFM:
+            defaultcachedir, defaultdedupdir = CACHE_DIR, DEDUP_DIR
+        elif section.startswith(self.SECTION_LASTFM + self.INSTANCE_SEPARATOR):
+            defaultcachedir, defaultdedupdir = os.path.join(CACHE_DIR, user), os.path.join(DEDUP_DIR, user)
+        else:
+            servicedir = os.path.join(os.path.expanduser(HOME_DIR), section.replace(self.INSTANCE_SEPARATOR, '-'))
+            defaultcachedir, defaultdedupdir = os.path.join(servicedir, "cache"), os.path.join(servicedir, "dedup")
+        cachedir = self.config.get(section, self.OPT_LASTFM_CACHE, fallback=defaultcachedir)
+        dedupdir = self.config.get(section, self.OPT_LASTFM_DEDUP, fallback=defaultdedupdir)
+        return os.path.expanduser(cachedir), os.path.expanduser(dedupdir)
+
+    def get_breaker(self, section: str):
+        threshold = self.config.getint(section, self.OPT_BREAKER_THRESHOLD, fallback=BREAKER_THRESHOLD)
+        reset = self.config.getfloat(section, self.OPT_BREAKER_RESET, fallback=BREAKER_RESET)
+        return CircuitBreaker(threshold, reset)
+
+    def get_dispatcher(self, scrobbler, name: str=None):
+        name = name if name else self.lastfmsection
+        queuesize = self.config.getint(self.SECTION_DISPATCH, self.OPT_DISPATCH_QUEUE_SIZE,
+                                       fallback=DEFAULT_QUEUE_SIZE)
+        if self.isasync():
+            from scribscrob.asyncdispatch import AsyncDispatchingScrobbler  # asyncio is imported in async mode only
+            return AsyncDispatchingScrobbler(scrobbler, queuesize=queuesize, name=name)
+        puttimeout = self.config.getfloat(self.SECTION_DISPATCH, self.OPT_DISPATCH_PUT_TIMEOUT,
+                                          fallback=DEFAULT_PUT_TIMEOUT)
+        dispatcher = DispatchingScrobbler(scrobbler, queuesize=queuesize, puttimeout=puttimeout, name=name)
+        return dispatcher
+
+    def get_scrobbler(self):
+        """
+        returns: dispatcher of the only configured service or fan-out over dispatchers of all of them
+        """
+        dispatchers = [self.get_dispatcher(scrobbler, section) for section, scrobbler in self.get_backends()]
+        if len(dispatchers) == 1:
+            return dispatchers[0]
+        return FanoutScrobbler(dispatchers)
+
+    def get_metrics(self):
+        """
+        returns: list of metrics exporters configured in [metrics] section. Prometheus endpoint is enabled by port,
+        statsd push is enabled by statsd=host:port
+        """
+        exporters = []
+        port = self.config.getint(self.SECTION_METRICS, self.OPT_METRICS_PORT, fallback=None)
+        if port is not None:
+            host = self.config.get(self.SECTION_METRICS, self.OPT_METRICS_HOST, fallback='localhost')
+            exporters.append(MetricsServer(host, port))
+        statsd = self.config.get(self.SECTION_METRICS, self.OPT_METRICS_STATSD, fallback=None)
+        if statsd:
+            host, _, port = statsd.rpartition(':')
+            interval = self.config.getfloat(self.SECTION_METRICS, self.OPT_METRICS_STATSD_INTERVAL,
+                                            fallback=DEFAULT_STATSD_INTERVAL)
+            exporters.append(StatsdPusher(host, int(port), interval=interval))
+        return exporters
+
+    def get_logging(self):
+        """
+        returns: LogPipeline configured by [logging] section
+        """
+        # logging.handlers imports pickle, which is not needed till logging is set up
+        from scribscrob.logs import LogPipeline, DEFAULT_MAX_BYTES, DEFAULT_BACKUPS, DEFAULT_ROTATE_INTERVAL, \
+            DEFAULT_SAMPLE_DEBUG
+        section = self.SECTION_LOGGING
+        path = os.path.expanduser(self.config.get(section, self.OPT_LOGGING_FILE, fallback=LOG_FILE))
+        level = self.config.get(section, self.OPT_LOGGING_LEVEL, fallback='INFO').upper()
+        prefix = self.OPT_LOGGING_MODULE_LEVEL_PREFIX
+        levels = {option[len(prefix):]: value.upper() for option, value in self.config.items(section)
+                  if option.startswith(prefix)} if self.config.has_section(section) else {}
+        return LogPipeline(path, level, levels,
+                           maxbytes=self.config.getint(section, self.OPT_LOGGING_MAX_BYTES,
+                                                       fallback=DEFAULT_MAX_BYTES),
+                           backups=self.config.getint(section, self.OPT_LOGGING_BACKUPS, fallback=DEFAULT_BACKUPS),
+                           interval=self.config.getfloat(section, self.OPT_LOGGING_ROTATE_INTERVAL,
+                                                         fallback=DEFAULT_ROTATE_INTERVAL),
+                           sampledebug=self.config.getint(section, self.OPT_LOGGING_SAMPLE_DEBUG,
+                                                          fallback=DEFAULT_SAMPLE_DEBUG))
+
+    def get_supervisor(self):
+        """
+        returns: Supervisor sharding instances across [supervisor] workers processes or None if instances are served
+        by this process, i.e. there are less than two workers
+        """
+        section = self.SECTION_SUPERVISOR
+        workers = self.config.getint(section, self.OPT_SUPERVISOR_WORKERS, fallback=1)
+        if workers < 2:
+            return None
+        from scribscrob.supervisor import Supervisor, REPORT_INTERVAL
+        control = os.path.expanduser(self.config.get(section, self.OPT_SUPERVISOR_CONTROL, fallback=CONTROL_FILE))
+        interval = self.config.getfloat(section, self.OPT_SUPERVISOR_REPORT_INTERVAL, fallback=REPORT_INTERVAL)
+        return Supervisor(self, workers, control, interval)
+
     def get_transformer(self):
+        """
+        returns: chain of tag guesser and normalizer
+        """
         regexps_raw = self.config.get(self.SECTION_TAGGUESS, self.OPT_TAGGUESS_REGEX)
         regexps = json.loads(regexps_raw)
         tagguesser = TagGuesser(regexps)
-        return tagguesser
+        memosize = self.config.getint(self.SECTION_NORMALIZE, self.OPT_NORMALIZE_MEMO_SIZE,
+                                      fallback=DEFAULT_IDENTITY_MEMO_SIZE)
+        return TransformerChain([tagguesser, Normalizer(memosize)])
 
 
 def config():
-    config = ConfigParser(allow_no_value=True, strict=False)
-    read = config.read(CONFIG_FILE)
-    logger.debug("read configuration from %s", read)
-    return config
+    """
+    returns: ConfigParser of validated configuration, validation is cached till CONFIG_FILE changes
+    """
+    from scribscrob import configcache
+    compiled = configcache.load(CONFIG_FILE, CONFIG_CACHE_FILE)
+    logger.debug("read configuration from %s", CONFIG_FILE)
+    return compiled.parser()
 
 
-def main():
+def reloadedtransformer():
+    """
+    returns: transformer of re-read configuration. Called on SIGHUP
+    """
+    return ScribScrobFactory(config()).get_transformer()
 
-    logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG)
 
+def main():
     factory = ScribScrobFactory(config())
+    instances = list(factory.instances())
+    supervisor = factory.get_supervisor() if instances else None
+    factory.get_logging().start(supervisor.records if supervisor else None)
+    for exporter in factory.get_metrics():
+        exporter.start()
+
+    if supervisor:
+        supervisor.run()
+        return
+    if instances or factory.isasync():
+        # asyncio is imported in async mode only, it takes noticeable part of start up time
+        import asyncio
+        from scribscrob import daemon
+    if instances:
+        asyncio.run(daemon.run(instances, factory.get_transformer(), reloadedtransformer))
+        return
+    if factory.isasync():
+        asyncio.run(daemon.run([(factory.SECTION_MPD, factory)], factory.get_transformer(), reloadedtransformer))
+        return
 
     mpd = factory.get_mpd()
-    # TODO connect implicitly or schedule reconnect if failed
-    mpd.connect()
 
-    scrobbler = factory.get_lastfm()
+    scrobbler = factory.get_scrobbler()
+    scrobbler.start()
 
-    status, song = mpd.status()
-    sm = ScrobblingMachine(status, song, transformer=factory.get_transformer(), scrobbler=scrobbler)
+    sm = ScrobblingMachine(transformer=factory.get_transformer(), scrobbler=scrobbler,
+                           snapshots=factory.get_snapshots(), streamdebounce=factory.get_streamdebounce())
+    # the handler runs between bytecodes of the listener thread, select is resumed after it
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloadtransformer([sm], reloadedtransformer))
 
-    # TODO figure out smthng to allow running w/o mpd connection
-    mpd.listen('player', sm.onevent)
+    mpd.listen_forever('player', sm.onevent, sm.resync, sm.disconnected, sm.scheduler)
 
 
 if __name__ == '__main__':
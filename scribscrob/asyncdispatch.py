@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from scribscrob.dispatch import DEFAULT_QUEUE_SIZE, SCROBBLE, NOWPLAYING, PENDING_NOWPLAYING, _STOP
+from scribscrob.metrics import REGISTRY
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDispatchingScrobbler:
+    """
+    asyncio flavour of DispatchingScrobbler. Worker is a task on caller's event loop, blocking scrobbler calls are
+    run in a single thread executor, so they are sent in order and never block the loop.
+    Callers are synchronous (i.e. ScrobblingMachine), so there is no waiting for free slot: when queue is full,
+    scrobbles go to scrobbler's local cache right away and now playing notifications are dropped.
+    It lives in its own module, which is imported in async mode only, so sync mode doesn't pay for asyncio at start up
+    """
+
+    def __init__(self, scrobbler, queuesize: int=DEFAULT_QUEUE_SIZE, name: str=None):
+        self.scrobbler = scrobbler
+        self.queuesize = queuesize
+        self.name = name
+        self.queue = None
+        self.worker = None
+        self.executor = None
+        self.loop = None
+        scrobbler.ondue = self.sendpending
+
+    def start(self):
+        """
+        Starts worker on running event loop
+        """
+        if not self.worker:
+            self.loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue(maxsize=self.queuesize)
+            REGISTRY.gauge('scribscrob_dispatch_queue_depth', "Items waiting in dispatch queue",
+                           callback=self.queue.qsize, dispatcher=self.name)
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scrobble-dispatcher")
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """
+        Waits until queued items are sent and stops worker
+        """
+        if self.worker:
+            await self.queue.put(_STOP)
+            await self.worker
+            self.executor.shutdown()
+            self.worker = None
+            self.scrobbler.cancelnowplaying()
+
+    def scrobble(self, song, timestamp):
+        try:
+            self.queue.put_nowait((SCROBBLE, song, timestamp))
+        except asyncio.QueueFull:
+            logger.warning("Dispatch queue is full. Saving %s to local cache", song)
+            self.scrobbler.scrobble_to_cache(song, timestamp)
+
+    def nowplaying(self, song):
+        try:
+            self.queue.put_nowait((NOWPLAYING, song))
+        except asyncio.QueueFull:
+            logger.warning("Dispatch queue is full. Dropping now playing %s", song)
+
+    def sendpending(self):
+        """
+        Queues now playing, that scrobbler held back till the end of its window. Called by scrobbler's timer thread
+        """
+        self.loop.call_soon_threadsafe(self.putpending)
+
+    def putpending(self):
+        try:
+            self.queue.put_nowait((PENDING_NOWPLAYING,))
+        except asyncio.QueueFull:
+            logger.warning("Dispatch queue is full. Dropping pending now playing")
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self.queue.get()
+            if item is _STOP:
+                return
+            op, *args = item
+            try:
+                await loop.run_in_executor(self.executor, getattr(self.scrobbler, op), *args)
+            except Exception:
+                logger.exception("Failed to dispatch %s%s", op, tuple(args))
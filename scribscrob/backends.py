@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+from scribscrob.cache import ScrobbleCache
+from scribscrob.dedup import DedupIndex
+from scribscrob.model import Song
+from scribscrob.scrobble import Scrobbler, NOWPLAYING_WINDOW
+
+
+LISTENBRAINZ_URL = "https://api.listenbrainz.org"
+LISTENBRAINZ_TIMEOUT = 10  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class ListenBrainzScrobbler(Scrobbler):
+    """
+    Submits listens to ListenBrainz JSON API
+    """
+    service = 'listenbrainz'
+
+    def __init__(self, username: str, token: str, url: str=LISTENBRAINZ_URL, timeout: float=LISTENBRAINZ_TIMEOUT,
+                 cache: ScrobbleCache=None, nowplayingwindow: float=NOWPLAYING_WINDOW,
+                 bucket: 'TokenBucket'=None, dedup: DedupIndex=None, breaker: 'CircuitBreaker'=None):
+        super().__init__(username, cache=cache, nowplayingwindow=nowplayingwindow, bucket=bucket, dedup=dedup,
+                         breaker=breaker)
+        self.token = token
+        self.url = url.rstrip('/') + "/1/submit-listens"
+        self.timeout = timeout
+
+    @property
+    def errors(self):
+        import http.client  # imported by urllib on first request anyway
+        # urllib errors, HTTP error statuses included, are OSErrors. Truncated or garbled responses are HTTPExceptions
+        return OSError, ValueError, http.client.HTTPException
+
+    def submit(self, song, timestamp):
+        self.post('single', [listen(song.artist, song.title, song.album, timestamp)])
+
+    def submitmany(self, plays):
+        self.post('import', [listen(d['song']['artist'], d['song']['title'], d['song'].get('album'), d['start'])
+                             for d in plays])
+
+    def sendnowplaying(self, song):
+        self.post('playing_now', [listen(song.artist, song.title, song.album)])
+
+    def post(self, listentype: str, payload: list):
+        import urllib.request  # with http.client, email and ssl it is too heavy to import before the first request
+        body = json.dumps({'listen_type': listentype, 'payload': payload}).encode()
+        request = urllib.request.Request(self.url, data=body, method='POST',
+                                         headers={'Authorization': "Token " + self.token,
+                                                  'Content-Type': "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def listen(artist: str, title: str, album: str=None, timestamp: int=None):
+    """
+    returns: listen in ListenBrainz format, now playing ones go without timestamp
+    """
+    metadata = {'artist_name': artist, 'track_name': title}
+    if album:
+        metadata['release_name'] = album
+    d = {'track_metadata': metadata}
+    if timestamp is not None:
+        d['listened_at'] = timestamp
+    return d
+
+
+class LocalLogScrobbler(Scrobbler):
+    """
+    Appends scrobbles to local JSON lines file. Now playing notifications are not logged
+    """
+    service = 'locallog'
+    errors = (OSError,)
+
+    def __init__(self, path: str, cache: ScrobbleCache=None, dedup: DedupIndex=None,
+                 breaker: 'CircuitBreaker'=None):
+        super().__init__(path, cache=cache, dedup=dedup, breaker=breaker)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def submit(self, song: Song, timestamp):
+        self.write([{'artist': song.artist, 'title': song.title, 'album': song.album, 'timestamp': timestamp}])
+
+    def submitmany(self, plays):
+        self.write([{'artist': d['song']['artist'], 'title': d['song']['title'], 'album': d['song'].get('album'),
+                     'timestamp': d['start']} for d in plays])
+
+    def sendnowplaying(self, song):
+        pass
+
+    def write(self, plays: list):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                for play in plays:
+                    f.write(json.dumps(play) + "\n")
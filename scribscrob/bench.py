@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from scribscrob.model import Song, Status, canonical
+from scribscrob.transform import Normalizer
+
+
+def corpus(n: int, distinct: int):
+    """
+    MPD-like currentsong dicts. Only distinct of them have different tags, like stream titles repeating all day
+    """
+    return [{'file': "http://radio/stream" if i % 2 else "music/{:d}.flac".format(i % distinct),
+             'time': "180",
+             'artist': "Artist {:d}".format(i % distinct),
+             'title': "Title {:d}".format(i % distinct),
+             'album': "Album {:d}".format(i % distinct // 10),
+             'pos': str(i), 'id': str(i)}
+            for i in range(n)]
+
+
+def model(n: int=100000, distinct: int=1000):
+    """
+    Memory held by and time spent constructing Song and Status objects from MPD responses
+    """
+    songs = corpus(n, distinct)
+    status = {'state': 'play', 'elapsed': "12.345", 'volume': "100", 'song': "1"}
+
+    started = time.perf_counter()
+    for d in songs:
+        Song(d)
+        Status(status)
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [Song(d) for d in songs]
+        songbytes = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del kept
+    return {'songs': n,
+            'constructions_per_second': 2 * n / seconds,
+            'bytes_per_song': songbytes / n}
+
+
+SPELLINGS = ("{artist} - {title}", "{ARTIST} - {title}", "  {artist}  -  {title} ", "The {artist} - {title}",
+             "{artist} - {title} (feat. Guest {n})", "{artist} ft. Guest {n} - {title}", "{artist} - {title} [Ft. X]")
+
+
+def tags(n: int, distinct: int):
+    """
+    Tag corpus of n plays of distinct tracks, every track is spelled in several ways, like stations and rips do.
+    Plays are skewed to popular tracks, like rotation of radio stations
+    """
+    rng = random.Random(n)
+    corpus = []
+    for _ in range(n):
+        track = int(distinct * rng.random() ** 3)
+        spelling = SPELLINGS[rng.randrange(len(SPELLINGS))].format(
+            artist="Artist {:d}".format(track // 10), ARTIST="ARTIST {:d}".format(track // 10),
+            title="Title {:d}".format(track), n=track)
+        artist, _, title = spelling.partition(" - ")
+        corpus.append(Song({'file': "http://radio/stream", 'artist': artist, 'title': title}))
+    return corpus
+
+
+def normalize(n: int=200000, distinct: int=5000):
+    """
+    Bulk normalization: throughput of canonicalization alone and of Normalizer, whose memo saves it for songs
+    coming again. Spelling variations should collapse into distinct identities
+    """
+    songs = tags(n, distinct)
+    started = time.perf_counter()
+    for song in songs:
+        canonical(song.artist, song.title)
+    canonicalseconds = time.perf_counter() - started
+
+    normalizer = Normalizer()
+    started = time.perf_counter()
+    for song in songs:
+        normalizer.transform(song)
+    seconds = time.perf_counter() - started
+    return {'songs': n,
+            'spellings': len({(song.artist, song.title) for song in songs}),
+            'identities': len({song.key for song in songs}),
+            'canonical_per_second': n / canonicalseconds,
+            'normalized_per_second': n / seconds,
+            'memo_hit_rate': normalizer.hits / n}
+
+
+COLD_START_BUDGET = 0.15  # seconds from interpreter start till sync mode scrobbler is built, reported only
+HEAVY_MODULES = ('asyncio', 'pylast', 'httpx2', 'mpd', 'http.server', 'urllib.request', 'ssl')
+CONFIG_MODULES = ('configparser', 'pickle')  # needed to read configuration, not to import scribscrob
+COLD_START = """
+import json, sys, tempfile, time
+started = time.perf_counter()
+from scribscrob.__main__ import ScribScrobFactory
+from scribscrob.state import ScrobblingMachine
+imported = sorted(sys.modules)
+from configparser import ConfigParser
+with tempfile.TemporaryDirectory() as state:
+    config = ConfigParser()
+    config.read_dict({'mpd': {'host': "localhost", 'port': "6600"},
+                      'last.fm': {'user': "user", 'password_hash': "hash", 'cache': state + "/cache",
+                                  'dedup': state + "/dedup"},
+                      'tagguess': {'regexps': '["(?P<artist>.+) - (?P<title>.+)"]'}})
+    factory = ScribScrobFactory(config)
+    ScrobblingMachine(transformer=factory.get_transformer(), scrobbler=factory.get_scrobbler())
+    seconds = time.perf_counter() - started
+print(json.dumps({'seconds': seconds, 'imported': imported, 'modules': sorted(sys.modules)}))
+"""
+
+
+def coldstart(runs: int=5):
+    """
+    Time fresh interpreter spends importing scribscrob and building sync mode scrobbler, short of connecting to MPD.
+    Heavy modules are expected to be imported on first network use only
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [json.loads(subprocess.run([sys.executable, '-c', COLD_START], cwd=root, check=True,
+                                         stdout=subprocess.PIPE, universal_newlines=True).stdout)
+               for _ in range(runs)]
+    seconds = statistics.median(r['seconds'] for r in results)
+    return {'seconds': seconds,
+            'budget': COLD_START_BUDGET,
+            'within_budget': seconds <= COLD_START_BUDGET,
+            'heavy_modules': sorted(m for m in results[0]['modules'] if m in HEAVY_MODULES) +
+                             sorted(m for m in results[0]['imported'] if m in CONFIG_MODULES)}
+
+
+BENCHMARKS = {'model': model, 'coldstart': coldstart, 'normalize': normalize}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.bench", description="Runs micro benchmarks")
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run, all by default. One of: " +
+                        ", ".join(sorted(BENCHMARKS)))
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print(json.dumps({name: BENCHMARKS[name]()}, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+TMP_FILE_SUFFIX = ".tmp"
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # bytes. Segment is sealed and new one started after this size is reached
+TAIL_SIZE = 4096  # bytes read from the end of segment to find its last entry, way more than one entry takes
+
+logger = logging.getLogger(__name__)
+
+
+class ScrobbleCache:
+    """
+    Local cache of plays, that haven't been scrobbled yet.
+    Plays are appended to numbered segment files as JSON lines. Position of the first not acknowledged play is
+    kept in separate cursor file, so acknowledging plays costs a small atomic write instead of log rewrite.
+    Segments, that are fully acknowledged, are removed as soon as cursor leaves them.
+    Every play gets sequential id. Cursor keeps id of the last acknowledged play and progress of replay, that is
+    going on, so interrupted replay resumes from the cursor (a seek, not a rescan) and can be inspected by status()
+    """
+
+    def __init__(self, directory: str, segmentsize: int=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segmentsize = segmentsize
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = listsegments(directory)
+        checkpoint = self.loadcursor()
+        self.cursor = checkpoint['segment'], checkpoint['offset']
+        self.acked = checkpoint.get('play')  # id of the last acknowledged play, None for caches older than ids
+        self.replay = checkpoint.get('replay')  # progress of replay in progress
+        if self.cursor[0] not in self.segments:
+            # segment under cursor is gone, start from the first one we have
+            self.cursor = next((s for s in self.segments if s > self.cursor[0]), self.cursor[0]), 0
+        if self.segments:
+            repair(self.segmentpath(self.segments[-1]))
+        self.lastid = lastid(self.directory, self.segments) or self.acked or 0
+        self.compact()
+
+    def segmentpath(self, segment: int):
+        return segmentpath(self.directory, segment)
+
+    def cursorpath(self):
+        return os.path.join(self.directory, CURSOR_FILE)
+
+    def loadcursor(self):
+        """
+            returns: checkpoint dict stored in cursor file
+        """
+        try:
+            with open(self.cursorpath(), mode='r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segment': self.segments[0] if self.segments else 0, 'offset': 0}
+
+    def append(self, play: dict):
+        """
+        Appends play to the last segment. Starts new segment if the last one is full
+        """
+        with self.lock:
+            self.lastid += 1
+            line = json.dumps(dict(play, id=self.lastid), separators=(',', ':'), sort_keys=True) + '\n'
+            if not self.segments:
+                self.segments.append(self.cursor[0])
+            path = self.segmentpath(self.segments[-1])
+            if os.path.isfile(path) and os.path.getsize(path) >= self.segmentsize:
+                self.segments.append(self.segments[-1] + 1)
+                path = self.segmentpath(self.segments[-1])
+            with open(path, mode='a') as f:
+                f.write(line)
+
+    def isempty(self):
+        with self.lock:
+            if not self.segments:
+                return True
+            segment, offset = self.cursor
+            if segment < self.segments[-1]:
+                return False
+            path = self.segmentpath(segment)
+            return not os.path.isfile(path) or offset >= os.path.getsize(path)
+
+    def pendingbytes(self):
+        """
+        Size of not acknowledged part of the cache. Costs a stat per segment
+        """
+        with self.lock:
+            segment, offset = self.cursor
+            pending = 0
+            for s in self.segments:
+                try:
+                    size = os.path.getsize(self.segmentpath(s))
+                except FileNotFoundError:
+                    continue
+                pending += size - offset if s == segment else size
+            return pending
+
+    def plays(self):
+        """
+        Iterates over not acknowledged plays
+            returns: generator of (play, position) pairs. Commit position to acknowledge play and all plays before it
+        """
+        segment, offset = self.cursor
+        expected = self.acked + 1 if self.acked is not None else None
+        for s in list(self.segments):
+            if s < segment:
+                continue
+            if s > segment:
+                offset = 0
+            try:
+                with open(self.segmentpath(s), mode='rb') as f:
+                    f.seek(offset)
+                    for line in iter(f.readline, b''):
+                        if not line.endswith(b'\n'):
+                            break  # being written right now
+                        position = (s, f.tell())
+                        try:
+                            play = json.loads(line.decode())
+                        except ValueError:
+                            logger.warning("Skipping malformed cache entry %r", line)
+                            continue
+                        if expected is not None and play.get('id') not in (None, expected):
+                            logger.warning("Cache cursor points to play %s instead of %d", play.get('id'), expected)
+                        expected = None  # only the play under cursor is checked
+                        yield play, position
+            except FileNotFoundError:
+                continue  # compacted meanwhile
+
+    def batches(self, size: int):
+        """
+        Iterates over not acknowledged plays in lists of at most size elements
+            returns: generator of (plays, position) pairs, where position is the position after the last play in list
+        """
+        batch = []
+        position = None
+        for play, position in self.plays():
+            batch.append(play)
+            if len(batch) == size:
+                yield batch, position
+                batch = []
+        if batch:
+            yield batch, position
+
+    def commit(self, position: tuple, playid: int=None, replayed: int=0):
+        """
+        Acknowledges all plays up to position. Cursor is replaced atomically, so crash leaves either old or new one
+            param: playid - id of the last acknowledged play
+            param: replayed - number of plays acknowledged by replay since previous commit
+        """
+        with self.lock:
+            if self.replay is not None:
+                self.replay['replayed'] += replayed
+                self.replay['updated'] = round(time.time(), 3)
+            self.savecursor(position, playid if playid is not None else self.acked)
+        self.compact()
+
+    def startreplay(self):
+        """
+        Marks start of replay. Replay interrupted by crash is continued, not started over
+        """
+        with self.lock:
+            if self.replay is not None:
+                logger.info("Resuming cache replay started at %s, %d plays replayed",
+                            time.ctime(self.replay['started']), self.replay['replayed'])
+                return
+            self.replay = {'started': round(time.time(), 3), 'updated': round(time.time(), 3), 'replayed': 0,
+                           'target': self.lastid}  # id of the last play to replay
+            self.savecursor(self.cursor, self.acked)
+
+    def endreplay(self):
+        """
+        Marks that cache has been replayed up to target play
+        """
+        with self.lock:
+            if self.replay is None:
+                return
+            self.replay = None
+            self.savecursor(self.cursor, self.acked)
+
+    def savecursor(self, position: tuple, playid: int):
+        tmp = self.cursorpath() + TMP_FILE_SUFFIX
+        with open(tmp, mode='w') as f:
+            json.dump({'segment': position[0], 'offset': position[1], 'play': playid, 'replay': self.replay}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.cursorpath())
+        self.cursor = position
+        self.acked = playid
+
+    def compact(self):
+        """
+        Removes segments, that lie entirely before cursor
+        """
+        with self.lock:
+            while self.segments and self.segments[0] < self.cursor[0]:
+                segment = self.segments.pop(0)
+                try:
+                    os.remove(self.segmentpath(segment))
+                except FileNotFoundError:
+                    pass
+                logger.debug("Removed acknowledged cache segment %d", segment)
+
+
+def segmentpath(directory: str, segment: int):
+    return os.path.join(directory, "{:010d}{:s}".format(segment, SEGMENT_SUFFIX))
+
+
+def listsegments(directory: str):
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def repair(path: str):
+    """
+    Truncates incomplete trailing line left by interrupted write
+    """
+    with open(path, mode='r+b') as f:
+        content = f.read()
+        if content and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+            logger.warning("Truncated incomplete entry at the end of %s", path)
+
+
+def tail(path: str):
+    """
+        returns: the last complete entry of segment or None
+    """
+    with open(path, mode='rb') as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - TAIL_SIZE))
+        lines = f.read().split(b'\n')
+    for line in reversed(lines[:-1]):
+        try:
+            return json.loads(line.decode())
+        except ValueError:
+            continue
+    return None
+
+
+def lastid(directory: str, segments: list):
+    """
+        returns: id of the last play in cache, None if the cache is empty or older than ids
+    """
+    for segment in reversed(segments):
+        try:
+            play = tail(segmentpath(directory, segment))
+        except FileNotFoundError:
+            continue
+        if play is not None:
+            return play.get('id')
+    return None
+
+
+def status(directory: str):
+    """
+    Reads state of cache without modifying it, so it is safe while daemon runs
+        returns: dict describing checkpoint, pending plays and replay in progress
+    """
+    segments = listsegments(directory)
+    try:
+        with open(os.path.join(directory, CURSOR_FILE), mode='r') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        checkpoint = {'segment': segments[0] if segments else 0, 'offset': 0}
+    acked = checkpoint.get('play')
+    last = lastid(directory, segments)
+    pending = 0
+    for s in segments:
+        if s < checkpoint['segment']:
+            continue
+        try:
+            size = os.path.getsize(segmentpath(directory, s))
+        except FileNotFoundError:
+            continue  # compacted meanwhile
+        pending += size - checkpoint['offset'] if s == checkpoint['segment'] else size
+    return {'segments': len(segments),
+            'checkpoint': {'segment': checkpoint['segment'], 'offset': checkpoint['offset'], 'play': acked},
+            'last_play': last,
+            'pending_bytes': max(0, pending),
+            'pending_plays': last - (acked or 0) if last is not None else None,
+            'replay': checkpoint.get('replay')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.cache", description="Inspects local scrobble cache")
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('status', help="checkpoint, pending plays and replay progress")
+    command.add_argument('directory', help="cache directory, cache option of scrobbling service section in config")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.directory):
+        parser.error("no cache directory {:s}".format(args.directory))
+    print(json.dumps(status(args.directory), sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+from configparser import ConfigParser, Error as ConfigParserError
+
+
+CACHE_VERSION = 1  # bump when CompiledConfig changes
+TMP_FILE_SUFFIX = ".tmp"
+INSTANCE_PREFIX = "mpd:"
+REQUIRED_GROUPS = ('artist', 'title')
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class CompiledConfig:
+    """
+    Validated configuration. Pickled next to config file and reused while the file doesn't change, so validation of
+    (possibly hundreds of) tag guessing patterns is done once per config change, not once per start
+    """
+
+    def __init__(self, digest: str, sections: dict):
+        self.version = CACHE_VERSION
+        self.digest = digest  # sha256 of config file
+        self.sections = sections  # {section: {option: raw value}}
+
+    def parser(self):
+        """
+        returns: ConfigParser, that ScribScrobFactory reads options from
+        """
+        config = ConfigParser(allow_no_value=True, strict=False)
+        config.read_dict(self.sections)
+        return config
+
+
+def compileconfig(text: str, digest: str):
+    """
+    Parses and validates configuration
+        raises: ConfigError describing the first problem found
+    """
+    config = ConfigParser(allow_no_value=True, strict=False)
+    try:
+        config.read_string(text)
+    except ConfigParserError as e:
+        raise ConfigError(str(e))
+
+    for section in config.sections():
+        if section == 'mpd' or section.startswith(INSTANCE_PREFIX):
+            port = config.get(section, 'port', fallback=None)
+            if port is not None and not port.isdigit():
+                raise ConfigError("[{:s}] port is not a number: {:s}".format(section, port))
+        if section.startswith(INSTANCE_PREFIX):
+            account = config.get(section, 'account', fallback=None)
+            if not account or not any(s.endswith(":" + account) and not s.startswith(INSTANCE_PREFIX)
+                                      for s in config.sections()):
+                raise ConfigError("[{:s}] account refers to no scrobbling service section".format(section))
+
+    raw = config.get('tagguess', 'regexps', fallback=None)
+    if raw:
+        try:
+            regexps = json.loads(raw)
+        except ValueError as e:
+            raise ConfigError("[tagguess] regexps is not valid JSON: {}".format(e))
+        if not isinstance(regexps, list) or not all(isinstance(r, str) for r in regexps):
+            raise ConfigError("[tagguess] regexps is not a list of strings")
+        for r in regexps:
+            try:
+                groups = re.compile(r).groupindex
+            except re.error as e:
+                raise ConfigError("[tagguess] invalid regexp {:s}: {}".format(r, e))
+            if not all(g in groups for g in REQUIRED_GROUPS):
+                raise ConfigError("[tagguess] regexp {:s} lacks artist or title group".format(r))
+
+    return CompiledConfig(digest, {s: dict(config.items(s, raw=True)) for s in config.sections()})
+
+
+def load(path: str, cachepath: str):
+    """
+    returns: CompiledConfig of config file, from cache if file hasn't changed since it was compiled. Missing file
+    gives empty configuration
+        raises: ConfigError if file is not valid
+    """
+    try:
+        with open(path, mode='rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        logger.warning("No configuration file %s", path)
+        return compileconfig("", "")
+    digest = hashlib.sha256(data).hexdigest()
+
+    try:
+        with open(cachepath, mode='rb') as f:
+            cached = pickle.load(f)
+        if getattr(cached, 'version', None) == CACHE_VERSION and cached.digest == digest:
+            return cached
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Ignoring broken configuration cache %s: %s", cachepath, e)
+
+    compiled = compileconfig(data.decode('utf-8'), digest)
+    try:
+        tmp = cachepath + TMP_FILE_SUFFIX
+        with open(tmp, mode='wb') as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cachepath)
+    except OSError as e:
+        logger.warning("Can't write configuration cache %s: %s", cachepath, e)
+    logger.info("Compiled configuration %s", path)
+    return compiled
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import signal
+from scribscrob.state import ScrobblingMachine, reloadtransformer
+from scribscrob.transform import SongTransformer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """
+    Serves several MPD instances from one event loop. Every instance gets its own listener and ScrobblingMachine,
+    while instances scrobbling to the same account share one scrobbler (and its sessions, caches and dispatchers).
+    Instances may be added and removed while the loop runs
+    """
+
+    def __init__(self, transformer: SongTransformer):
+        self.transformer = transformer
+        self.scrobblers = {}  # {account section: scrobbler}
+        self.listeners = {}  # {instance name: listener}
+        self.machines = {}  # {instance name: machine}
+        self.tasks = {}  # {instance name: task}
+        self.accounts = {}  # {instance name: account section}
+
+    def add(self, name, factory):
+        """
+        Starts serving instance on running loop
+        """
+        if name in self.tasks:
+            return
+        if factory.lastfmsection not in self.scrobblers:
+            scrobbler = factory.get_scrobbler()
+            scrobbler.start()
+            self.scrobblers[factory.lastfmsection] = scrobbler
+        self.accounts[name] = factory.lastfmsection
+        self.tasks[name] = asyncio.ensure_future(self.serve(name, factory))
+
+    async def remove(self, name):
+        """
+        Stops serving instance. Its state stays in snapshot, so it can be picked up by another daemon. Scrobbler of
+        the account is stopped with its last instance, after the instance is done with it, so the account's cache is
+        owned by one daemon at a time
+        """
+        task = self.tasks.pop(name, None)
+        if task:
+            task.cancel()
+            await asyncio.wait([task])
+        self.listeners.pop(name, None)
+        self.machines.pop(name, None)
+        account = self.accounts.pop(name, None)
+        if account and account not in self.accounts.values():
+            scrobbler = self.scrobblers.pop(account)
+            stop = scrobbler.stopasync if hasattr(scrobbler, 'stopasync') else scrobbler.stop
+            await stop()
+
+    async def serve(self, name, factory):
+        """
+        Runs single instance. Failure of the instance is logged and doesn't affect others
+        """
+        try:
+            mpd = factory.get_mpd()
+            sm = ScrobblingMachine(transformer=self.transformer, scrobbler=self.scrobblers[factory.lastfmsection],
+                                   snapshots=factory.get_snapshots(), streamdebounce=factory.get_streamdebounce())
+        except Exception:
+            logger.exception("Instance %s failed", name)
+            return
+        self.listeners[name] = mpd
+        self.machines[name] = sm
+        try:
+            await mpd.listen_forever('player', sm.onevent, sm.resync, sm.disconnected, sm.scheduler)
+        except Exception:
+            logger.exception("Instance %s failed", name)
+        finally:
+            # timers of removed instance must not scrobble into stopping scrobbler or rewrite snapshot of the play,
+            # which is the next owner's now
+            if mpd.timerhandle:
+                mpd.timerhandle.cancel()
+                mpd.timerhandle = None
+            if sm.scrobbletimer:
+                sm.scrobbletimer.cancel()
+                sm.scrobbletimer = None
+            sm.cancelstream()
+            mpd.disconnect()
+
+    def reload(self, build):
+        """
+        Swaps transformer of all instances for freshly built one
+        """
+        transformer = reloadtransformer(list(self.machines.values()), build)
+        if transformer:
+            self.transformer = transformer
+
+    def load(self):
+        """
+            returns: {instance name: MPD events received}
+        """
+        return {name: listener.wakeups.value for name, listener in self.listeners.items()}
+
+    async def wait(self):
+        """
+        Waits till all instances finish, i.e. forever
+        """
+        while self.tasks:
+            await asyncio.wait(list(self.tasks.values()))
+            self.tasks = {name: task for name, task in self.tasks.items() if not task.done()}
+
+
+async def run(instances: list, transformer: SongTransformer, reload=None):
+    """
+    Serves instances from one event loop
+        param: instances - list of (name, factory) pairs
+        param: transformer - transformer shared by all instances
+        param: reload - builds new transformer, which replaces the current one on SIGHUP
+    """
+    daemon = Daemon(transformer)
+    if reload:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, daemon.reload, reload)
+    for name, factory in instances:
+        daemon.add(name, factory)
+    await daemon.wait()
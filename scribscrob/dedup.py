@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from scribscrob.model import canonical
+
+
+DEFAULT_WINDOW = 50000  # plays remembered exactly
+DEFAULT_CAPACITY = 100000  # plays per bloom filter generation
+BLOOM_BITS_PER_PLAY = 29  # ~1e-6 false positive rate
+BLOOM_HASHES = 20
+BLOOM_FILES = ("bloom.0", "bloom.1")
+RECENT_FILE = "recent.log"
+TMP_FILE_SUFFIX = ".tmp"
+HEADER = struct.Struct("<Q")  # number of plays added to generation
+
+logger = logging.getLogger(__name__)
+
+
+def playkey(artist, title, timestamp):
+    """
+    Identity of a play. Spelling variations of artist and title with the same canonical identity give the same key
+    """
+    return identitykey(canonical(artist, title), timestamp)
+
+
+def identitykey(key: tuple, timestamp):
+    """
+    Identity of a play of song with canonical identity key (i.e. Song.key), saves canonicalization of memoized songs
+    """
+    identity = "\x1f".join((str(key[0]), str(key[1]), str(int(timestamp))))
+    return hashlib.blake2b(identity.encode(), digest_size=16).digest()
+
+
+class DedupIndex:
+    """
+    Remembers submitted plays, so they are not submitted twice (e.g. by cache replay after partial failure).
+    The last window plays are kept in exact set, backed by append-only log. Older ones are remembered by rolling
+    bloom filter of two memory mapped generations: when the current one is full, the older one is cleared and becomes
+    current. Lookups are O(1) and don't touch disk
+    """
+
+    def __init__(self, directory: str, window: int=DEFAULT_WINDOW, capacity: int=DEFAULT_CAPACITY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.window = window
+        self.capacity = capacity
+        self.bits = capacity * BLOOM_BITS_PER_PLAY
+        self.lock = threading.Lock()
+        self.generations = [self.openbloom(name) for name in BLOOM_FILES]
+        # the generation with fewer plays is the one being filled
+        self.current = min((0, 1), key=lambda i: (self.count(i) >= capacity, -self.count(i)))
+        self.recent = OrderedDict()
+        self.recentlines = 0
+        self.loadrecent()
+        self.recentfile = open(self.path(RECENT_FILE), mode='ab')
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def openbloom(self, name):
+        size = HEADER.size + self.bits // 8 + 1
+        path = self.path(name)
+        with open(path, mode='ab') as f:
+            if f.tell() != size:
+                f.truncate(0)
+                f.truncate(size)
+        with open(path, mode='r+b') as f:
+            return mmap.mmap(f.fileno(), size)
+
+    def count(self, generation: int):
+        return HEADER.unpack_from(self.generations[generation])[0]
+
+    def loadrecent(self):
+        try:
+            with open(self.path(RECENT_FILE), mode='rb') as f:
+                for line in f:
+                    if len(line) == 33:  # skips line torn by crash
+                        self.remember(bytes.fromhex(line[:32].decode()))
+                        self.recentlines += 1
+        except FileNotFoundError:
+            pass
+
+    def remember(self, key: bytes):
+        self.recent[key] = None
+        if len(self.recent) > self.window:
+            self.recent.popitem(last=False)
+
+    def positions(self, key: bytes):
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(BLOOM_HASHES)]
+
+    def inbloom(self, generation: int, positions: list):
+        bloom = self.generations[generation]
+        return all(bloom[HEADER.size + p // 8] & (1 << (p % 8)) for p in positions)
+
+    def seen(self, key: bytes):
+        """
+        returns: True if play has been submitted already. False positive is possible for plays older than window with
+        probability of bloom filter
+        """
+        with self.lock:
+            if key in self.recent:
+                return True
+            positions = self.positions(key)
+            return self.inbloom(self.current, positions) or self.inbloom(1 - self.current, positions)
+
+    def add(self, key: bytes):
+        """
+        Remembers submitted play
+        """
+        with self.lock:
+            if key in self.recent:
+                return
+            self.remember(key)
+            self.recentfile.write(key.hex().encode() + b'\n')
+            self.recentfile.flush()
+            self.recentlines += 1
+            if self.recentlines > 2 * self.window:
+                self.compactrecent()
+
+            if self.count(self.current) >= self.capacity:
+                self.rotate()
+            bloom = self.generations[self.current]
+            for p in self.positions(key):
+                bloom[HEADER.size + p // 8] |= 1 << (p % 8)
+            HEADER.pack_into(bloom, 0, self.count(self.current) + 1)
+
+    def rotate(self):
+        self.current = 1 - self.current
+        bloom = self.generations[self.current]
+        bloom[:] = bytes(len(bloom))
+        logger.info("Rotated dedup bloom filter generation")
+
+    def compactrecent(self):
+        """
+        Rewrites recent log with the plays of the window only
+        """
+        tmp = self.path(RECENT_FILE + TMP_FILE_SUFFIX)
+        with open(tmp, mode='wb') as f:
+            f.writelines(key.hex().encode() + b'\n' for key in self.recent)
+        self.recentfile.close()
+        os.replace(tmp, self.path(RECENT_FILE))
+        self.recentfile = open(self.path(RECENT_FILE), mode='ab')
+        self.recentlines = len(self.recent)
+
+    def close(self):
+        with self.lock:
+            self.recentfile.close()
+            for bloom in self.generations:
+                bloom.close()
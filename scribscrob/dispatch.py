@@ -0,0 +1,128 @@
+import logging
+import queue
+import threading
+from scribscrob.metrics import REGISTRY
+
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_PUT_TIMEOUT = 0.5  # seconds to wait for free slot before scrobble is saved to local cache
+
+SCROBBLE = "scrobble"
+NOWPLAYING = "nowplaying"
+PENDING_NOWPLAYING = "send_pending_nowplaying"
+_STOP = None
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchingScrobbler:
+    """
+    Puts scrobbles and now playing notifications to bounded queue, which is drained by worker thread,
+    so caller (i.e. MPD event loop) never waits for network.
+    When queue is full, scrobbles wait for free slot up to puttimeout and then go to scrobbler's local cache.
+    Now playing notifications are just dropped. Now playing coalesced by scrobbler is queued too, when its window ends
+    """
+
+    def __init__(self, scrobbler, queuesize: int=DEFAULT_QUEUE_SIZE, puttimeout: float=DEFAULT_PUT_TIMEOUT,
+                 name: str=None):
+        self.scrobbler = scrobbler
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.puttimeout = puttimeout
+        self.worker = None
+        scrobbler.ondue = self.sendpending
+        REGISTRY.gauge('scribscrob_dispatch_queue_depth', "Items waiting in dispatch queue",
+                       callback=self.queue.qsize, dispatcher=name)
+
+    def start(self):
+        if not self.worker:
+            self.worker = threading.Thread(target=self.run, name="scrobble-dispatcher", daemon=True)
+            self.worker.start()
+
+    def stop(self, timeout: float=None):
+        """
+        Waits until queued items are sent and stops worker
+        """
+        if self.worker:
+            self.queue.put(_STOP)
+            self.worker.join(timeout)
+            self.worker = None
+            self.scrobbler.cancelnowplaying()
+
+    def scrobble(self, song, timestamp):
+        try:
+            self.queue.put((SCROBBLE, song, timestamp), timeout=self.puttimeout)
+        except queue.Full:
+            logger.warning("Dispatch queue is full. Saving %s to local cache", song)
+            self.scrobbler.scrobble_to_cache(song, timestamp)
+
+    def nowplaying(self, song):
+        try:
+            self.queue.put_nowait((NOWPLAYING, song))
+        except queue.Full:
+            logger.warning("Dispatch queue is full. Dropping now playing %s", song)
+
+    def sendpending(self):
+        """
+        Queues now playing, that scrobbler held back till the end of its window. Called by scrobbler's timer thread
+        """
+        try:
+            self.queue.put_nowait((PENDING_NOWPLAYING,))
+        except queue.Full:
+            logger.warning("Dispatch queue is full. Dropping pending now playing")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.dispatch(*item)
+            finally:
+                self.queue.task_done()
+
+    def dispatch(self, op, *args):
+        try:
+            getattr(self.scrobbler, op)(*args)
+        except Exception:
+            logger.exception("Failed to dispatch %s%s", op, args)
+
+
+class FanoutScrobbler:
+    """
+    Sends every scrobble and now playing notification to all backends. Every backend is wrapped in its own
+    dispatcher, so backends are sent to concurrently and slow or unavailable service doesn't delay others
+        param: dispatchers - DispatchingScrobbler or AsyncDispatchingScrobbler per backend
+    """
+
+    def __init__(self, dispatchers: list):
+        self.dispatchers = dispatchers
+
+    def start(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+
+    def stop(self, timeout: float=None):
+        """
+        Waits until queued items are sent and stops workers of sync dispatchers
+        """
+        for dispatcher in self.dispatchers:
+            dispatcher.stop(timeout)
+
+    async def stopasync(self):
+        """
+        Waits until queued items are sent and stops workers of asyncio dispatchers
+        """
+        import asyncio
+        await asyncio.gather(*(dispatcher.stop() for dispatcher in self.dispatchers))
+
+    def scrobble(self, song, timestamp):
+        for dispatcher in self.dispatchers:
+            dispatcher.scrobble(song, timestamp)
+
+    def nowplaying(self, song):
+        for dispatcher in self.dispatchers:
+            dispatcher.nowplaying(song)
+
+    def scrobble_to_cache(self, song, timestamp):
+        for dispatcher in self.dispatchers:
+            dispatcher.scrobbler.scrobble_to_cache(song, timestamp)
@@ -0,0 +1,284 @@
+import logging
+import random
+import threading
+import time
+from xml.sax.saxutils import escape
+from scribscrob.scrobble import TokenBucket
+
+
+MPD_VERSION = "0.23.0"
+LASTFM_PATH = "/2.0/"
+SESSION_KEY = "fakesessionkey"
+# last.fm API error codes
+ERROR_INVALID_METHOD = 3
+ERROR_OFFLINE = 11
+ERROR_RATE_LIMIT = 29
+
+logger = logging.getLogger(__name__)
+
+
+def playlist(plays: int, length: int=180, pauses: int=0, start: int=0):
+    """
+    Script of MPD player events: plays tracks one after another, pausing and resuming each one pauses times,
+    then stops. Events are (virtual ms, status dict, currentsong dict) tuples, like ones of recorded trace
+        param: length - track length in seconds
+    """
+    t = start
+    for i in range(plays):
+        song = {'file': "music/{:d}.flac".format(i), 'artist': "Artist {:d}".format(i % 97),
+                'title': "Title {:d}".format(i), 'album': "Album {:d}".format(i % 97), 'time': str(length)}
+        yield t, {'state': 'play', 'elapsed': "0.000"}, song
+        step = length * 1000 // (2 * pauses + 2)
+        for n in range(1, 2 * pauses + 1):
+            status = {'state': 'pause' if n % 2 else 'play', 'elapsed': "{:.3f}".format(n * step / 1000)}
+            yield t + n * step, status, song
+        t += length * 1000
+    yield t, {'state': 'stop'}, {}
+
+
+class FakeMpd:
+    """
+    MPD protocol emulator, that serves scripted player events to one client at a time. It implements what
+    MpdListener uses: every idle is answered by the next event of script, status and currentsong (in command lists
+    too) report state of the last sent event. When script is exhausted idle is left unanswered and done is set
+        param: script - iterable of (virtual ms, status dict, currentsong dict) tuples, i.e. playlist() or trace
+        param: rate - events per second, None to send them as fast as client asks
+        param: clock - one element list, which is set to virtual time of event when it is sent
+        param: lockstep - send the next event only after the client calls handled() for the previous one. MPD client
+            re-arms idle before it handles event, so otherwise virtual time could move while the event is handled
+    """
+
+    def __init__(self, script, rate: float=None, clock: list=None, lockstep: bool=False, host: str='localhost',
+                 port: int=0):
+        import socketserver  # only in load tests
+        self.script = iter(script)
+        self.interval = 1 / rate if rate else 0
+        self.clock = clock
+        self.turn = threading.Semaphore(1) if lockstep else None
+        self.stopped = False
+        self.status = {'state': 'stop'}
+        self.song = {}
+        self.events = 0
+        self.sentat = 0  # perf_counter of the last sent event
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with fake.lock:
+                    fake.connections.append(self.connection)
+                fake.serve(self.rfile, self.wfile)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.connections = []
+        self.server = Server((host, port), Handler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-mpd", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops server and drops connections, so client waiting for idle sees connection lost
+        """
+        import socket
+        self.stopped = True
+        if self.turn:
+            self.turn.release()  # wakes up handler waiting for its turn
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def next(self):
+        """
+        Makes the next event of script current, not sooner than rate allows
+            returns: False if script is exhausted or server is stopped
+        """
+        if self.turn:
+            self.turn.acquire()
+        if self.stopped:
+            return False
+        with self.lock:
+            event = next(self.script, None)
+            if event is None:
+                self.done.set()
+                return False
+            wait = self.sentat + self.interval - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            t, self.status, self.song = event
+            if self.clock is not None:
+                self.clock[0] = t
+            self.events += 1
+            self.sentat = time.perf_counter()
+            return True
+
+    def handled(self):
+        """
+        Lets lockstep server send the next event
+        """
+        if self.turn:
+            self.turn.release()
+
+    def serve(self, rfile, wfile):
+        wfile.write("OK MPD {:s}\n".format(MPD_VERSION).encode())
+        commands = None  # commands of command list being received
+        for line in rfile:
+            command = line.decode().strip()
+            if command == 'close':
+                return
+            if command.startswith('command_list'):
+                if command == 'command_list_end':
+                    wfile.write(b"".join(self.respond(c) + b"list_OK\n" for c in commands) + b"OK\n")
+                    commands = None
+                else:
+                    commands = []
+            elif commands is not None:
+                commands.append(command)
+            elif command.startswith('idle'):
+                if self.next():
+                    wfile.write(b"changed: player\nOK\n")
+            elif command == 'noidle':
+                wfile.write(b"OK\n")
+            else:
+                response = self.respond(command)
+                wfile.write(response + b"OK\n" if response is not None else
+                            "ACK [5@0] {{{:s}}} unknown command \"{:s}\"\n".format(command, command).encode())
+
+    def respond(self, command: str):
+        """
+            returns: response of command without the final OK or None if command is not supported
+        """
+        if command == 'status':
+            return "".join("{:s}: {}\n".format(k, v) for k, v in self.status.items()).encode()
+        if command == 'currentsong':
+            return "".join("{:s}: {}\n".format(k, v) for k, v in self.song.items()).encode()
+        if command == 'ping':
+            return b""
+        return None
+
+
+class FakeLastfm:
+    """
+    last.fm compatible web service endpoint (POST /2.0/ with form encoded parameters, XML responses) implementing
+    auth.getMobileSession, track.scrobble and track.updateNowPlaying. Latency, errors and rate limits are injectable
+        param: latency - seconds every request takes, plus up to jitter seconds
+        param: errorrate - share of requests failing with HTTP 503
+        param: ratelimit - requests per second, that are served. The rest fail with rate limit error
+    """
+
+    def __init__(self, latency: float=0, jitter: float=0, errorrate: float=0, ratelimit: float=None,
+                 seed: int=0, host: str='localhost', port: int=0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # only in load tests
+        from urllib.parse import parse_qs
+        self.latency = latency
+        self.jitter = jitter
+        self.errorrate = errorrate
+        self.bucket = TokenBucket(ratelimit, max(1, int(ratelimit))) if ratelimit else None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'failed': 0, 'ratelimited': 0, 'nowplaying': 0, 'scrobbles': 0}
+        self.scrobbles = []  # accepted (artist, title, timestamp) tuples
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?')[0] != LASTFM_PATH:
+                    self.send_error(404)
+                    return
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                status, xml = fake.handle(params)
+                body = xml.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/xml; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{:s}:{:d}{:s}".format(*self.server.server_address[:2], LASTFM_PATH)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-lastfm", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, params: dict):
+        """
+            returns: (HTTP status, XML body) pair
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.errorrate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            self.count('failed')
+            return 503, error(ERROR_OFFLINE, "Service temporarily unavailable")
+        if self.bucket and self.bucket.tryacquire():
+            self.count('ratelimited')
+            return 200, error(ERROR_RATE_LIMIT, "Rate limit exceeded")
+
+        method = params.get('method')
+        if method == 'auth.getMobileSession':
+            return 200, ok("<session><name>{:s}</name><key>{:s}</key><subscriber>0</subscriber></session>".format(
+                escape(params.get('username', "")), SESSION_KEY))
+        if method == 'track.updateNowPlaying':
+            self.count('nowplaying')
+            return 200, ok("<nowplaying><track>{:s}</track><artist>{:s}</artist></nowplaying>".format(
+                escape(params.get('track', "")), escape(params.get('artist', ""))))
+        if method == 'track.scrobble':
+            if 'track' in params:
+                tracks = [(params.get('artist'), params['track'], int(params['timestamp']))]
+            else:
+                tracks = []
+                while 'track[{:d}]'.format(len(tracks)) in params:
+                    suffix = "[{:d}]".format(len(tracks))
+                    tracks.append((params.get('artist' + suffix), params['track' + suffix],
+                                   int(params['timestamp' + suffix])))
+            with self.lock:
+                self.scrobbles.extend(tracks)
+                self.counts['scrobbles'] += len(tracks)
+            return 200, ok('<scrobbles accepted="{:d}" ignored="0"></scrobbles>'.format(len(tracks)))
+        return 200, error(ERROR_INVALID_METHOD, "Invalid Method - No method with that name in this package")
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def ok(content: str):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="ok">{:s}</lfm>'.format(content)
+
+
+def error(code: int, message: str):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="failed"><error code="{:d}">{:s}</error></lfm>'.format(
+        code, escape(message))
@@ -0,0 +1,250 @@
+import argparse
+import csv
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from scribscrob.cache import ScrobbleCache
+from scribscrob.model import Song, canonical
+from scribscrob.scrobble import Scrobbler
+
+
+COLUMNS = ('timestamp', 'artist', 'title', 'album', 'file', 'length')
+GROUPS = {'artist': ('artist',), 'track': ('artist', 'title'), 'album': ('artist', 'album')}
+# plays are grouped by canonical identity, so spelling variations count as one artist or track
+GROUP_KEYS = {'artist': ('artist_key',), 'track': ('artist_key', 'title_key'), 'album': ('artist_key', 'album')}
+EXPORT_BATCH_SIZE = 65536  # rows fetched (and written as one parquet row group) at once
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    timestamp INTEGER NOT NULL,
+    artist TEXT NOT NULL,
+    title TEXT NOT NULL,
+    album TEXT,
+    file TEXT,
+    length INTEGER,  -- milliseconds, as Song.length
+    artist_key TEXT,  -- canonical identity, Song.key
+    title_key TEXT
+);
+"""
+# indexes on raw tags were used before canonical identity was added
+INDEXES = """
+DROP INDEX IF EXISTS plays_timestamp;
+DROP INDEX IF EXISTS plays_track;
+DROP INDEX IF EXISTS plays_album;
+CREATE UNIQUE INDEX IF NOT EXISTS plays_identity ON plays (timestamp, artist_key, title_key);
+CREATE INDEX IF NOT EXISTS plays_track_key ON plays (artist_key, title_key);
+CREATE INDEX IF NOT EXISTS plays_album_key ON plays (artist_key, album);
+"""
+INSERT = "INSERT OR IGNORE INTO plays ({:s}, artist_key, title_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(
+    ", ".join(COLUMNS))
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """
+    Local listening history in SQLite. Plays are unique by timestamp and canonical identity of the song, so replayed
+    plays (even under different spelling) are ignored. Indexes on timestamp, artist and track keep top-N and time
+    range queries fast over millions of plays
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        migrate(self.connection)
+        self.connection.executescript(INDEXES)
+        self.lock = threading.Lock()
+
+    def add(self, song: Song, timestamp):
+        self.insert([(timestamp, song.artist, song.title, song.album, song.file, song.length) + song.key])
+
+    def addmany(self, rows):
+        """
+            param: rows - iterable of tuples in COLUMNS order
+        """
+        self.insert(row + canonical(row[1], row[2]) for row in rows)
+
+    def insert(self, rows):
+        """
+            param: rows - iterable of tuples in COLUMNS order followed by canonical artist and title
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(INSERT, rows)
+
+    def count(self, since: int=None, until: int=None):
+        where, args = timerange(since, until)
+        with self.lock:
+            return self.connection.execute("SELECT count(*) FROM plays" + where, args).fetchone()[0]
+
+    def top(self, by: str='artist', n: int=10, since: int=None, until: int=None):
+        """
+            param: by - one of GROUPS
+            returns: list of (*group, plays) tuples, the most played first
+        """
+        where, args = timerange(since, until)
+        query = "SELECT {0:s}, count(*) AS plays FROM plays{1:s} GROUP BY {2:s} ORDER BY plays DESC, {2:s} LIMIT ?"
+        with self.lock:
+            return self.connection.execute(query.format(", ".join(GROUPS[by]), where, ", ".join(GROUP_KEYS[by])),
+                                           args + [n]).fetchall()
+
+    def range(self, since: int=None, until: int=None, batchsize: int=EXPORT_BATCH_SIZE):
+        """
+        Streams plays ordered by timestamp
+            returns: generator of lists of at most batchsize rows in COLUMNS order
+        """
+        where, args = timerange(since, until)
+        with self.lock:
+            cursor = self.connection.execute("SELECT {:s} FROM plays{:s} ORDER BY timestamp".format(
+                ", ".join(COLUMNS), where), args)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batchsize)
+            if not rows:
+                return
+            yield rows
+
+    def exportcsv(self, f, since: int=None, until: int=None):
+        """
+            returns: number of exported plays
+        """
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        exported = 0
+        for rows in self.range(since, until):
+            writer.writerows(rows)
+            exported += len(rows)
+        return exported
+
+    def exportparquet(self, path: str, since: int=None, until: int=None):
+        """
+        Needs pyarrow. Every fetched batch becomes a row group, so memory use doesn't depend on history size
+            returns: number of exported plays
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow installed")
+        schema = pyarrow.schema([('timestamp', pyarrow.int64()), ('artist', pyarrow.string()),
+                                 ('title', pyarrow.string()), ('album', pyarrow.string()),
+                                 ('file', pyarrow.string()), ('length', pyarrow.int64())])
+        exported = 0
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for rows in self.range(since, until):
+                writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(c) for c in zip(*rows)], schema=schema))
+                exported += len(rows)
+        return exported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def migrate(connection: sqlite3.Connection):
+    """
+    Adds canonical identity to history created before it was introduced. Plays, that turn out to be the same, are
+    merged
+    """
+    if 'artist_key' in {row[1] for row in connection.execute("PRAGMA table_info(plays)")}:
+        return
+    connection.create_function('canonical_artist', 1, lambda artist: canonical(artist, None)[0])
+    connection.create_function('canonical_title', 1, lambda title: canonical(None, title)[1])
+    with connection:
+        connection.execute("ALTER TABLE plays ADD COLUMN artist_key TEXT")
+        connection.execute("ALTER TABLE plays ADD COLUMN title_key TEXT")
+        connection.execute("UPDATE plays SET artist_key = canonical_artist(artist), title_key = canonical_title(title)")
+        merged = connection.execute("DELETE FROM plays WHERE rowid NOT IN "
+                                    "(SELECT min(rowid) FROM plays GROUP BY timestamp, artist_key, title_key)").rowcount
+    logger.info("Added canonical identity to history, %d duplicate plays merged", merged)
+
+
+def timerange(since: int=None, until: int=None):
+    """
+    returns: (WHERE clause, arguments) pair of half-open [since, until) range, empty clause if there are no bounds
+    """
+    conditions, args = [], []
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        args.append(since)
+    if until is not None:
+        conditions.append("timestamp < ?")
+        args.append(until)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), args
+
+
+class HistoryScrobbler(Scrobbler):
+    """
+    Records scrobbles to HistoryStore. Now playing notifications are not recorded
+    """
+    service = 'history'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, store: HistoryStore, cache: ScrobbleCache=None):
+        super().__init__(store.path, cache=cache)
+        self.store = store
+
+    def submit(self, song: Song, timestamp):
+        self.store.add(song, timestamp)
+
+    def submitmany(self, plays):
+        self.store.addmany((d['start'], d['song']['artist'], d['song']['title'], d['song'].get('album'), None, None)
+                           for d in plays)
+
+    def sendnowplaying(self, song):
+        pass
+
+
+def timestamp(value: str):
+    """
+    returns: unix time of ISO date (time), which may be unix time already
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.history", description="Queries listening history")
+    parser.add_argument('database', help="history database, [history] path in config")
+    parser.add_argument('--since', type=timestamp, help="ISO date or unix time, inclusive")
+    parser.add_argument('--until', type=timestamp, help="ISO date or unix time, exclusive")
+    commands = parser.add_subparsers(dest='command', required=True)
+    top = commands.add_parser('top', help="the most played artists, tracks or albums")
+    top.add_argument('by', choices=sorted(GROUPS))
+    top.add_argument('-n', type=int, default=10, help="number of entries, 10 by default")
+    commands.add_parser('count', help="number of plays")
+    export = commands.add_parser('export', help="exports plays ordered by time")
+    export.add_argument('--format', choices=('csv', 'parquet'), default='csv')
+    export.add_argument('-o', '--output', help="output file, CSV goes to stdout by default")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(args.database)
+    try:
+        if args.command == 'top':
+            for row in store.top(args.by, args.n, args.since, args.until):
+                print(json.dumps(row))
+        elif args.command == 'count':
+            print(store.count(args.since, args.until))
+        elif args.format == 'parquet':
+            if not args.output:
+                parser.error("parquet export needs --output")
+            store.exportparquet(args.output, args.since, args.until)
+        elif args.output:
+            with open(args.output, mode='w', newline='') as f:
+                store.exportcsv(f, args.since, args.until)
+        else:
+            store.exportcsv(sys.stdout, args.since, args.until)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
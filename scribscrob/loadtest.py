@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import scribscrob.state
+from scribscrob.fakes import FakeLastfm, FakeMpd, playlist
+from scribscrob.state import ScrobblingMachine
+
+
+REQUEST_TIMEOUT = 30  # seconds
+RUN_TIMEOUT = 600  # seconds to wait for the script to be played
+PERCENTILES = (50, 95, 99)
+
+logger = logging.getLogger(__name__)
+
+
+class LastfmHttpClient:
+    """
+    Speaks last.fm web service protocol over plain HTTP, so load test can put it in place of pylast network of
+    LastfmScrobbler: pylast always connects to its ws_server by HTTPS, which local endpoint can't serve without
+    certificates. Failures are raised as pylast exceptions, so the scrobbler handles them as in production.
+    Latencies of requests are kept by method
+    """
+
+    def __init__(self, url: str, apikey: str, apisecret: str, username: str, password_hash: str,
+                 timeout: float=REQUEST_TIMEOUT):
+        self.url = url
+        self.apikey = apikey
+        self.apisecret = apisecret
+        self.username = username
+        self.password_hash = password_hash
+        self.timeout = timeout
+        self.sessionkey = None
+        self.latencies = {}  # {method: [seconds]}
+        self.lock = threading.Lock()
+
+    def scrobble(self, artist, title, timestamp, album=None):
+        self.scrobble_many([{'artist': artist, 'title': title, 'timestamp': timestamp, 'album': album}])
+
+    def scrobble_many(self, tracks):
+        params = {}
+        for i, track in enumerate(tracks):
+            for name, value in track.items():
+                if value is not None:
+                    params["{:s}[{:d}]".format('track' if name == 'title' else name, i)] = str(value)
+        self.call('track.scrobble', params)
+
+    def update_now_playing(self, artist, title, album=None):
+        params = {'artist': artist, 'track': title}
+        if album:
+            params['album'] = album
+        self.call('track.updateNowPlaying', params)
+
+    def call(self, method: str, params: dict):
+        if not self.sessionkey:
+            token = hashlib.md5((self.username + self.password_hash).encode()).hexdigest()
+            session = self.request('auth.getMobileSession', {'username': self.username, 'authToken': token})
+            self.sessionkey = session.findtext('session/key')
+        return self.request(method, dict(params, sk=self.sessionkey))
+
+    def request(self, method: str, params: dict):
+        """
+            returns: parsed <lfm> element of successful response
+        """
+        import pylast
+        import urllib.error
+        import urllib.parse
+        import urllib.request
+        from xml.etree import ElementTree
+        params = dict(params, method=method, api_key=self.apikey)
+        params['api_sig'] = hashlib.md5(("".join(k + params[k] for k in sorted(params)) + self.apisecret)
+                                        .encode()).hexdigest()
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(self.url, data=urllib.parse.urlencode(params).encode(),
+                                        timeout=self.timeout) as response:
+                body = response.read()
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            if e.code >= 500:
+                raise pylast.WSError(self, str(e.code), "Connection to the API failed with HTTP code {:d}".format(
+                    e.code))
+        except OSError as e:
+            raise pylast.NetworkError(self, e)
+        finally:
+            with self.lock:
+                self.latencies.setdefault(method, []).append(time.perf_counter() - started)
+        try:
+            lfm = ElementTree.fromstring(body)
+        except ElementTree.ParseError as e:
+            raise pylast.MalformedResponseError(self, e)
+        if lfm.get('status') != 'ok':
+            error = lfm.find('error')
+            raise pylast.WSError(self, error.get('code'), error.text)
+        return lfm
+
+
+def percentiles(values: list):
+    """
+        returns: dict of count, nearest rank percentiles and max of values, which are in seconds, in ms
+    """
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    report = {'count': len(values), 'max_ms': round(values[-1] * 1000, 3)}
+    for p in PERCENTILES:
+        report['p{:d}_ms'.format(p)] = round(values[max(0, -(-len(values) * p // 100) - 1)] * 1000, 3)
+    return report
+
+
+def loadtestconfig(directory: str, mpdaddress: tuple, clientrate: float=None):
+    """
+        returns: configuration of single instance talking to fake MPD, with state kept in directory
+    """
+    from configparser import ConfigParser
+    lastfm = {'user': "loadtest", 'password_hash': hashlib.md5(b"loadtest").hexdigest(),
+              'cache': directory + "/cache", 'dedup': directory + "/dedup"}
+    if clientrate:
+        lastfm.update(rate=str(clientrate), burst=str(max(1, int(clientrate))))
+    config = ConfigParser()
+    config.read_dict({'mpd': {'host': mpdaddress[0], 'port': str(mpdaddress[1]),
+                              'snapshot': directory + "/snapshot.json"},
+                      'last.fm': lastfm,
+                      'tagguess': {'regexps': json.dumps(["(?P<artist>.+) - (?P<title>.+)"])}})
+    return config
+
+
+def drive(listener, machine: ScrobblingMachine, onevent):
+    """
+    Listens to MPD till connection is lost
+    """
+    from scribscrob.mpdlistener import connectionerrors
+    try:
+        listener.connect()
+        machine.resync(*listener.status())
+        listener.listen('player', onevent, machine.scheduler)
+    except connectionerrors() as e:
+        logger.debug("Load test listener is done: %s", e)
+    finally:
+        listener.disconnect()
+
+
+def run(plays: int=1000, length: int=180, pauses: int=1, rate: float=None, latency: float=0, jitter: float=0,
+        errorrate: float=0, ratelimit: float=None, clientrate: float=None, seed: int=0, timeout: float=RUN_TIMEOUT):
+    """
+    Plays scripted player events of fake MPD through MpdListener, ScrobblingMachine and dispatched LastfmScrobbler
+    built by ScribScrobFactory to fake last.fm endpoint. Machine runs on virtual time of the script, like trace
+    replay, so plays of hours take as long as the pipeline needs
+        param: rate - MPD events per second, as fast as pipeline handles them by default
+        param: latency, jitter, errorrate, ratelimit - behaviour of last.fm endpoint, see FakeLastfm
+        param: clientrate - requests per second the scrobbler allows itself, last.fm limit by default
+        returns: report dict
+    """
+    from scribscrob.__main__ import ScribScrobFactory
+    from scribscrob.cache import status as cachestatus
+    directory = tempfile.mkdtemp(prefix="scribscrob-loadtest-")
+    clock = [0]
+    original = scribscrob.state.current_time_millis
+    scribscrob.state.current_time_millis = lambda: clock[0]
+    lastfm = FakeLastfm(latency, jitter, errorrate, ratelimit, seed)
+    mpd = FakeMpd(playlist(plays, length, pauses), rate, clock, lockstep=True)
+    lastfm.start()
+    mpd.start()
+    try:
+        factory = ScribScrobFactory(loadtestconfig(directory, mpd.address, clientrate))
+        dispatcher = factory.get_scrobbler()
+        scrobbler = dispatcher.scrobbler
+        client = LastfmHttpClient(lastfm.url, scrobbler.apikey, scrobbler.apisecret, scrobbler.username,
+                                  scrobbler.password_hash)
+        scrobbler.network = client
+        dispatcher.start()
+        machine = ScrobblingMachine(transformer=factory.get_transformer(), scrobbler=dispatcher,
+                                    snapshots=factory.get_snapshots())
+        eventlatencies = []
+        cachebytes = [0]  # peak of not acknowledged cache
+
+        def onevent(status, song):
+            machine.onevent(status, song)
+            eventlatencies.append(time.perf_counter() - mpd.sentat)
+            cachebytes[0] = max(cachebytes[0], scrobbler.cache.pendingbytes())
+            mpd.handled()
+
+        listener = factory.get_mpd()
+        thread = threading.Thread(target=drive, args=(listener, machine, onevent), name="loadtest-listener",
+                                  daemon=True)
+        started = time.perf_counter()
+        thread.start()
+        if not mpd.done.wait(timeout):
+            raise TimeoutError("Script is not played in {:.0f}s, {:d} events sent".format(timeout, mpd.events))
+        seconds = time.perf_counter() - started
+        dispatcher.stop()
+        drained = time.perf_counter() - started
+        mpd.stop()
+        thread.join(REQUEST_TIMEOUT)
+        cache = cachestatus(scrobbler.cache.directory)
+        return {'events': mpd.events,
+                'seconds': round(seconds, 3),
+                'drain_seconds': round(drained - seconds, 3),
+                'events_per_second': round(mpd.events / seconds, 1) if seconds else float('inf'),
+                'event_latency': percentiles(eventlatencies),
+                'plays': plays,
+                'scrobbles_accepted': lastfm.counts['scrobbles'],
+                'duplicates': len(lastfm.scrobbles) - len(set(lastfm.scrobbles)),
+                'lastfm': dict(lastfm.counts),
+                'request_latency': {method: percentiles(values) for method, values in sorted(client.latencies.items())},
+                'cache': {'peak_pending_bytes': cachebytes[0],
+                          'pending_bytes': cache['pending_bytes'],
+                          'pending_plays': cache['pending_plays'] or 0}}
+    finally:
+        scribscrob.state.current_time_millis = original
+        mpd.stop()
+        lastfm.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.loadtest",
+                                     description="Runs MPD -> scrobbling machine -> last.fm pipeline against local "
+                                                 "fake servers and reports throughput, latency and cache growth")
+    parser.add_argument('--plays', type=int, default=1000, help="tracks played by fake MPD")
+    parser.add_argument('--length', type=int, default=180, help="track length, seconds of virtual time")
+    parser.add_argument('--pauses', type=int, default=1, help="pause/resume pairs per track")
+    parser.add_argument('--rate', type=float, help="MPD events per second, as fast as possible by default")
+    parser.add_argument('--latency', type=float, default=0, help="last.fm response time, seconds")
+    parser.add_argument('--jitter', type=float, default=0, help="random extra last.fm response time, seconds")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of last.fm requests failing with 503")
+    parser.add_argument('--rate-limit', type=float, help="last.fm requests per second served, the rest are refused")
+    parser.add_argument('--client-rate', type=float, help="requests per second the scrobbler allows itself, "
+                                                          "[last.fm] rate by default")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    report = run(args.plays, args.length, args.pauses, args.rate, args.latency, args.jitter, args.error_rate,
+                 args.rate_limit, args.client_rate, args.seed)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
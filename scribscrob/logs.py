@@ -0,0 +1,148 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+DEFAULT_LEVEL = logging.INFO
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+DEFAULT_ROTATE_INTERVAL = 24 * 60 * 60  # seconds
+DEFAULT_SAMPLE_DEBUG = 1  # every DEBUG record is kept
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats record as single JSON line
+    """
+
+    def format(self, record: logging.LogRecord):
+        d = {'t': round(record.created, 3),
+             'level': record.levelname,
+             'logger': record.name,
+             'thread': record.threadName,
+             'msg': record.getMessage()}
+        if record.exc_info:
+            d['exc'] = self.formatException(record.exc_info)
+        return json.dumps(d, default=str)
+
+
+class RotatingHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates file when it would grow past maxbytes or when interval seconds passed since it was opened, whatever comes
+    first. Rotated files are numbered like ones of RotatingFileHandler
+    """
+
+    def __init__(self, path: str, maxbytes: int=DEFAULT_MAX_BYTES, backups: int=DEFAULT_BACKUPS,
+                 interval: float=DEFAULT_ROTATE_INTERVAL, clock=time.time):
+        super().__init__(path, maxBytes=maxbytes, backupCount=backups, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.clock = clock
+        self.rolloverat = clock() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and self.clock() >= self.rolloverat:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rolloverat = self.clock() + self.interval
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps every rate-th DEBUG record of each message template, so high frequency debug events (one per MPD event)
+    don't flood the log. Other levels pass
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno != logging.DEBUG or self.rate <= 1:
+            return True
+        key = record.name, record.msg
+        with self.lock:
+            n = self.counts.get(key, 0)
+            self.counts[key] = n + 1
+        return n % self.rate == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, that leaves message formatting to the listener thread. Objects logged by scribscrob (Song, Status,
+    MPD responses) are not changed after they are logged, so they may be formatted later
+    """
+
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+
+class LogPipeline:
+    """
+    Non-blocking logging: callers only put records to queue, which is drained by QueueListener thread writing
+    JSON lines to rotating file
+        param: levels - {logger name: level} overriding level for modules
+        param: sampledebug - keep every sampledebug-th DEBUG record of a message
+    """
+
+    def __init__(self, path: str, level: int=DEFAULT_LEVEL, levels: dict=None, maxbytes: int=DEFAULT_MAX_BYTES,
+                 backups: int=DEFAULT_BACKUPS, interval: float=DEFAULT_ROTATE_INTERVAL,
+                 sampledebug: int=DEFAULT_SAMPLE_DEBUG):
+        self.path = path
+        self.level = level
+        self.levels = levels if levels else {}
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.interval = interval
+        self.sampledebug = sampledebug
+        self.handler = None
+        self.listener = None
+
+    def start(self, records=None):
+        """
+            param: records - queue to drain, i.e. multiprocessing one shared with worker processes
+        """
+        handler = RotatingHandler(self.path, self.maxbytes, self.backups, self.interval)
+        handler.setFormatter(JsonFormatter())
+        records = records if records is not None else queue.SimpleQueue()
+        self.handler = DeferredQueueHandler(records)
+        self.listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        self.configure(self.handler)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def forward(self, records):
+        """
+        Sends records of worker process to records queue of supervisor's pipeline. Unlike DeferredQueueHandler, plain
+        QueueHandler formats messages in the worker, since records are pickled to cross process boundary
+        """
+        self.configure(logging.handlers.QueueHandler(records))
+
+    def configure(self, handler: logging.Handler):
+        handler.addFilter(SamplingFilter(self.sampledebug))
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(handler)
+        root.setLevel(self.level)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+    def stop(self):
+        """
+        Writes queued records and stops listener thread
+        """
+        if self.listener:
+            logging.getLogger().removeHandler(self.handler)
+            self.listener.stop()
+            for h in self.listener.handlers:
+                h.close()
+            self.listener = None
@@ -0,0 +1,302 @@
+import bisect
+import logging
+import re
+import socket
+import threading
+import time
+
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_STATSD_INTERVAL = 10  # seconds
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+STATSD_UNSAFE = re.compile(r"[^A-Za-z0-9_-]")  # characters, that can't be part of statsd key
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    """
+    Monotonically growing value
+    """
+    type = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int=1):
+        self.value += n
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Gauge:
+    """
+    Value, that can go up and down. Either set explicitly or read from callback at collection time
+    """
+    type = "gauge"
+
+    def __init__(self, callback=None):
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield "", {}, self.callback() if self.callback else self.value
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket bounds. Cheap enough to be updated in hot path
+    """
+    type = "histogram"
+
+    def __init__(self, buckets: tuple=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for values above the highest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """
+        Context manager, that observes duration of its block
+        """
+        return Timer(self)
+
+    def percentile(self, p: float):
+        """
+        Upper bound of the bucket, that p-th percentile falls into. Infinity if it is above the highest bound
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def samples(self):
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            yield "_bucket", {'le': "{:g}".format(bound)}, seen
+        yield "_bucket", {'le': "+Inf"}, self.count
+        yield "_sum", {}, self.sum
+        yield "_count", {}, self.count
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n={:d} mean={:.4f}s p50<={:g}s p99<={:g}s".format(self.count, self.mean(),
+                                                                  self.percentile(50), self.percentile(99))
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class RequestMetrics:
+    """
+    Success and failure counters and latency histogram of requests of one kind
+    """
+
+    def __init__(self, registry: 'Registry', op: str, **labels):
+        self.ok = registry.counter('scribscrob_requests_total', "Requests to scrobbling services",
+                                   op=op, result='ok', **labels)
+        self.failed = registry.counter('scribscrob_requests_total', "Requests to scrobbling services",
+                                       op=op, result='failed', **labels)
+        self.latency = registry.histogram('scribscrob_request_seconds', "Latency of requests to scrobbling services",
+                                          op=op, **labels)
+
+    def measure(self):
+        """
+        Context manager, that counts its block as request. Block raising exception is counted as failed one
+        """
+        return RequestTimer(self)
+
+
+class RequestTimer(Timer):
+    def __init__(self, metrics: RequestMetrics):
+        super().__init__(metrics.latency)
+        self.metrics = metrics
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+        (self.metrics.failed if exc_type else self.metrics.ok).inc()
+
+
+class Registry:
+    """
+    Named metrics. The same name and labels always give the same metric, so it can be looked up once and kept
+    """
+
+    def __init__(self):
+        self.metrics = {}  # name -> (help, {labels: metric})
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, help: str, **labels):
+        return self.register(name, help, labels, Counter)
+
+    def gauge(self, name: str, help: str, callback=None, **labels):
+        gauge = self.register(name, help, labels, Gauge)
+        if callback:
+            # the latest owner of the gauge reports it
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets: tuple=LATENCY_BUCKETS, **labels):
+        return self.register(name, help, labels, lambda: Histogram(buckets))
+
+    def register(self, name, help, labels, create):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            _, family = self.metrics.setdefault(name, (help, {}))
+            if key not in family:
+                family[key] = create()
+            return family[key]
+
+    def collect(self):
+        """
+        returns: generator of (name, type, help, [(sample name, labels, value)]) tuples
+        """
+        with self.lock:
+            metrics = [(name, help, list(family.items())) for name, (help, family) in sorted(self.metrics.items())]
+        for name, help, family in metrics:
+            samples = [(name + suffix, dict(labels, **extra), value)
+                       for labels, metric in family for suffix, extra, value in metric.samples()]
+            yield name, family[0][1].type, help, samples
+
+    def exposition(self):
+        """
+        Metrics in Prometheus text format
+        """
+        lines = []
+        for name, type, help, samples in self.collect():
+            lines.append("# HELP {:s} {:s}".format(name, help))
+            lines.append("# TYPE {:s} {:s}".format(name, type))
+            for sample, labels, value in samples:
+                lines.append("{:s}{:s} {}".format(sample, formatlabels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def formatlabels(labels: dict):
+    if not labels:
+        return ""
+    return "{" + ",".join('{:s}="{:s}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """
+    Serves registry in Prometheus text format on /metrics from daemon thread
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry=REGISTRY):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # only when endpoint is enabled
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        logger.info("Serving metrics on %s:%d", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsdPusher:
+    """
+    Periodically pushes registry to statsd over UDP. Counters are sent as deltas, gauges and histogram samples as
+    gauges
+    """
+
+    def __init__(self, host: str, port: int, prefix: str="scribscrob", interval: float=DEFAULT_STATSD_INTERVAL,
+                 registry: Registry=REGISTRY):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.interval = interval
+        self.registry = registry
+        self.sent = {}  # counter values pushed last time
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="statsd-pusher", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.push()
+            except OSError as e:
+                logger.warning("Can't push metrics to statsd: %s", e)
+
+    def lines(self):
+        for name, type, _, samples in self.registry.collect():
+            for sample, labels, value in samples:
+                if 'le' in labels:
+                    continue  # buckets make no sense for statsd
+                key = ".".join([self.prefix, sample] + [statsdsafe("{:s}_{}".format(k, v))
+                                                        for k, v in sorted(labels.items())])
+                if type == "counter":
+                    delta = value - self.sent.get(key, 0)
+                    self.sent[key] = value
+                    yield "{:s}:{}|c".format(key, delta)
+                else:
+                    yield "{:s}:{}|g".format(key, value)
+
+    def push(self):
+        for line in self.lines():
+            self.socket.sendto(line.encode(), self.address)
+
+
+def statsdsafe(label: str):
+    """
+    Replaces characters, that delimit parts of statsd line (':', '|', '.', '@') or break it (spaces), with '_'
+    """
+    return STATSD_UNSAFE.sub('_', label)
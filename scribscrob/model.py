@@ -1,3 +1,8 @@
+import re
+import sys
+import unicodedata
+
+
 STOP = "stop"
 PLAY = "play"
 PAUSE = "pause"
@@ -5,38 +10,146 @@ PAUSE = "pause"
 
 class Song:
     """
-    Simple structure over currentsong dict returned by MPDClient
+    Immutable structure over currentsong dict returned by MPDClient.
+    Tag strings are interned, so songs repeated over and over (e.g. by streams) share them
     """
+    __slots__ = ('title', 'artist', 'album', 'file', 'length', '_key')
 
     def __init__(self, song: dict):
         """
         Create instance from dictionary returned by MPDClient
         """
-        # primary
-        self.title = song.get('title')
-        self.artist = song.get('artist')
-        self.album = song.get('album')
-        self.file = song.get('file')
+        file = song.get('file')
+        length = None if file.startswith('http') else int(song['time']) * 1000
+        _init(self, song.get('title'), song.get('artist'), song.get('album'), file, length)
+
+    @property
+    def isstream(self):
+        return self.length is None
+
+    @property
+    def key(self):
+        """
+        Canonical (artist, title) identity of the song. Computed on first use, unless set by Normalizer
+        """
+        try:
+            return self._key
+        except AttributeError:
+            key = canonical(self.artist, self.title)
+            _set_key(self, key)
+            return key
 
-        # derived
-        self.isstream = self.file.startswith('http')
+    def setkey(self, key: tuple):
+        """
+        Sets identity computed (or memoized) elsewhere
+        """
+        _set_key(self, key)
+
+    def withtags(self, artist, title):
+        """
+        returns: copy of the song with artist and title replaced
+        """
+        song = object.__new__(Song)
+        _init(song, title, artist, self.album, self.file, self.length)
+        return song
+
+    def asdict(self):
+        """
+        Dictionary in the form returned by MPDClient, i.e. Song(song.asdict()) is equal to song
+        """
+        song = {'title': self.title, 'artist': self.artist, 'album': self.album, 'file': self.file}
         if not self.isstream:
-            self.length = int(song['time']) * 1000
+            song['time'] = str(self.length // 1000)
+        return song
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Song is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, Song) and (self.title, self.artist, self.album, self.file, self.length) == \
+            (other.title, other.artist, other.album, other.file, other.length)
+
+    def __hash__(self):
+        return hash((self.title, self.artist, self.file))
+
+    def __reduce__(self):
+        return Song, (self.asdict(),)
 
     def __repr__(self):
-        nstr = lambda s: s if s else "<empty>"
         source = "[http]" if self.isstream else "[file]"
         return "{:s} {:s} - {:s}".format(source, nstr(self.artist), nstr(self.title))
 
 
+_set_title = Song.title.__set__
+_set_artist = Song.artist.__set__
+_set_album = Song.album.__set__
+_set_file = Song.file.__set__
+_set_length = Song.length.__set__
+_set_key = Song._key.__set__
+
+
+def _init(song: Song, title, artist, album, file, length):
+    # slot descriptors are used directly, as __setattr__ is disabled
+    _set_title(song, intern(title))
+    _set_artist(song, intern(artist))
+    _set_album(song, intern(album))
+    _set_file(song, file)
+    _set_length(song, length)
+
+
 class Status:
     """
-    Simple structure over status dict returned by MPDClient
+    Immutable structure over status dict returned by MPDClient
     """
+    __slots__ = ('state', 'elapsed')
 
     def __init__(self, status: dict):
-        self.state = status['state']
-        self.elapsed = status['elapsed'] if self.state != STOP else None
+        state = status['state']
+        _set_state(self, state)
+        _set_elapsed(self, status['elapsed'] if state != STOP else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Status is immutable")
+
+    def __reduce__(self):
+        return Status, ({'state': self.state, 'elapsed': self.elapsed},)
 
     def __str__(self):
         return "{:s}({:s})".format(self.state, self.elapsed if self.elapsed else "")
+
+
+_set_state = Status.state.__set__
+_set_elapsed = Status.elapsed.__set__
+
+
+def intern(s):
+    return sys.intern(s) if type(s) is str else s
+
+
+# featured artists: "(feat. X)", "[ft. X]" anywhere, " feat. X" till the end
+FEATURING = re.compile(r"\s*[(\[]\s*(?:feat\.?|ft\.|featuring)\s[^)\]]*[)\]]|\s+(?:feat\.|ft\.|featuring)\s.*$",
+                       re.IGNORECASE)
+ARTICLE = "the "
+
+
+def canonical(artist, title):
+    """
+    Canonical identity of a track. Spellings differing in case, whitespace, unicode form, featured artists or leading
+    "The" of artist give the same identity
+        returns: (artist, title) pair
+    """
+    artist = canonicalname(artist)
+    if type(artist) is str and artist.startswith(ARTICLE) and len(artist) > len(ARTICLE):
+        artist = artist[len(ARTICLE):]
+    return artist, canonicalname(title)
+
+
+def canonicalname(s):
+    if type(s) is not str:
+        return s
+    s = FEATURING.sub("", unicodedata.normalize('NFKC', s))
+    return " ".join(s.casefold().split())
+
+
+def nstr(s):
+    return s if s else "<empty>"
@@ -1,7 +1,21 @@
+import functools
 import logging
+import random
+import time
 from select import select
-from mpd import MPDClient
+from scribscrob.metrics import Histogram, REGISTRY
 from scribscrob.model import Status, Song
+from scribscrob.scheduler import Scheduler
+
+
+STATS_INTERVAL = 100  # events between status latency reports
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 60  # seconds
+# MPD protocol
+HELLO_PREFIX = "OK MPD "
+ERROR_PREFIX = "ACK "
+SUCCESS = "OK"
+NEXT = "list_OK"
 
 
 logger = logging.getLogger('mpd')
@@ -14,11 +28,15 @@ class MpdListener:
 
     def __init__(self, host: str='localhost', port: int=6600, password: str=None):
         # TODO support passwords
+        from mpd import MPDClient
         self.client = MPDClient()
         self.host = host
         self.port = port
         self.password = password
-        pass
+        self.statuslatency = statushistogram(host, port)
+        self.wakeups = wakeupcounter(host, port)
+        self.recorder = None  # TraceRecorder
+        self.songs = SongReuser()
 
     def connect(self):
         """
@@ -27,20 +45,335 @@ class MpdListener:
         self.client.connect(self.host, self.port)
         logger.info("Connected to %s:%d", self.host, self.port)
 
-    def listen(self, event, onevent):
+    def disconnect(self):
+        try:
+            self.client.disconnect()
+        except connectionerrors():
+            pass
+
+    def listen_forever(self, event, onevent, onconnect, ondisconnect, scheduler: Scheduler=None):
         """
-        listens to MPD events and calls onevent callback with current state name and current song
+        Like listen, but keeps connection alive. Reconnects with exponential backoff when connection is lost
+            param: onconnect - called with current state and song every time connection is (re)established
+            param: ondisconnect - called when established connection is lost
+            param: scheduler - timers run between events while connected
         """
+        backoff = Backoff()
         while True:
-            self.client.send_idle()
-            canRead = select([self.client], [], [])[0]
+            try:
+                self.connect()
+                current = self.status()
+            except connectionerrors() as e:
+                self.dropconnection(e)
+                time.sleep(backoff.next())
+                continue
+            backoff.reset()
+            handle(onconnect, *current)
+            try:
+                self.listen(event, onevent, scheduler)
+            except connectionerrors() as e:
+                self.dropconnection(e)
+                handle(ondisconnect)
+            time.sleep(backoff.next())
+
+    def dropconnection(self, e: Exception):
+        logger.warning("Connection to %s:%d failed: %s", self.host, self.port, e)
+        self.disconnect()
+
+    def listen(self, event, onevent, scheduler: Scheduler=None):
+        """
+        listens to MPD events and calls onevent callback with current state name and current song.
+        Waiting for event is cut short by the next deadline of scheduler, expired timers are run after every wakeup
+        """
+        self.client.send_idle()
+        while True:
+            canRead = select([self.client], [], [], scheduler.timeout() if scheduler else None)[0]
+            if scheduler:
+                scheduler.runexpired()
             if canRead:
                 changes = self.client.fetch_idle()
+                self.wakeups.inc()
                 if changes.count(event) > 0:
-                    onevent(*self.status())
+                    current = self.status()
+                    # re-arm idle before handling the event, so changes made meanwhile are not missed
+                    self.client.send_idle()
+                    handle(onevent, *current)
+                else:
+                    self.client.send_idle()
 
     def status(self):
-        status = self.client.status()
-        song = self.client.currentsong()
+        started = time.perf_counter()
+        # both commands go in one write and come back in one read
+        self.client.command_list_ok_begin()
+        self.client.status()
+        self.client.currentsong()
+        status, song = self.client.command_list_end()
+        observe(self.statuslatency, time.perf_counter() - started)
+        logger.debug("Current status %s %s", status['state'], song)
+        if self.recorder:
+            self.recorder.record(status, song)
+        return Status(status), self.songs.get(song)
+
+
+class AsyncMpdListener:
+    """
+    asyncio flavour of MpdListener. Meant to share event loop with other coroutines, e.g. AsyncDispatchingScrobbler.
+    asyncio is imported by methods, so sync mode doesn't pay for it at start up
+    """
+
+    def __init__(self, host: str='localhost', port: int=6600, password: str=None):
+        self.client = AsyncMpdClient()
+        self.host = host
+        self.port = port
+        self.password = password
+        self.statuslatency = statushistogram(host, port)
+        self.wakeups = wakeupcounter(host, port)
+        self.recorder = None  # TraceRecorder
+        self.songs = SongReuser()
+        self.timerhandle = None
+
+    async def connect(self):
+        await self.client.connect(self.host, self.port)
+        logger.info("Connected to %s:%d", self.host, self.port)
+
+    def disconnect(self):
+        self.client.disconnect()
+
+    async def listen_forever(self, event, onevent, onconnect, ondisconnect, scheduler: Scheduler=None):
+        """
+        Like listen, but keeps connection alive. Reconnects with exponential backoff when connection is lost
+            param: onconnect - called with current state and song every time connection is (re)established
+            param: ondisconnect - called when established connection is lost
+            param: scheduler - its timers are run on the event loop
+        """
+        import asyncio
+        if scheduler:
+            scheduler.wakeup = functools.partial(self.armtimers, scheduler)
+            self.armtimers(scheduler)
+        backoff = Backoff()
+        while True:
+            try:
+                await self.connect()
+                current = await self.status()
+            except connectionerrors() as e:
+                self.dropconnection(e)
+                await asyncio.sleep(backoff.next())
+                continue
+            backoff.reset()
+            handle(onconnect, *current)
+            try:
+                await self.listen(event, onevent, scheduler)
+            except connectionerrors() as e:
+                self.dropconnection(e)
+                handle(ondisconnect)
+            await asyncio.sleep(backoff.next())
+
+    def dropconnection(self, e: Exception):
+        logger.warning("Connection to %s:%d failed: %s", self.host, self.port, e)
+        self.disconnect()
+
+    async def listen(self, event, onevent, scheduler: Scheduler=None):
+        """
+        listens to MPD events and calls onevent callback with current state name and current song.
+        MPD queues changes made while status is fetched and reports them on the next idle.
+        Expired timers of scheduler are run after every wakeup, like sync listener does
+        """
+        while True:
+            changes = await self.client.idle(event)
+            if scheduler:
+                self.runtimers(scheduler)
+            self.wakeups.inc()
+            if event in changes:
+                handle(onevent, *await self.status())
+
+    def armtimers(self, scheduler: Scheduler):
+        """
+        Makes event loop wake up at the earliest deadline of scheduler
+        """
+        import asyncio
+        if self.timerhandle:
+            self.timerhandle.cancel()
+        timeout = scheduler.timeout()
+        self.timerhandle = None if timeout is None else \
+            asyncio.get_running_loop().call_later(timeout, self.runtimers, scheduler)
+
+    def runtimers(self, scheduler: Scheduler):
+        self.timerhandle = None
+        scheduler.runexpired()
+        self.armtimers(scheduler)
+
+    async def status(self):
+        started = time.perf_counter()
+        # both commands go in one write and come back in one read
+        status, song = await self.client.commandlist('status', 'currentsong')
+        observe(self.statuslatency, time.perf_counter() - started)
         logger.debug("Current status %s %s", status['state'], song)
-        return Status(status), Song(song) if song else None
\ No newline at end of file
+        if self.recorder:
+            self.recorder.record(status, song)
+        return Status(status), self.songs.get(song)
+
+
+class AsyncMpdClient:
+    """
+    MPD client speaking the protocol over asyncio streams. It implements just what AsyncMpdListener needs: idle and
+    command lists. mpd.asyncio of python-mpd2 2.x can't be used, it passes loop arguments, which asyncio of
+    Python 3.10 doesn't accept, and it sends commands one by one. Errors are ones of python-mpd2, so
+    connectionerrors() applies
+    """
+
+    def __init__(self):
+        from mpd import CommandError, ConnectionError as MPDConnectionError
+        self.connectionerror = MPDConnectionError
+        self.commanderror = CommandError
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host: str, port: int):
+        import asyncio
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        hello = await self.readline()
+        if not hello.startswith(HELLO_PREFIX):
+            self.disconnect()
+            raise self.connectionerror("Connected to something else than MPD: " + hello)
+
+    def disconnect(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def idle(self, *subsystems):
+        """
+            returns: list of changed subsystems
+        """
+        await self.write(" ".join(("idle",) + subsystems))
+        return [value for key, value in await self.readpairs(SUCCESS)]
+
+    async def commandlist(self, *commands):
+        """
+        Sends commands in one write and reads their responses
+            returns: list of response dicts
+        """
+        await self.write("\n".join(('command_list_ok_begin',) + commands + ('command_list_end',)))
+        responses = [parseobject(await self.readpairs(NEXT)) for _ in commands]
+        await self.readpairs(SUCCESS)
+        return responses
+
+    async def write(self, text: str):
+        if not self.writer:
+            raise self.connectionerror("Not connected")
+        self.writer.write(text.encode('utf-8') + b"\n")
+        await self.writer.drain()
+
+    async def readline(self):
+        if not self.reader:
+            raise self.connectionerror("Not connected")
+        line = (await self.reader.readline()).decode('utf-8')
+        if not line.endswith("\n"):
+            self.disconnect()
+            raise self.connectionerror("Connection lost while reading line")
+        line = line[:-1]
+        if line.startswith(ERROR_PREFIX):
+            raise self.commanderror(line[len(ERROR_PREFIX):].strip())
+        return line
+
+    async def readpairs(self, end: str):
+        """
+            returns: list of (key, value) pairs read till end line
+        """
+        pairs = []
+        line = await self.readline()
+        while line != end:
+            key, _, value = line.partition(": ")
+            pairs.append((key, value))
+            line = await self.readline()
+        return pairs
+
+
+def parseobject(pairs: list):
+    """
+    Lower cases keys and collects values of repeated key to list, like python-mpd2 does
+    """
+    obj = {}
+    for key, value in pairs:
+        key = key.lower()
+        if key not in obj:
+            obj[key] = value
+        elif isinstance(obj[key], list):
+            obj[key].append(value)
+        else:
+            obj[key] = [obj[key], value]
+    return obj
+
+
+class SongReuser:
+    """
+    Songs are immutable, so the last one is reused while MPD keeps returning the same currentsong
+    (pause, resume, seek, repeated stream metadata)
+    """
+
+    def __init__(self):
+        self.raw = None
+        self.song = None
+
+    def get(self, raw: dict):
+        if raw != self.raw:
+            self.raw = raw
+            self.song = Song(raw) if raw else None
+        return self.song
+
+
+def handle(callback, *args):
+    """
+    Calls handler of MPD events. Its failure is logged and doesn't stop listening: exceptions of handlers must not be
+    mistaken for lost connection, i.e. OSError of snapshot or cache write
+    """
+    try:
+        callback(*args)
+    except Exception:
+        logger.exception("Handler %s failed", callback)
+
+
+def connectionerrors():
+    """
+    returns: exceptions, that mean connection to MPD is lost. mpd module is imported by listeners on construction
+    """
+    from mpd import ConnectionError as MPDConnectionError
+    return MPDConnectionError, OSError
+
+
+def statushistogram(host, port):
+    return REGISTRY.histogram('scribscrob_mpd_status_seconds', "Time to fetch status and current song from MPD",
+                              mpd="{:s}:{:d}".format(host, port))
+
+
+def wakeupcounter(host, port):
+    return REGISTRY.counter('scribscrob_mpd_idle_wakeups_total', "Idle commands returned by MPD",
+                            mpd="{:s}:{:d}".format(host, port))
+
+
+def observe(histogram: Histogram, latency: float):
+    histogram.observe(latency)
+    if histogram.count % STATS_INTERVAL == 0:
+        logger.info("Status latency %s", histogram)
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter. Delays grow twice per attempt, the actual delay is randomly chosen from the upper
+    half of the current one, so instances restarted together don't reconnect in lockstep
+    """
+
+    def __init__(self, mindelay: float=RECONNECT_MIN_DELAY, maxdelay: float=RECONNECT_MAX_DELAY):
+        self.mindelay = mindelay
+        self.maxdelay = maxdelay
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.maxdelay, self.mindelay * 2 ** self.attempt)
+        if delay < self.maxdelay:
+            self.attempt += 1
+        return random.uniform(delay / 2, delay)
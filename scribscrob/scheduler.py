@@ -0,0 +1,78 @@
+import heapq
+import itertools
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Heap of deadlines (in ms of clock). Not thread safe: timers are scheduled and run by the loop of MPD listener,
+    which asks for timeout to wait for the next deadline and runs expired timers when it wakes up.
+    Cancelled timers stay in heap till they are popped
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None  # called when timer becomes the earliest one, i.e. asyncio loop has to be re-armed
+
+    def schedule(self, deadline: int, callback):
+        """
+            returns: Timer, that can be cancelled
+        """
+        timer = Timer(deadline, next(self.counter), callback)
+        heapq.heappush(self.heap, timer)
+        if self.heap[0] is timer and self.wakeup:
+            self.wakeup()
+        return timer
+
+    def next(self):
+        """
+            returns: the earliest deadline or None if there are no timers
+        """
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0].deadline if self.heap else None
+
+    def timeout(self):
+        """
+            returns: seconds till the earliest deadline or None if there are no timers
+        """
+        deadline = self.next()
+        return None if deadline is None else max(0, deadline - self.clock()) / 1000
+
+    def runexpired(self):
+        """
+            returns: number of timers run
+        """
+        now = self.clock()
+        run = 0
+        while self.heap and self.heap[0].deadline <= now:
+            timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception("Timer %s failed", timer.callback)
+            run += 1
+        return run
+
+
+class Timer:
+    __slots__ = ('deadline', 'seq', 'callback', 'cancelled')
+
+    def __init__(self, deadline: int, seq: int, callback):
+        self.deadline = deadline
+        self.seq = seq  # timers with equal deadlines run in order they were scheduled
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
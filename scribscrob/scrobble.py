@@ -1,97 +1,404 @@
+import hashlib
 import logging
-import json
-import os
-
-import pylast
+import threading
+import time
+from scribscrob.cache import ScrobbleCache
+from scribscrob.dedup import DedupIndex, playkey, identitykey
+from scribscrob.metrics import REGISTRY, RequestMetrics
 from scribscrob.model import Song
 
 
-API_KEY = "key"
+API_KEY = "key"  # used when [last.fm] section doesn't configure api_key
 API_SECRET = "secret"
 
 logger = logging.getLogger(__name__)
 
-TMP_FILE_SUFFIX = ".tmp"
+NOWPLAYING_WINDOW = 5  # seconds. Now playing notifications are sent at most once per window, the latest one wins
+API_RATE = 5  # requests per second, last.fm limit averaged over 5 minutes
+API_BURST = 10  # requests
+CACHE_BATCH_SIZE = 50  # max number of scrobbles last.fm accepts in a single track.scrobble request
+BREAKER_THRESHOLD = 3  # consecutive failures, that open circuit breaker
+BREAKER_RESET = 60  # seconds circuit breaker stays open before trial request is let through
 
 
-class LastfmScrobbler:
+class Scrobbler:
     """
-    Scrobbles to last.fm
+    Base of scrobbling service backends. Handles dedup, local cache, rate limiting, circuit breaking and now playing
+    coalescing, so backends just implement submit, submitmany and sendnowplaying requests.
+    Exceptions listed in errors mean the service is unavailable: play goes to local cache and counts as breaker
+    failure. While breaker is open requests are not sent at all
     """
+    service = None
+    errors = ()
 
-    def __init__(self, username, password: str=None, password_hash: str=None, cachefile: str=None):
+    def __init__(self, username: str, cache: ScrobbleCache=None, nowplayingwindow: float=NOWPLAYING_WINDOW,
+                 bucket: 'TokenBucket'=None, dedup: DedupIndex=None, breaker: 'CircuitBreaker'=None):
         self.username = username
-        self.password_hash = password_hash if password_hash else pylast.md5(password)
-        self.cachefile = cachefile
-        self.network = None
+        self.cache = cache
+        self.dedup = dedup
+        self.bucket = bucket
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.nowplayingwindow = nowplayingwindow
+        self.nowplayinglock = threading.Lock()
+        self.pendingnowplaying = None  # the latest song waiting for the window to end
+        self.lastnowplaying = None  # (time, song) of the last sent now playing
+        self.nowplayingtimer = None
+        self.ondue = self.send_pending_nowplaying  # called when window ends, dispatchers replace it
+        labels = {'service': self.service, 'user': username}
+        self.duplicates = REGISTRY.counter('scribscrob_duplicate_scrobbles_total',
+                                           "Scrobbles skipped as already submitted", **labels)
+        self.supersedednowplaying = REGISTRY.counter('scribscrob_nowplaying_superseded_total',
+                                                     "Now playing notifications dropped in favour of newer ones",
+                                                     **labels)
+        self.scrobblemetrics = RequestMetrics(REGISTRY, 'scrobble', **labels)
+        self.batchmetrics = RequestMetrics(REGISTRY, 'scrobble_batch', **labels)
+        self.nowplayingmetrics = RequestMetrics(REGISTRY, 'nowplaying', **labels)
+        self.flushlatency = REGISTRY.histogram('scribscrob_cache_flush_seconds', "Time to flush local cache", **labels)
+        REGISTRY.gauge('scribscrob_circuit_open', "1 while circuit breaker stops requests to service",
+                       callback=lambda: int(self.breaker.isopen()), **labels)
+        if cache:
+            REGISTRY.gauge('scribscrob_cache_pending_bytes', "Size of not yet scrobbled part of local cache",
+                           callback=cache.pendingbytes, **labels)
 
-    def ensurestarted(self):
-        if not self.network:
-            self.network = pylast.LastFMNetwork(api_key=API_KEY,
-                                                api_secret=API_SECRET,
-                                                username=self.username,
-                                                password_hash=self.password_hash)
+    def submit(self, song: Song, timestamp):
+        raise NotImplementedError()
+
+    def submitmany(self, plays):
+        """
+            param: plays - list of cached play dicts, at most CACHE_BATCH_SIZE long
+        """
+        raise NotImplementedError()
+
+    def sendnowplaying(self, song: Song):
+        raise NotImplementedError()
 
     def scrobble(self, song, timestamp):
         """
-        Scrobbles track. Stores it to local cache if any last.fm related error occurs
+        Scrobbles track. Stores it to local cache if service is unavailable
         """
+        key = identitykey(song.key, timestamp) if self.dedup else None
+        if key and self.dedup.seen(key):
+            logger.warning("Skipping already scrobbled %s", song)
+            self.duplicates.inc()
+            return
+        if not self.breaker.allow():
+            logger.info("%s circuit is open. Saving to local cache %s", self.service, song)
+            self.scrobble_to_cache(song, timestamp)
+            return
         try:
             self._scrobble(song, timestamp)
+            if key:
+                self.dedup.add(key)
             self.flush_cache()
-        except (pylast.WSError, pylast.NetworkError, pylast.MalformedResponseError) as e:
-            logger.error("Can't scrobble. Saving to local cache", e)
-            self.scrobble_to_file(song, timestamp)
+        except self.errors as e:
+            logger.error("Can't scrobble to %s. Saving to local cache: %s", self.service, e)
+            self.scrobble_to_cache(song, timestamp)
+
+    def request(self, metrics: RequestMetrics, call, *args):
+        """
+        Sends request with rate limiting and breaker bookkeeping, errors are passed to caller
+        """
+        if self.bucket:
+            self.bucket.acquire()
+        try:
+            with metrics.measure():
+                call(*args)
+        except BaseException:
+            # unlisted exceptions count too, otherwise failed trial request would keep the breaker half open for good
+            self.breaker.failure()
+            raise
+        self.breaker.success()
 
     def _scrobble(self, song, timestamp):
         """
         Just plain call to API without error handling
         """
-        self.ensurestarted()
-        self.network.scrobble(song.artist, song.title, timestamp)
-        logger.debug("Scrobbled %s", song)
+        self.request(self.scrobblemetrics, self.submit, song, timestamp)
+        logger.debug("Scrobbled %s to %s", song, self.service)
 
     def nowplaying(self, song):
+        """
+        Sends now playing notification. Within nowplayingwindow after the last one only the latest notification is
+        sent, when the window ends. Repeated notification for the same song is dropped
+        """
+        with self.nowplayinglock:
+            now = time.monotonic()
+            if self.lastnowplaying and now < self.lastnowplaying[0] + self.nowplayingwindow:
+                if self.pendingnowplaying or samenowplaying(self.lastnowplaying[1], song):
+                    self.supersedednowplaying.inc()
+                self.pendingnowplaying = None if samenowplaying(self.lastnowplaying[1], song) else song
+                if self.pendingnowplaying and not self.nowplayingtimer:
+                    self.nowplayingtimer = threading.Timer(self.lastnowplaying[0] + self.nowplayingwindow - now,
+                                                           self.windowended)
+                    self.nowplayingtimer.daemon = True
+                    self.nowplayingtimer.start()
+                return
+            self.lastnowplaying = now, song
+            self.pendingnowplaying = None
+        self._nowplaying(song)
+
+    def windowended(self):
+        """
+        Runs in timer thread. Pending notification is sent by ondue, which dispatcher replaces with putting it to its
+        queue, so all requests are sent by dispatcher's worker
+        """
+        with self.nowplayinglock:
+            self.nowplayingtimer = None
+        self.ondue()
+
+    def cancelnowplaying(self):
+        """
+        Drops pending now playing notification, i.e. when dispatcher stops
+        """
+        with self.nowplayinglock:
+            if self.nowplayingtimer:
+                self.nowplayingtimer.cancel()
+            self.nowplayingtimer = None
+            self.pendingnowplaying = None
+
+    def send_pending_nowplaying(self):
+        with self.nowplayinglock:
+            song = self.pendingnowplaying
+            self.pendingnowplaying = None
+            if not song:
+                return
+            self.lastnowplaying = time.monotonic(), song
+        self._nowplaying(song)
+
+    def _nowplaying(self, song):
+        if not self.breaker.allow():
+            logger.debug("%s circuit is open. Dropping now playing %s", self.service, song)
+            return
         try:
-            self.ensurestarted()
-            self.network.update_now_playing(song.artist, song.title)
-            logger.debug("Sent now playing %s", song)
-        except (pylast.WSError, pylast.NetworkError, pylast.MalformedResponseError) as e:
-            logger.error("Can't send now playing notification", e)
-
-    def scrobble_to_file(self, song: Song, start):
-        mode = 'a' if os.path.isfile(self.cachefile) else 'x'
-        with open(self.cachefile, mode=mode) as f:
-            print(song)
-            d = {"song": song,
-                 "start": start}
-            json.dump(d, f, separators=(',', ':'), sort_keys=True)
-            f.write('\n')
+            self.request(self.nowplayingmetrics, self.sendnowplaying, song)
+            logger.debug("Sent now playing %s to %s", song, self.service)
+        except self.errors as e:
+            logger.error("Can't send now playing notification to %s: %s", self.service, e)
 
-    def flush_cache(self):
-        if self.cachefile:
-            with open(self.cachefile, mode='r') as cachefile_handle:
-                scrobbled = self.scrobble_cache_file(cachefile_handle)
-                if scrobbled:
-                    with open(self.get_tmp_cache(), mode="w") as tmp_cache_file_handle:
-                        for line in cachefile_handle:
-                            tmp_cache_file_handle.write(line)
+    def _scrobble_many(self, plays):
+        """
+        Just plain batch call to API without error handling
+            param: plays - list of cached play dicts, at most CACHE_BATCH_SIZE long
+        """
+        self.request(self.batchmetrics, self.submitmany, plays)
+        logger.debug("Scrobbled batch of %d to %s", len(plays), self.service)
 
-            os.rename(self.get_tmp_cache(), self.cachefile)
+    def dedupbatch(self, plays):
+        """
+        Drops plays, that have been submitted already (or repeat within batch)
+            returns: (plays to submit, their keys) pair
+        """
+        unique, keys = [], []
+        for play in plays:
+            key = playkey(play['song']['artist'], play['song']['title'], play['start'])
+            if self.dedup.seen(key) or key in keys:
+                self.duplicates.inc()
+                continue
+            unique.append(play)
+            keys.append(key)
+        return unique, keys
+
+    def scrobble_to_cache(self, song: Song, start):
+        if not self.cache:
+            logger.warning("No local cache configured for %s. Dropping scrobble %s", self.service, song)
+            return
+        self.cache.append({"song": {"artist": song.artist,
+                                    "title": song.title,
+                                    "album": song.album},
+                           "start": start})
 
-    def get_tmp_cache(self):
-        return self.cachefile + TMP_FILE_SUFFIX
+    def flush_cache(self):
+        """
+        Scrobbles cached plays in batches. Every accepted batch is committed to cache right away, together with
+        progress of the replay, so replay interrupted by error or crash resumes after the last accepted batch
+            returns: number of scrobbled plays
+        """
+        if not self.cache or self.cache.isempty() or not self.breaker.ready():
+            return 0
 
-    def scrobble_cache_file(self, fp):
         scrobbled = 0
-        try:
-            for line in fp:
-                d = json.loads(line)
-                song = d['song']
-                start = d['start']
-                self._scrobble(song, start)
-                scrobbled += 1
-        except (pylast.WSError, pylast.NetworkError, pylast.MalformedResponseError) as e:
-            logger.error("Can't scrobble from local cache", e)
+        with self.flushlatency.time():
+            try:
+                self.cache.startreplay()
+                for batch, position in self.cache.batches(CACHE_BATCH_SIZE):
+                    playid = batch[-1].get('id')
+                    keys = []
+                    if self.dedup:
+                        batch, keys = self.dedupbatch(batch)
+                    if batch:
+                        # trial is claimed only for a request that is sent, batches may be all duplicates
+                        if not self.breaker.allow():
+                            logger.info("%s circuit is open. Cache replay is paused", self.service)
+                            return scrobbled
+                        self._scrobble_many(batch)
+                    for key in keys:
+                        self.dedup.add(key)
+                    self.cache.commit(position, playid, len(batch))
+                    scrobbled += len(batch)
+                    logger.info("Scrobbled %d plays from local cache to %s", scrobbled, self.service)
+                self.cache.endreplay()
+            except self.errors as e:
+                logger.error("Can't scrobble from local cache to %s: %s", self.service, e)
         return scrobbled
 
+
+class LastfmScrobbler(Scrobbler):
+    """
+    Scrobbles to last.fm
+    """
+    service = 'last.fm'
+    networkclass = 'LastFMNetwork'  # pylast is imported on first request, it takes most of start up time
+
+    def __init__(self, username, password: str=None, password_hash: str=None,
+                 cache: ScrobbleCache=None, nowplayingwindow: float=NOWPLAYING_WINDOW,
+                 bucket: 'TokenBucket'=None, dedup: DedupIndex=None, breaker: 'CircuitBreaker'=None,
+                 apikey: str=API_KEY, apisecret: str=API_SECRET):
+        super().__init__(username, cache=cache, nowplayingwindow=nowplayingwindow,
+                         bucket=bucket if bucket else TokenBucket(API_RATE, API_BURST), dedup=dedup, breaker=breaker)
+        self.password_hash = password_hash if password_hash else hashlib.md5(password.encode('utf-8')).hexdigest()
+        self.apikey = apikey
+        self.apisecret = apisecret
+        self.network = None
+
+    @property
+    def errors(self):
+        return lastfmerrors()
+
+    def ensurestarted(self):
+        if not self.network:
+            import pylast
+            self.network = getattr(pylast, self.networkclass)(api_key=self.apikey,
+                                                              api_secret=self.apisecret,
+                                                              username=self.username,
+                                                              password_hash=self.password_hash)
+
+    def submit(self, song, timestamp):
+        self.ensurestarted()
+        self.network.scrobble(song.artist, song.title, timestamp)
+
+    def submitmany(self, plays):
+        self.ensurestarted()
+        tracks = [{'artist': d['song']['artist'],
+                   'title': d['song']['title'],
+                   'album': d['song'].get('album'),
+                   'timestamp': d['start']} for d in plays]
+        self.network.scrobble_many(tracks)
+
+    def sendnowplaying(self, song):
+        self.ensurestarted()
+        self.network.update_now_playing(song.artist, song.title)
+
+
+class LibrefmScrobbler(LastfmScrobbler):
+    """
+    Scrobbles to libre.fm, which implements last.fm API
+    """
+    service = 'libre.fm'
+    networkclass = 'LibreFMNetwork'
+
+
+def lastfmerrors():
+    """
+    returns: pylast exceptions, that mean last.fm is unavailable
+    """
+    import pylast
+    return pylast.WSError, pylast.NetworkError, pylast.MalformedResponseError
+
+
+def samenowplaying(song: Song, other: Song):
+    return song.key == other.key
+
+
+class TokenBucket:
+    """
+    Rate limiter. Holds up to capacity tokens, which are refilled at rate per second. Every request takes a token
+    """
+
+    def __init__(self, rate: float, capacity: int, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def tryacquire(self):
+        """
+        returns: 0 if token was taken or seconds to wait for the next token
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Takes token, waits for it if needed
+        """
+        wait = self.tryacquire()
+        while wait:
+            self.sleep(wait)
+            wait = self.tryacquire()
+
+
+class CircuitBreaker:
+    """
+    Stops requests to service after threshold consecutive failures. After resettimeout one trial request is let
+    through: its success closes the breaker, its failure keeps it open for another resettimeout
+    """
+
+    def __init__(self, threshold: int=BREAKER_THRESHOLD, resettimeout: float=BREAKER_RESET, clock=time.monotonic):
+        self.threshold = threshold
+        self.resettimeout = resettimeout
+        self.clock = clock
+        self.failures = 0
+        self.openeduntil = None  # None while closed
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def isopen(self):
+        return self.openeduntil is not None
+
+    def ready(self):
+        """
+        returns: True if allow() would let request through, trial request is not claimed
+        """
+        with self.lock:
+            return self.openeduntil is None or not self.trial and self.clock() >= self.openeduntil
+
+    def allow(self):
+        """
+        returns: True if request may be sent
+        """
+        with self.lock:
+            if self.openeduntil is None:
+                return True
+            if self.trial or self.clock() < self.openeduntil:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.openeduntil is not None:
+                logger.info("Circuit closed after successful trial request")
+            self.failures = 0
+            self.openeduntil = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.openeduntil is None:
+                    logger.warning("Circuit opened after %d failures", self.failures)
+                self.openeduntil = self.clock() + self.resettimeout
+                self.trial = False
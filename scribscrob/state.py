@@ -1,7 +1,11 @@
+import json
 import logging
+import os
 import time
+from scribscrob.metrics import REGISTRY
 from scribscrob.model import Status, STOP, Song, PLAY, PAUSE
-from scribscrob.scrobble import LastfmScrobbler
+from scribscrob.scheduler import Scheduler
+from scribscrob.scrobble import Scrobbler
 from scribscrob.transform import SongTransformer
 
 
@@ -9,9 +13,18 @@ NEW_SONG_THRESHOLD = 1000  # ms
 MAX_SCROBBLING_THRESHOLD = 4 * 60 * 1000  # 4 mins as required by last.fm documentation
 MIN_SCROBBLING_THRESHOLD = 15 * 1000  # shortest track is 30 sec. This is equivalent to 15 seconds of listening
 MIN_SCROBBLING_LENGTH = 30 * 1000  # shortest track is 30 sec.
+STREAM_DEBOUNCE = 3000  # ms new stream title has to hold before it starts a play
+SNAPSHOT_VERSION = 1
+TMP_FILE_SUFFIX = ".tmp"
 
 logger = logging.getLogger(__name__)
 
+TRANSFORM_SECONDS = REGISTRY.histogram('scribscrob_transform_seconds', "Time spent in song transformer")
+STREAM_UPDATES_SKIPPED = REGISTRY.counter('scribscrob_stream_updates_skipped_total',
+                                          "Stream updates, that didn't change artist and title")
+STREAM_TITLES_DEBOUNCED = REGISTRY.counter('scribscrob_stream_titles_debounced_total',
+                                           "Stream titles replaced before they started a play")
+
 
 class ScrobblingMachine:
     """
@@ -22,24 +35,46 @@ class ScrobblingMachine:
     song = None
     elapsed = 0
     start = -1
+    scrobbled = False  # current play has been committed already
+    scrobbletimer = None
+    pendingstream = None  # (song, since, timer) of new stream title waiting for debounce
 
     def __init__(self, initialstatus: Status=Status({'state': STOP}), initialsong: Song=None,
-                 transformer: SongTransformer=SongTransformer(),
-                 scrobbler: LastfmScrobbler=None):
-        self.transformer = transformer
+                 transformer: SongTransformer=None,
+                 scrobbler: Scrobbler=None, snapshots: 'SnapshotStore'=None, scheduler: Scheduler=None,
+                 streamdebounce: int=STREAM_DEBOUNCE):
+        self.transformer = transformer if transformer else SongTransformer()
         self.scrobbler = scrobbler
+        self.streamdebounce = streamdebounce
+        self.scheduler = scheduler if scheduler else Scheduler(lambda: current_time_millis())
+        self.snapshots = None
+        snapshot = snapshots.load() if snapshots else None
         self.onevent(initialstatus, initialsong)
+        if snapshot:
+            self.restore(snapshot)
+        self.snapshots = snapshots
 
     def onevent(self, status: Status, song: Song):
         logger.debug("Handling event %s song: %s", status, song)
+        self.handle(status, song)
+        self.armscrobble()
+        self.save_snapshot()
+
+    def handle(self, status: Status, song: Song):
         state = status.state
 
         if state == STOP:
+            self.cancelstream()
             self.stop()
         else:
-            song = self.transformer.transform(song)
+            with TRANSFORM_SECONDS.time():
+                song = self.transformer.transform(song)
             elapsed = int(float(status.elapsed) * 1000)
-            if state == PLAY and (song.isstream or elapsed <= NEW_SONG_THRESHOLD):
+            if state == PLAY and song.isstream:
+                self.playstream(song)
+                return
+            self.cancelstream()
+            if state == PLAY and elapsed <= NEW_SONG_THRESHOLD:
                 self.play(song)
             elif state == PLAY and elapsed > NEW_SONG_THRESHOLD:
                 self.play_continue(song, elapsed)
@@ -64,15 +99,17 @@ class ScrobblingMachine:
             self.elapsed += self.state.duration()
             self.state = State(PAUSE)
 
-    def play(self, song):
+    def play(self, song, since: int=None):
         """
         Handle play from beginning
             param: song - played song
+            param: since - time play started at, now by default
         """
+        now = current_time_millis() if since is None else since
         # if we had been playing something
         if self.state and self.state.isplay():
             # count this time as played
-            self.elapsed += self.state.duration()
+            self.elapsed += now - self.state.start
 
         # ... or been on pause
         if self.state and (self.state.isplay() or self.state.ispause()):
@@ -82,10 +119,60 @@ class ScrobblingMachine:
         # ... or been stopped
         self.song = song
         self.elapsed = 0
-        self.start = current_time_millis()
-        self.state = State(PLAY)
+        self.scrobbled = False
+        self.start = now
+        self.state = State(PLAY, now)
         self.nowplaying_if_needed()
 
+    def playstream(self, song):
+        """
+        Handle play of stream. Every tag update of stream comes as player event: updates, that don't change normalized
+        artist and title, are skipped, and new title starts a play only after it holds for streamdebounce, so
+        flapping titles don't cost plays and now playing notifications
+            param: song - played stream
+        """
+        current = self.song
+        samestream = self.state and not self.state.isstop() and current is not None and current.isstream and \
+            current.file == song.file
+        if samestream and current.key == song.key:
+            if self.pendingstream:
+                # title flapped back before new one settled
+                STREAM_TITLES_DEBOUNCED.inc()
+                self.cancelstream()
+            if self.state.ispause():
+                self.play_continue(song, 0)
+            else:
+                STREAM_UPDATES_SKIPPED.inc()
+            return
+        if samestream and self.state.isplay() and self.streamdebounce:
+            if self.pendingstream:
+                if self.pendingstream[0].key == song.key:
+                    STREAM_UPDATES_SKIPPED.inc()
+                    return
+                STREAM_TITLES_DEBOUNCED.inc()
+                self.cancelstream()
+            now = current_time_millis()
+            timer = self.scheduler.schedule(now + self.streamdebounce, self.onstreamsettled)
+            self.pendingstream = song, now, timer
+            return
+        self.cancelstream()
+        self.play(song)
+
+    def onstreamsettled(self):
+        """
+        New stream title has held for streamdebounce. Its play is counted since the title appeared
+        """
+        song, since, _ = self.pendingstream
+        self.pendingstream = None
+        self.play(song, since)
+        self.armscrobble()
+        self.save_snapshot()
+
+    def cancelstream(self):
+        if self.pendingstream:
+            self.pendingstream[2].cancel()
+            self.pendingstream = None
+
     def play_continue(self, song, elapsed):
         """
         Handle play after pause/seek
@@ -101,6 +188,7 @@ class ScrobblingMachine:
 
         # If we've been on pause before
         if self.state.ispause():
+            self.state = State(PLAY)
             # send now playing if previous have been timed out
             self.nowplaying_if_needed()
 
@@ -112,13 +200,119 @@ class ScrobblingMachine:
         self.scrobble_if_needed()
         self.song = None
         self.elapsed = 0
+        self.scrobbled = False
         self.state = State(STOP)
 
-    def scrobble_if_needed(self):
+    def disconnected(self):
+        """
+        Handle lost connection to MPD. Nothing is known about time till reconnection, so it is counted as pause
+        """
+        self.cancelstream()
+        if self.state and self.state.isplay():
+            self.elapsed += self.state.duration()
+            self.state = State(PAUSE)
+        self.armscrobble()
+        self.save_snapshot()
+
+    def resync(self, status: Status, song: Song):
+        """
+        Handle fresh status after connection to MPD is (re)established
+        """
+        if status.state != STOP:
+            song = self.transformer.transform(song)
+            elapsed = int(float(status.elapsed) * 1000)
+            restarted = not song.isstream and elapsed <= NEW_SONG_THRESHOLD
+            if self.state and not self.state.isstop() and samesong(self.song, song) and not restarted:
+                # same play goes on
+                if status.state == PLAY and not self.state.isplay():
+                    self.state = State(PLAY)
+                    self.nowplaying_if_needed()
+                elif status.state == PAUSE and self.state.isplay():
+                    self.pause(song, elapsed)
+                self.armscrobble()
+                self.save_snapshot()
+                return
+
+        # something else is going on now. Finish what we had and start over as if we connected in the middle
+        self.cancelstream()
+        if self.state and self.state.isplay() and self.song:
+            # song has been played till the end at most
+            self.elapsed += self.state.duration()
+            if not self.song.isstream:
+                self.elapsed = min(self.elapsed, self.song.length)
+        self.scrobble_if_needed()
+        self.song = None
+        self.elapsed = 0
+        self.scrobbled = False
+        self.state = None
+        self.onevent(status, song)
+
+    def snapshot(self):
+        """
+        returns: JSON serializable state of the machine
+        """
+        return {'version': SNAPSHOT_VERSION,
+                'saved': current_time_millis(),
+                'song': self.song.asdict() if self.song else None,
+                'elapsed': self.elapsed,
+                'start': self.start,
+                'scrobbled': self.scrobbled,
+                'state': self.state.name if self.state else None,
+                'statestart': self.state.start if self.state else None}
+
+    def restore(self, snapshot: dict):
+        """
+        Restores state from snapshot. MPD goes on playing while we are restarted, so restored play is still counted as
+        play. Resync with current status should follow
+        """
+        if snapshot.get('version') != SNAPSHOT_VERSION or not snapshot['state']:
+            return
+        self.song = Song(snapshot['song']) if snapshot['song'] else None
+        self.elapsed = snapshot['elapsed']
+        self.start = snapshot['start']
+        self.scrobbled = snapshot.get('scrobbled', False)
+        self.state = State(snapshot['state'], snapshot['statestart'])
+        logger.info("Restored %s %s", self.state, self.song)
+        self.armscrobble()
+
+    def save_snapshot(self):
+        if self.snapshots:
+            self.snapshots.save(self.snapshot())
+
+    def scrobble_if_needed(self, elapsed: int=None):
+        """
+            param: elapsed - played time, accumulated elapsed by default
+        """
         song = self.song
+        elapsed = self.elapsed if elapsed is None else elapsed
         logger.debug("Asked to scrobble %s", song)
-        if song and eligibleforscrobbling(song) and (self.elapsed > scrobblethreshold(song)):
+        if song and not self.scrobbled and eligibleforscrobbling(song) and (elapsed > scrobblethreshold(song)):
             self.scrobbler.scrobble(song, int(self.start / 1000))
+            self.scrobbled = True
+
+    def armscrobble(self):
+        """
+        Schedules commit of current play for the moment it crosses scrobbling threshold, so it is not postponed till
+        the next event (which may never come for a stream)
+        """
+        if self.scrobbletimer:
+            self.scrobbletimer.cancel()
+            self.scrobbletimer = None
+        song = self.song
+        if self.state and self.state.isplay() and song and not self.scrobbled and eligibleforscrobbling(song):
+            remaining = scrobblethreshold(song) - self.elapsed - self.state.duration()
+            self.scrobbletimer = self.scheduler.schedule(current_time_millis() + max(0, int(remaining)) + 1,
+                                                         self.onthreshold)
+
+    def onthreshold(self):
+        """
+        Commits current play. Transition, that finishes the play later, doesn't scrobble it again
+        """
+        self.scrobbletimer = None
+        if self.state and self.state.isplay():
+            self.scrobble_if_needed(self.elapsed + self.state.duration())
+            self.armscrobble()
+            self.save_snapshot()
 
     def nowplaying_if_needed(self):
         song = self.song
@@ -137,6 +331,17 @@ def scrobblethreshold(song: Song):
         return min(threshold, MAX_SCROBBLING_THRESHOLD)
 
 
+def samesong(song: Song, other: Song):
+    """
+    Stream titles are compared by normalized artist and title, as playstream does
+    """
+    if song is None or other is None:
+        return False
+    if song.isstream:
+        return song.file == other.file and song.key == other.key
+    return (song.artist, song.title, song.file) == (other.artist, other.title, other.file)
+
+
 def eligibleforscrobbling(song: Song):
     return song.artist and song.title and (song.isstream or song.length > MIN_SCROBBLING_LENGTH)
 
@@ -168,4 +373,52 @@ class State:
 
 
 def current_time_millis():
-    return int(round(time.time() * 1000))
\ No newline at end of file
+    return int(round(time.time() * 1000))
+
+
+def reloadtransformer(machines: list, build):
+    """
+    Hot reload: swaps transformer of machines for freshly built one. Assignment is atomic, so an event is transformed
+    either by old or by new transformer, and machines keep their state. Old transformer stays if build fails
+        param: build - returns new transformer
+        returns: new transformer or None if build failed
+    """
+    try:
+        transformer = build()
+    except Exception:
+        logger.exception("Can't reload transformer, keeping the old one")
+        return None
+    for machine in machines:
+        machine.transformer = transformer
+    logger.info("Reloaded transformer of %d machines", len(machines))
+    return transformer
+
+
+class SnapshotStore:
+    """
+    Keeps ScrobblingMachine snapshot in a small file. File is replaced atomically, so it is either old or new snapshot
+    after a crash
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last = None
+
+    def load(self):
+        try:
+            with open(self.path, mode='r') as f:
+                self.last = json.load(f)
+                return self.last
+        except (FileNotFoundError, ValueError) as e:
+            logger.warning("Can't load snapshot %s: %s", self.path, e)
+            return None
+
+    def save(self, snapshot: dict):
+        # skip writes, if nothing but snapshot time has changed
+        if self.last and all(snapshot[k] == self.last.get(k) for k in snapshot if k != 'saved'):
+            return
+        tmp = self.path + TMP_FILE_SUFFIX
+        with open(tmp, mode='w') as f:
+            json.dump(snapshot, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp, self.path)
+        self.last = snapshot
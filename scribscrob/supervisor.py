@@ -0,0 +1,385 @@
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from scribscrob.configcache import CompiledConfig
+from scribscrob.mpdlistener import Backoff
+
+
+REPLICAS = 100  # points of each shard on the ring
+REPORT_INTERVAL = 5  # seconds between load reports of a worker
+RESPAWN_MIN_DELAY = 1  # seconds
+RESPAWN_MAX_DELAY = 60  # seconds
+# commands sent to worker over its pipe
+ADD = 'add'
+REMOVE = 'remove'
+# messages sent by worker
+LOAD = 'load'
+REMOVED = 'removed'  # instances of REMOVE are stopped and their scrobbler is drained
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hashing: every node owns arcs of the ring in front of its points, so adding or removing a node moves
+    only keys of arcs, that the node gains or loses
+    """
+
+    def __init__(self, nodes=(), replicas: int=REPLICAS):
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.owners = {}  # {hash: node}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key: str):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self.hash("{}#{:d}".format(node, i))
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            point = self.hash("{}#{:d}".format(node, i))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                del self.points[bisect.bisect_left(self.points, point)]
+
+    def node(self, key: str):
+        """
+            returns: node owning key or None if ring is empty
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[self.points[i]]
+
+
+class Worker:
+    """
+    Supervisor's view of worker process
+    """
+
+    def __init__(self, shard: int, process, conn):
+        self.shard = shard
+        self.process = process
+        self.conn = conn  # supervisor's end of the pipe
+        self.started = time.time()
+        self.report = {}  # the last load report
+
+
+class Supervisor:
+    """
+    Shards [mpd:<instance>] sections across worker processes, each serving its shard from own event loop (so tag
+    guessing, cache I/O and HTTP requests of different shards don't share GIL). Instances are assigned by consistent
+    hashing of their account: state of an account (cache, dedup index, rate limit) must have one owner, so instances
+    of one account always land on the same worker. When a worker dies, its accounts move to the surviving workers
+    and move back once it is respawned; the instance state moves with snapshot files. Account, that leaves a running
+    worker, is sent to the new one only after the old one confirms, that it has stopped serving it.
+    Load of shards is reported as JSON by control unix socket.
+    """
+
+    def __init__(self, factory, workers: int, controlpath: str=None, interval: float=REPORT_INTERVAL,
+                 reload: bool=True):
+        """
+            param: factory - ScribScrobFactory of whole configuration, workers rebuild it from config sections
+            param: reload - whether workers re-read configuration and swap transformer on SIGHUP
+        """
+        import multiprocessing
+        self.context = multiprocessing.get_context('spawn')
+        self.sections = {s: dict(factory.config.items(s, raw=True)) for s in factory.config.sections()}
+        self.accounts = {}  # {account section: [instance names]}
+        for name, instance in factory.instances():
+            self.accounts.setdefault(instance.lastfmsection, []).append(name)
+        self.size = workers
+        self.controlpath = controlpath
+        self.interval = interval
+        self.reload = reload
+        self.records = self.context.Queue()  # log records of workers, drained by LogPipeline of supervisor
+        self.ring = HashRing()
+        self.owners = {}  # {account section: shard}
+        self.leaving = {}  # {account section: shard told to remove its instances, which hasn't confirmed it yet}
+        self.workers = {}  # {shard: Worker} of running workers
+        self.restarts = {shard: 0 for shard in range(workers)}
+        self.backoffs = {shard: Backoff(RESPAWN_MIN_DELAY, RESPAWN_MAX_DELAY) for shard in range(workers)}
+        self.respawns = {}  # {shard: monotonic time to respawn dead worker at}
+        self.lock = threading.Lock()  # guards workers against status reads of control thread
+        self.control = None
+        self.stopped = False
+
+    def spawn(self, shard: int):
+        """
+        Starts worker and puts it on the ring. It gets its instances once the ring is rebalanced
+        """
+        conn, child = self.context.Pipe()
+        process = self.context.Process(target=work, name="scribscrob-shard-{:d}".format(shard), daemon=True,
+                                       args=(shard, self.sections, child, self.records, self.interval, self.reload))
+        process.start()
+        child.close()
+        with self.lock:
+            self.workers[shard] = Worker(shard, process, conn)
+        self.ring.add(shard)
+        logger.info("Started worker %d, pid %d", shard, process.pid)
+
+    def died(self, shard: int):
+        with self.lock:
+            worker = self.workers.pop(shard)
+        worker.process.join()
+        worker.conn.close()
+        self.ring.remove(shard)
+        self.left(shard, [account for account, leaving in self.leaving.items() if leaving == shard])
+        self.restarts[shard] += 1
+        delay = self.backoffs[shard].next()
+        self.respawns[shard] = time.monotonic() + delay
+        logger.error("Worker %d died with exit code %s, respawning in %.1fs", shard, worker.process.exitcode, delay)
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Sends instances of accounts, that changed owner, to the new owner. The previous owner, if still running,
+        stops them first: the new owner gets them when it confirms, so cache of account is never served twice
+        """
+        for account, names in self.accounts.items():
+            shard = self.ring.node(account)
+            previous = self.owners.get(account)
+            if shard == previous:
+                continue
+            self.owners[account] = shard
+            if account in self.leaving:
+                continue  # the current owner gets it, when the leaving one confirms
+            if previous in self.workers:
+                self.send(previous, REMOVE, names)
+                self.leaving[account] = previous
+                logger.info("Account %s is leaving worker %d", account, previous)
+            else:
+                self.assign(account, previous)
+
+    def left(self, shard: int, accounts: list):
+        """
+        Sends accounts, that shard has stopped serving or died with, to their current owners
+        """
+        for account in accounts:
+            if self.leaving.get(account) == shard:
+                del self.leaving[account]
+                self.assign(account, shard)
+
+    def assign(self, account: str, previous: int):
+        shard = self.owners.get(account)
+        if shard in self.workers:
+            self.send(shard, ADD, self.accounts[account])
+            logger.info("Account %s moved from worker %s to %d", account, previous, shard)
+
+    def send(self, shard: int, command: str, names: list):
+        try:
+            self.workers[shard].conn.send((command, names))
+        except OSError as e:
+            # worker is dying, its sentinel becomes ready soon
+            logger.warning("Can't send %s to worker %d: %s", command, shard, e)
+
+    def status(self):
+        """
+            returns: {shard: load} of all shards. Load of a running worker is its last report
+        """
+        with self.lock:
+            workers = dict(self.workers)
+        shards = {}
+        for shard in range(self.size):
+            worker = workers.get(shard)
+            load = {'alive': worker is not None, 'restarts': self.restarts[shard],
+                    'accounts': sorted(a for a, s in self.owners.items() if s == shard)}
+            if worker:
+                load.update(worker.report, pid=worker.process.pid, uptime=round(time.time() - worker.started, 1))
+            shards[str(shard)] = load
+        return shards
+
+    def poll(self, timeout: float=None):
+        """
+        Waits for load reports and deaths of workers
+        """
+        from multiprocessing.connection import wait
+        bypipe = {w.conn: w for w in self.workers.values()}
+        bysentinel = {w.process.sentinel: w for w in self.workers.values()}
+        for ready in wait(list(bypipe) + list(bysentinel), timeout):
+            if ready in bysentinel:
+                if bysentinel[ready].shard in self.workers:
+                    self.died(bysentinel[ready].shard)
+                continue
+            worker = bypipe[ready]
+            try:
+                message, content = worker.conn.recv()
+            except (EOFError, OSError):
+                continue  # death is handled by sentinel
+            if message == LOAD:
+                worker.report = content
+                self.backoffs[worker.shard].reset()
+            elif message == REMOVED:
+                self.left(worker.shard, [account for account, names in self.accounts.items() if names == content])
+
+    def run(self):
+        """
+        Serves all shards till stopped, respawning dead workers
+        """
+        if self.reload:
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.signal(signal.SIGHUP))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.controlpath:
+            self.control = ControlServer(self.controlpath, self.status)
+            self.control.start()
+        try:
+            for shard in range(self.size):
+                self.spawn(shard)
+            self.rebalance()
+            while not self.stopped:
+                now = time.monotonic()
+                for shard, at in list(self.respawns.items()):
+                    if at <= now:
+                        del self.respawns[shard]
+                        self.spawn(shard)
+                        self.rebalance()
+                timeout = max(0, min(self.respawns.values()) - now) if self.respawns else None
+                self.poll(timeout)
+        finally:
+            self.stop()
+
+    def signal(self, signum):
+        """
+        Forwards signal to workers
+        """
+        for worker in list(self.workers.values()):
+            os.kill(worker.process.pid, signum)
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            workers, self.workers = list(self.workers.values()), {}
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
+            worker.conn.close()
+        if self.control:
+            self.control.stop()
+            self.control = None
+
+
+class ControlServer:
+    """
+    Unix socket, that writes JSON status of shards to every client and closes connection
+    """
+
+    def __init__(self, path: str, status):
+        import socketserver  # only in supervisor mode
+        status_ = status
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(json.dumps(status_(), sort_keys=True).encode() + b"\n")
+
+        if os.path.exists(path):
+            os.unlink(path)  # left by killed supervisor
+        self.path = path
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="control-server", daemon=True)
+        self.thread.start()
+        logger.info("Serving control socket on %s", self.path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.path)
+
+
+def work(shard: int, sections: dict, conn, records, interval: float, reload: bool):
+    """
+    Entry point of worker process. Factory is imported by module name: multiprocessing doesn't re-import __main__
+    of package run by python -m, so its classes can't be pickled
+    """
+    from scribscrob.__main__ import ScribScrobFactory, reloadedtransformer
+    root = ScribScrobFactory(CompiledConfig("", sections).parser())
+    root.get_logging().forward(records)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    import asyncio
+    asyncio.run(serveshard(shard, root, conn, interval, reloadedtransformer if reload else None))
+
+
+async def serveshard(shard: int, root, conn, interval: float, reload):
+    """
+    Serves instances sent by supervisor, reporting load of the shard every interval seconds, till supervisor is gone
+    """
+    import asyncio
+    from scribscrob.daemon import Daemon
+    loop = asyncio.get_running_loop()
+    factories = dict(root.instances())
+    daemon = Daemon(root.get_transformer())
+    if reload:
+        loop.add_signal_handler(signal.SIGHUP, daemon.reload, reload)
+    gone = loop.create_future()
+
+    async def remove(names):
+        await asyncio.gather(*(daemon.remove(name) for name in names))
+        try:
+            conn.send((REMOVED, names))
+        except OSError as e:
+            logger.warning("Worker %d: can't confirm removal of %s: %s", shard, ", ".join(names), e)
+
+    def oncommand():
+        try:
+            command, names = conn.recv()
+        except EOFError:
+            loop.remove_reader(conn.fileno())
+            gone.set_result(None)
+            return
+        if command == ADD:
+            for name in names:
+                daemon.add(name, factories[name])
+        elif command == REMOVE:
+            asyncio.ensure_future(remove(names))
+        logger.info("Worker %d: %s %s", shard, command, ", ".join(names))
+
+    loop.add_reader(conn.fileno(), oncommand)
+    while not gone.done():
+        events = daemon.load()
+        conn.send((LOAD, {'instances': sorted(daemon.tasks), 'events': sum(events.values()),
+                          'instance_events': events, 'cpu_seconds': round(time.process_time(), 3)}))
+        await asyncio.wait([gone], timeout=interval)
+    logger.info("Worker %d: supervisor is gone", shard)
+
+
+def query(path: str):
+    """
+        returns: status of shards read from control socket
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.supervisor",
+                                     description="Reports load of shards of running supervisor")
+    parser.add_argument('control', help="control socket, [supervisor] control in config")
+    args = parser.parse_args(argv)
+    for shard, load in sorted(query(args.control).items(), key=lambda item: int(item[0])):
+        print(json.dumps(dict(load, shard=int(shard)), sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
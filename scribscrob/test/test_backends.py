@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from scribscrob.backends import ListenBrainzScrobbler, LocalLogScrobbler
+from scribscrob.cache import ScrobbleCache
+from scribscrob.scrobble import CircuitBreaker
+from scribscrob.test.test_scrobble import song
+
+
+class StandInServer(HTTPServer):
+    """
+    Local stand-in for scrobbling service HTTP API. Records requests and answers with status
+    """
+
+    def __init__(self):
+        super().__init__(('localhost', 0), StandInHandler)
+        self.requests = []
+        self.status = 200
+        self.truncated = False  # response body is shorter than its Content-Length
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://localhost:{:d}".format(self.server_address[1])
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.headers['Authorization'], json.loads(body.decode())))
+        self.send_response(self.server.status)
+        body = b'{"status": "ok"}'
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body) + 10 if self.server.truncated else len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestListenBrainzScrobbler(TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.addCleanup(self.server.close)
+        self.cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        self.scrobbler = ListenBrainzScrobbler("user", "token", url=self.server.url,
+                                               cache=ScrobbleCache(self.cachedir), breaker=CircuitBreaker(threshold=2))
+
+    def test_scrobble(self):
+        self.scrobbler.nowplaying(song(0))
+        self.scrobbler.scrobble(song(0), 10)
+        self.assertListEqual([("/1/submit-listens", "Token token",
+                               {'listen_type': 'playing_now',
+                                'payload': [{'track_metadata': {'artist_name': "Artist", 'track_name': "Track 0"}}]}),
+                              ("/1/submit-listens", "Token token",
+                               {'listen_type': 'single',
+                                'payload': [{'track_metadata': {'artist_name': "Artist", 'track_name': "Track 0"},
+                                             'listened_at': 10}]})],
+                             self.server.requests)
+
+    def test_unavailable(self):
+        self.server.status = 503
+        for n in range(3):
+            self.scrobbler.scrobble(song(n), n)
+        # breaker opens after two failures, the third play goes to cache without request
+        self.assertEqual(2, len(self.server.requests))
+        self.assertTrue(self.scrobbler.breaker.isopen())
+
+        self.server.status = 200
+        self.scrobbler.breaker.openeduntil = 0
+        self.scrobbler.scrobble(song(3), 3)
+        imported = [r[2] for r in self.server.requests[3:]]
+        self.assertListEqual(['import'], [r['listen_type'] for r in imported])
+        self.assertListEqual([0, 1, 2], [listen['listened_at'] for listen in imported[0]['payload']])
+        self.assertTrue(ScrobbleCache(self.cachedir).isempty())
+
+    def test_truncated_response(self):
+        self.server.truncated = True
+        self.scrobbler.scrobble(song(0), 0)
+        self.assertListEqual([0], [d['start'] for d, _ in ScrobbleCache(self.cachedir).plays()])
+        self.assertEqual(1, self.scrobbler.breaker.failures)
+
+
+class TestLocalLogScrobbler(TestCase):
+    def test_scrobble(self):
+        logdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logdir)
+        path = os.path.join(logdir, "scrobbles.log")
+        scrobbler = LocalLogScrobbler(path)
+        scrobbler.nowplaying(song(0))
+        scrobbler.scrobble(song(0), 10)
+        with open(path) as f:
+            self.assertListEqual([{'artist': "Artist", 'title': "Track 0", 'album': None, 'timestamp': 10}],
+                                 [json.loads(line) for line in f])
@@ -0,0 +1,17 @@
+from unittest import TestCase
+from scribscrob.bench import coldstart, normalize
+
+
+class TestColdStart(TestCase):
+    def test_no_heavy_modules(self):
+        # timing depends on the machine, budget is for reports of python -m scribscrob.bench only
+        report = coldstart(runs=1)
+        self.assertListEqual([], report['heavy_modules'])
+
+
+class TestNormalize(TestCase):
+    def test_spellings_collapse(self):
+        report = normalize(n=2000, distinct=50)
+        self.assertGreater(report['spellings'], report['identities'])
+        self.assertLessEqual(report['identities'], 50)
+        self.assertGreater(report['memo_hit_rate'], 0)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from scribscrob.cache import ScrobbleCache, status
+
+
+class TestScrobbleCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.directory) if n.endswith(".log"))
+
+    def test_append_commit_reopen(self):
+        cache = ScrobbleCache(self.directory, segmentsize=64)
+        self.assertTrue(cache.isempty())
+        for n in range(10):
+            cache.append({'start': n})
+        self.assertFalse(cache.isempty())
+        self.assertGreater(len(self.segments()), 1)
+
+        batch, position = next(cache.batches(4))
+        self.assertListEqual([0, 1, 2, 3], [d['start'] for d in batch])
+        cache.commit(position)
+
+        reopened = ScrobbleCache(self.directory, segmentsize=64)
+        self.assertListEqual(list(range(4, 10)), [d['start'] for d, _ in reopened.plays()])
+
+    def test_compaction(self):
+        cache = ScrobbleCache(self.directory, segmentsize=64)
+        for n in range(10):
+            cache.append({'start': n})
+        segments = self.segments()
+        *_, (_, position) = cache.plays()
+        cache.commit(position)
+        self.assertTrue(cache.isempty())
+        self.assertListEqual(segments[-1:], self.segments())
+
+    def test_incomplete_entry_is_truncated(self):
+        cache = ScrobbleCache(self.directory)
+        cache.append({'start': 1})
+        with open(os.path.join(self.directory, self.segments()[0]), mode='a') as f:
+            f.write('{"start":')
+
+        reopened = ScrobbleCache(self.directory)
+        reopened.append({'start': 2})
+        self.assertListEqual([1, 2], [d['start'] for d, _ in reopened.plays()])
+
+    def test_ids_survive_reopen(self):
+        cache = ScrobbleCache(self.directory, segmentsize=64)
+        for n in range(5):
+            cache.append({'start': n})
+        (_, position), = [(d, p) for d, p in cache.plays() if d['start'] == 1]
+        cache.commit(position, 2)
+
+        reopened = ScrobbleCache(self.directory, segmentsize=64)
+        reopened.append({'start': 5})
+        self.assertListEqual([3, 4, 5, 6], [d['id'] for d, _ in reopened.plays()])
+        self.assertDictEqual({'segments': len(self.segments()), 'last_play': 6, 'pending_plays': 4, 'replay': None,
+                              'checkpoint': {'segment': position[0], 'offset': position[1], 'play': 2},
+                              'pending_bytes': reopened.pendingbytes()}, status(self.directory))
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+from scribscrob import configcache
+from scribscrob.configcache import ConfigError, load
+from scribscrob.state import ScrobblingMachine, reloadtransformer
+from scribscrob.transform import TagGuesser
+
+
+CONFIG = """
+[mpd]
+host=localhost
+port=6600
+
+[tagguess]
+regexps=["(?P<artist>.+) - (?P<title>.+)"]
+"""
+
+
+class TestConfigCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "config.ini")
+        self.cachepath = os.path.join(self.dir, "config.cache")
+        self.write(CONFIG)
+
+    def write(self, text: str):
+        with open(self.path, mode='w') as f:
+            f.write(text)
+
+    def test_cached_till_changed(self):
+        self.assertEqual(6600, load(self.path, self.cachepath).parser().getint('mpd', 'port'))
+        with mock.patch.object(configcache, 'compileconfig', wraps=configcache.compileconfig) as compileconfig:
+            load(self.path, self.cachepath)
+            self.assertEqual(0, compileconfig.call_count)
+            self.write(CONFIG.replace("6600", "6601"))
+            self.assertEqual(6601, load(self.path, self.cachepath).parser().getint('mpd', 'port'))
+            self.assertEqual(1, compileconfig.call_count)
+
+    def test_version_mismatch_recompiles(self):
+        load(self.path, self.cachepath)
+        with mock.patch.object(configcache, 'CACHE_VERSION', configcache.CACHE_VERSION + 1), \
+                mock.patch.object(configcache, 'compileconfig', wraps=configcache.compileconfig) as compileconfig:
+            load(self.path, self.cachepath)
+            self.assertEqual(1, compileconfig.call_count)
+
+    def test_invalid(self):
+        for text in (CONFIG.replace("(?P<artist>.+) - ", "(?P<artist>.+ - "),
+                     CONFIG.replace("(?P<artist>.+)", "(?P<singer>.+)"),
+                     CONFIG.replace("6600", "mpd"),
+                     CONFIG + "[mpd:kitchen]\naccount=nobody\n"):
+            self.write(text)
+            self.assertRaises(ConfigError, load, self.path, self.cachepath)
+
+    def test_missing_file(self):
+        self.assertListEqual([], load(os.path.join(self.dir, "none.ini"), self.cachepath).parser().sections())
+
+
+class TestReload(TestCase):
+    def test_reload_keeps_old_on_failure(self):
+        machines = [ScrobblingMachine(), ScrobblingMachine()]
+        guesser = TagGuesser([])
+        reloadtransformer(machines, lambda: guesser)
+        self.assertListEqual([guesser, guesser], [m.transformer for m in machines])
+
+        def broken():
+            raise ConfigError("broken")
+        reloadtransformer(machines, broken)
+        self.assertIs(guesser, machines[0].transformer)
@@ -0,0 +1,150 @@
+import asyncio
+import shutil
+import tempfile
+import time
+from configparser import ConfigParser
+from unittest import TestCase, mock
+from scribscrob.__main__ import ScribScrobFactory
+from scribscrob.daemon import Daemon
+from scribscrob.fakes import FakeLastfm, FakeMpd, playlist
+from scribscrob.loadtest import LastfmHttpClient
+from scribscrob.scrobble import LastfmScrobbler
+import scribscrob.state
+
+
+PLAYS = 4
+SPEEDUP = 100000  # a ms of wall time is 100s of player time, so every track of FakeMpd paced at RATE is played long
+RATE = 100  # events per second
+
+CONFIG = """
+[mpd:kitchen]
+host={kitchen[0]}
+port={kitchen[1]}
+account=alice
+snapshot={dir}/kitchen.json
+
+[mpd:bedroom]
+host={bedroom[0]}
+port={bedroom[1]}
+account=alice
+snapshot={dir}/bedroom.json
+
+[last.fm:alice]
+user=alice
+password_hash=md5hash
+rate=1000
+burst=1000
+cache={dir}/cache
+dedup={dir}/dedup
+
+[tagguess]
+regexps=[]
+"""
+
+
+def fastclock(test: TestCase):
+    """
+    Makes machines see time passing SPEEDUP times faster till the end of test
+    """
+    original = scribscrob.state.current_time_millis
+    started = time.monotonic()
+    scribscrob.state.current_time_millis = lambda: int((time.monotonic() - started) * 1000 * SPEEDUP)
+    test.addCleanup(setattr, scribscrob.state, 'current_time_millis', original)
+
+
+def plainhttp(test: TestCase, lastfm: FakeLastfm):
+    """
+    Makes last.fm scrobblers talk to lastfm till the end of test. pylast always uses HTTPS
+    """
+    def ensurestarted(self):
+        if not self.network:
+            self.network = LastfmHttpClient(lastfm.url, self.apikey, self.apisecret, self.username,
+                                            self.password_hash)
+    patcher = mock.patch.object(LastfmScrobbler, 'ensurestarted', ensurestarted)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def instancescript(name: str, plays: int, length: int=180):
+    """
+        returns: playlist of tracks unique to instance
+    """
+    return [(t, status, dict(song, artist="{:s} {:s}".format(name, song['artist'])) if song else song)
+            for t, status, song in playlist(plays, length)]
+
+
+class FakeInstances:
+    """
+    FakeMpd per instance and FakeLastfm, configured as [mpd:kitchen] and [mpd:bedroom] of account alice
+        param: events - number of events of every script to play, all by default
+    """
+
+    def __init__(self, test: TestCase, plays: int=PLAYS, length: int=180, events: int=None):
+        self.dir = tempfile.mkdtemp()
+        test.addCleanup(shutil.rmtree, self.dir)
+        self.lastfm = FakeLastfm()
+        self.lastfm.start()
+        test.addCleanup(self.lastfm.stop)
+        self.mpds = {}
+        for name in ('kitchen', 'bedroom'):
+            mpd = FakeMpd(instancescript(name, plays, length)[:events], rate=RATE)
+            mpd.start()
+            test.addCleanup(mpd.stop)
+            self.mpds[name] = mpd
+        config = ConfigParser()
+        config.read_string(CONFIG.format(dir=self.dir, **{name: mpd.address for name, mpd in self.mpds.items()}))
+        self.factory = ScribScrobFactory(config)
+
+
+async def waitfor(condition, timeout: float=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+
+class TestDaemon(TestCase):
+    def test_instances_scrobble_to_shared_account(self):
+        fastclock(self)
+        fakes = FakeInstances(self)
+        plainhttp(self, fakes.lastfm)
+
+        async def main():
+            daemon = Daemon(fakes.factory.get_transformer())
+            for name, factory in fakes.factory.instances():
+                daemon.add(name, factory)
+            self.assertEqual(1, len(daemon.scrobblers))
+            await waitfor(lambda: fakes.lastfm.counts['scrobbles'] == 2 * PLAYS and
+                          sum(daemon.load().values()) == 2 * (PLAYS + 1))
+            self.assertDictEqual({'kitchen': PLAYS + 1, 'bedroom': PLAYS + 1}, daemon.load())
+            await daemon.remove('kitchen')
+            self.assertEqual(1, len(daemon.scrobblers))
+            await daemon.remove('bedroom')
+            self.assertDictEqual({}, daemon.scrobblers)
+
+        asyncio.run(main())
+        self.assertListEqual(sorted("{:s} Artist {:d}".format(name, n) for name in ('kitchen', 'bedroom')
+                                    for n in range(PLAYS)),
+                             sorted(artist for artist, title, timestamp in fakes.lastfm.scrobbles))
+
+    def test_remove_playing_instance(self):
+        fakes = FakeInstances(self, plays=1, events=1)  # track is left playing
+        plainhttp(self, fakes.lastfm)
+
+        async def main():
+            daemon = Daemon(fakes.factory.get_transformer())
+            daemon.add('kitchen', dict(fakes.factory.instances())['kitchen'])
+            await waitfor(lambda: 'kitchen' in daemon.machines and daemon.machines['kitchen'].scrobbletimer)
+            listener, machine = daemon.listeners['kitchen'], daemon.machines['kitchen']
+            scrobbler = daemon.scrobblers['last.fm:alice']
+            await daemon.remove('kitchen')
+            # nothing is left to scrobble into stopped scrobbler or to rewrite snapshot
+            self.assertIsNone(listener.timerhandle)
+            self.assertIsNone(machine.scrobbletimer)
+            self.assertIsNone(listener.client.writer)
+            self.assertIsNone(scrobbler.worker)
+
+        asyncio.run(main())
+        self.assertEqual(1, fakes.lastfm.counts['nowplaying'])
+        self.assertEqual(0, fakes.lastfm.counts['scrobbles'])
@@ -0,0 +1,43 @@
+import shutil
+import tempfile
+from unittest import TestCase
+from scribscrob.dedup import DedupIndex, playkey
+
+
+class TestDedupIndex(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_playkey(self):
+        self.assertEqual(playkey("The Chessnuts", "Beyond The Sea", 10), playkey(" the chessnuts", "BEYOND the sea", 10))
+        self.assertNotEqual(playkey("The Chessnuts", "Beyond The Sea", 10), playkey("The Chessnuts", "Beyond The Sea", 11))
+
+    def test_seen_after_restart(self):
+        index = DedupIndex(self.directory, window=10, capacity=100)
+        index.add(playkey("a", "b", 1))
+        self.assertTrue(index.seen(playkey("a", "b", 1)))
+        self.assertFalse(index.seen(playkey("a", "b", 2)))
+        index.close()
+
+        index = DedupIndex(self.directory, window=10, capacity=100)
+        self.assertTrue(index.seen(playkey("a", "b", 1)))
+        self.assertFalse(index.seen(playkey("a", "b", 2)))
+        index.close()
+
+    def test_rolling(self):
+        index = DedupIndex(self.directory, window=5, capacity=20)
+        for n in range(30):
+            index.add(playkey("a", "b", n))
+        self.assertLessEqual(index.recentlines, 10)
+        # older than window, but still in bloom filter
+        for n in range(30):
+            self.assertTrue(index.seen(playkey("a", "b", n)))
+
+        # the oldest generation is forgotten after two rotations
+        for n in range(30, 60):
+            index.add(playkey("a", "b", n))
+        self.assertFalse(any(index.seen(playkey("a", "b", n)) for n in range(20)))
+        index.close()
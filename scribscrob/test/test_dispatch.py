@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase, mock
+from scribscrob.asyncdispatch import AsyncDispatchingScrobbler
+from scribscrob.dispatch import DispatchingScrobbler, FanoutScrobbler
+from scribscrob.scrobble import LastfmScrobbler
+from scribscrob.test.test_state import songs
+
+
+class TestDispatchingScrobbler(TestCase):
+    def test_dispatch(self):
+        scrobbler = mock.MagicMock()
+        d = DispatchingScrobbler(scrobbler)
+        d.start()
+        d.nowplaying(songs[0])
+        d.scrobble(songs[0], 10)
+        d.stop()
+        self.assertListEqual([mock.call.nowplaying(songs[0]), mock.call.scrobble(songs[0], 10),
+                              mock.call.cancelnowplaying()], scrobbler.mock_calls)
+
+    def test_worker_survives_errors(self):
+        scrobbler = mock.MagicMock()
+        scrobbler.nowplaying.side_effect = RuntimeError()
+        d = DispatchingScrobbler(scrobbler)
+        d.start()
+        d.nowplaying(songs[0])
+        d.scrobble(songs[1], 10)
+        d.stop()
+        scrobbler.scrobble.assert_called_once_with(songs[1], 10)
+
+    def test_pending_nowplaying_sent_by_worker(self):
+        scrobbler = LastfmScrobbler("user", password_hash="hash", nowplayingwindow=0.05)
+        scrobbler.network = mock.MagicMock()
+        threads = []
+        scrobbler.network.update_now_playing.side_effect = lambda artist, title: threads.append(
+            threading.current_thread().name)
+        d = DispatchingScrobbler(scrobbler)
+        d.start()
+        d.nowplaying(songs[0])
+        d.nowplaying(songs[1])
+        deadline = time.monotonic() + 5
+        while len(threads) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertListEqual(["scrobble-dispatcher"] * 2, threads)
+
+        # pending notification is dropped on stop
+        d.nowplaying(songs[0])
+        d.stop()
+        time.sleep(0.1)
+        self.assertEqual(2, scrobbler.network.update_now_playing.call_count)
+        self.assertIsNone(scrobbler.nowplayingtimer)
+
+    def test_overflow(self):
+        scrobbler = mock.MagicMock()
+        d = DispatchingScrobbler(scrobbler, queuesize=1, puttimeout=0)
+        d.scrobble(songs[0], 10)
+        d.scrobble(songs[1], 20)
+        d.nowplaying(songs[1])
+        self.assertListEqual([mock.call.scrobble_to_cache(songs[1], 20)], scrobbler.mock_calls)
+
+        d.start()
+        d.stop()
+        scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+
+
+class TestAsyncDispatchingScrobbler(TestCase):
+    def test_dispatch(self):
+        scrobbler = mock.MagicMock()
+
+        async def run():
+            d = AsyncDispatchingScrobbler(scrobbler)
+            d.start()
+            d.nowplaying(songs[0])
+            d.scrobble(songs[0], 10)
+            await d.stop()
+
+        asyncio.run(run())
+        self.assertListEqual([mock.call.nowplaying(songs[0]), mock.call.scrobble(songs[0], 10),
+                              mock.call.cancelnowplaying()], scrobbler.mock_calls)
+
+    def test_overflow(self):
+        scrobbler = mock.MagicMock()
+
+        async def run():
+            d = AsyncDispatchingScrobbler(scrobbler, queuesize=1)
+            d.start()
+            d.scrobble(songs[0], 10)
+            d.scrobble(songs[1], 20)
+            d.nowplaying(songs[1])
+            self.assertListEqual([mock.call.scrobble_to_cache(songs[1], 20)], scrobbler.mock_calls)
+            await d.stop()
+
+        asyncio.run(run())
+        scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+
+
+class TestFanoutScrobbler(TestCase):
+    def test_slow_backend_doesnt_delay_others(self):
+        release = threading.Event()
+        slow, fast = mock.MagicMock(), mock.MagicMock()
+        slow.scrobble.side_effect = lambda *args: release.wait(5)
+        scrobbled = threading.Event()
+        fast.scrobble.side_effect = lambda *args: scrobbled.set()
+        fanout = FanoutScrobbler([DispatchingScrobbler(slow), DispatchingScrobbler(fast)])
+        fanout.start()
+        fanout.scrobble(songs[0], 10)
+        self.assertTrue(scrobbled.wait(1))
+        release.set()
+        fanout.stop()
+        slow.scrobble.assert_called_once_with(songs[0], 10)
+        fast.scrobble.assert_called_once_with(songs[0], 10)
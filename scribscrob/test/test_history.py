@@ -0,0 +1,86 @@
+import csv
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase
+from scribscrob.history import HistoryStore, HistoryScrobbler, main
+from scribscrob.model import Song
+
+
+def play(artist: str, title: str, timestamp: int):
+    return Song({'artist': artist, 'title': title, 'album': artist + " album", 'file': title + ".flac",
+                 'time': "200"}), timestamp
+
+
+PLAYS = [play("A", "one", 100), play("B", "two", 200), play("A", "one", 300), play("A", "three", 400),
+         play("C", "four", 500)]
+
+
+class TestHistoryStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "history.sqlite")
+        self.store = HistoryStore(self.path)
+        self.addCleanup(self.store.close)
+        for song, timestamp in PLAYS:
+            self.store.add(song, timestamp)
+
+    def test_replayed_play_ignored(self):
+        self.store.add(*PLAYS[0])
+        self.assertEqual(5, self.store.count())
+
+    def test_top(self):
+        self.assertListEqual([("A", 3), ("B", 1)], self.store.top('artist', 2))
+        self.assertListEqual([("A", "one", 2)], self.store.top('track', 1))
+        self.assertListEqual([("A", "one", 1), ("A", "three", 1)], self.store.top('track', 5, since=300, until=500))
+
+    def test_spelling_variations(self):
+        self.store.add(*play(" a ", "One (feat. B)", 100))  # replay of the first play
+        self.store.add(*play("a", "ONE", 600))
+        self.assertEqual(6, self.store.count())
+        self.assertListEqual([("A", "one", 3)], self.store.top('track', 1))
+
+    def test_migration(self):
+        path = os.path.join(self.dir, "old.sqlite")
+        old = sqlite3.connect(path)
+        old.executescript("CREATE TABLE plays (timestamp INTEGER NOT NULL, artist TEXT NOT NULL, title TEXT NOT NULL, "
+                          "album TEXT, file TEXT, length INTEGER);"
+                          "CREATE UNIQUE INDEX plays_timestamp ON plays (timestamp, artist, title);"
+                          "INSERT INTO plays VALUES (100, 'The A', 'one', NULL, NULL, NULL);"
+                          "INSERT INTO plays VALUES (100, 'a', 'One', NULL, NULL, NULL);"
+                          "INSERT INTO plays VALUES (200, 'A', 'one', NULL, NULL, NULL);")
+        old.commit()
+        old.close()
+        store = HistoryStore(path)
+        self.addCleanup(store.close)
+        self.assertListEqual([("The A", "one", 2)], store.top('track'))
+        store.add(*play("A", "One", 200))
+        self.assertEqual(2, store.count())
+
+    def test_range(self):
+        batches = list(self.store.range(since=200, until=500, batchsize=2))
+        self.assertListEqual([2, 1], [len(rows) for rows in batches])
+        self.assertEqual((200, "B", "two", "B album", "two.flac", 200000), batches[0][0])
+
+    def test_export_csv(self):
+        f = io.StringIO()
+        self.assertEqual(5, self.store.exportcsv(f))
+        rows = list(csv.reader(io.StringIO(f.getvalue())))
+        self.assertListEqual(['timestamp', 'artist', 'title', 'album', 'file', 'length'], rows[0])
+        self.assertListEqual(['100', 'A', 'one', 'A album', 'one.flac', '200000'], rows[1])
+
+    def test_scrobbler(self):
+        scrobbler = HistoryScrobbler(self.store)
+        scrobbler.scrobble(*play("D", "five", 600))
+        scrobbler.submitmany([{'song': {'artist': "D", 'title': "six"}, 'start': 700}])
+        self.assertEqual(7, self.store.count())
+
+    def test_cli(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            main([self.path, '--since', '200', 'top', 'artist', '-n', '1'])
+        self.assertEqual('["A", 2]\n', out.getvalue())
@@ -0,0 +1,37 @@
+from unittest import TestCase
+from scribscrob.fakes import FakeLastfm, ERROR_RATE_LIMIT
+from scribscrob.loadtest import LastfmHttpClient, run
+import scribscrob.state
+
+
+class TestLastfmHttpClient(TestCase):
+    def setUp(self):
+        self.lastfm = FakeLastfm(ratelimit=1)
+        self.lastfm.start()
+        self.addCleanup(self.lastfm.stop)
+
+    def test_rate_limit_is_service_error(self):
+        import pylast
+        client = LastfmHttpClient(self.lastfm.url, "key", "secret", "user", "hash")
+        with self.assertRaises(pylast.WSError) as e:
+            client.scrobble("Artist", "Title", 1)
+        self.assertEqual(str(ERROR_RATE_LIMIT), e.exception.status)
+        self.assertEqual(1, self.lastfm.counts['ratelimited'])
+
+
+class TestRun(TestCase):
+    def test_all_scrobbled(self):
+        original = scribscrob.state.current_time_millis
+        report = run(plays=20, pauses=1, clientrate=1000)
+        self.assertIs(original, scribscrob.state.current_time_millis)
+        self.assertEqual(61, report['events'])
+        self.assertEqual(20, report['scrobbles_accepted'])
+        self.assertEqual(0, report['duplicates'])
+        self.assertEqual(0, report['cache']['pending_plays'])
+        self.assertEqual(61, report['event_latency']['count'])
+
+    def test_unavailable_service_grows_cache(self):
+        report = run(plays=20, errorrate=1, clientrate=1000)
+        self.assertEqual(0, report['scrobbles_accepted'])
+        self.assertEqual(20, report['cache']['pending_plays'])
+        self.assertGreater(report['cache']['peak_pending_bytes'], 0)
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from scribscrob.logs import LogPipeline, RotatingHandler, SamplingFilter
+
+
+class TestLogPipeline(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "scribscrob.log")
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+
+        def restore():
+            for h in list(root.handlers):
+                root.removeHandler(h)
+            for h in handlers:
+                root.addHandler(h)
+            root.setLevel(level)
+            logging.getLogger('test.verbose').setLevel(logging.NOTSET)
+        self.addCleanup(restore)
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines(self):
+        pipeline = LogPipeline(self.path, 'INFO', {'test.verbose': 'DEBUG'}, sampledebug=2)
+        pipeline.start()
+        logging.getLogger('test.quiet').debug("dropped")
+        logging.getLogger('test.quiet').info("kept %s", {'title': "Blip Blop"})
+        for n in range(4):
+            logging.getLogger('test.verbose').debug("event %d", n)
+        pipeline.stop()
+
+        lines = self.lines()
+        self.assertListEqual(["kept {'title': 'Blip Blop'}", "event 0", "event 2"], [d['msg'] for d in lines])
+        self.assertEqual({'t', 'level', 'logger', 'thread', 'msg'}, set(lines[0]))
+        self.assertEqual('test.quiet', lines[0]['logger'])
+
+
+class TestRotatingHandler(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "scribscrob.log")
+
+    def record(self, msg: str):
+        return logging.LogRecord('test', logging.INFO, __file__, 0, msg, (), None)
+
+    def test_rotate_by_time_and_size(self):
+        now = [0]
+        handler = RotatingHandler(self.path, maxbytes=100, backups=2, interval=60, clock=lambda: now[0])
+        self.addCleanup(handler.close)
+        handler.emit(self.record("first"))
+        now[0] = 61
+        handler.emit(self.record("second"))
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        handler.emit(self.record("x" * 120))
+        handler.emit(self.record("third"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        with open(self.path) as f:
+            self.assertEqual("third\n", f.read())
+
+
+class TestSamplingFilter(TestCase):
+    def test_sampling_per_message(self):
+        f = SamplingFilter(3)
+        records = [logging.LogRecord('test', level, __file__, 0, msg, (n,), None)
+                   for n, (level, msg) in enumerate([(logging.DEBUG, "a %d")] * 4 + [(logging.DEBUG, "b %d")] +
+                                                   [(logging.WARNING, "c %d")] * 2)]
+        self.assertListEqual([0, 3, 4, 5, 6], [r.args[0] for r in records if f.filter(r)])
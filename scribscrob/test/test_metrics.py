@@ -0,0 +1,85 @@
+import socket
+from unittest import TestCase
+from urllib.request import urlopen
+from scribscrob.metrics import Histogram, Registry, RequestMetrics, MetricsServer, StatsdPusher
+
+
+class TestHistogram(TestCase):
+    def test_percentile(self):
+        h = Histogram(buckets=(0.01, 0.1, 1.0))
+        self.assertIsNone(h.percentile(50))
+        for v in (0.005, 0.005, 0.05, 0.5, 5.0):
+            h.observe(v)
+        self.assertEqual(5, h.count)
+        self.assertListEqual([2, 1, 1, 1], h.counts)
+        self.assertEqual(0.01, h.percentile(40))
+        self.assertEqual(0.1, h.percentile(50))
+        self.assertEqual(float('inf'), h.percentile(100))
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter('wakeups_total', "Wakeups", mpd="a").inc(3)
+        self.registry.gauge('depth', "Depth", callback=lambda: 7)
+        self.registry.histogram('latency_seconds', "Latency", buckets=(0.1, 1.0)).observe(0.5)
+
+    def test_same_metric(self):
+        self.assertIs(self.registry.counter('wakeups_total', "Wakeups", mpd="a"),
+                      self.registry.counter('wakeups_total', "Wakeups", mpd="a"))
+
+    def test_exposition(self):
+        self.assertEqual('# HELP depth Depth\n'
+                         '# TYPE depth gauge\n'
+                         'depth 7\n'
+                         '# HELP latency_seconds Latency\n'
+                         '# TYPE latency_seconds histogram\n'
+                         'latency_seconds_bucket{le="0.1"} 0\n'
+                         'latency_seconds_bucket{le="1"} 1\n'
+                         'latency_seconds_bucket{le="+Inf"} 1\n'
+                         'latency_seconds_sum 0.5\n'
+                         'latency_seconds_count 1\n'
+                         '# HELP wakeups_total Wakeups\n'
+                         '# TYPE wakeups_total counter\n'
+                         'wakeups_total{mpd="a"} 3\n', self.registry.exposition())
+
+    def test_request_metrics(self):
+        metrics = RequestMetrics(self.registry, 'scrobble', user="u")
+        with metrics.measure():
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.measure():
+                raise ValueError()
+        self.assertEqual((1, 1, 2), (metrics.ok.value, metrics.failed.value, metrics.latency.count))
+
+    def test_server(self):
+        server = MetricsServer('localhost', 0, registry=self.registry)
+        server.start()
+        try:
+            with urlopen("http://localhost:{:d}/metrics".format(server.server.server_address[1])) as r:
+                self.assertEqual(self.registry.exposition(), r.read().decode())
+        finally:
+            server.stop()
+
+    def test_statsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        pusher = StatsdPusher('127.0.0.1', receiver.getsockname()[1], registry=self.registry)
+        self.assertListEqual(['scribscrob.depth:7|g',
+                              'scribscrob.latency_seconds_sum:0.5|g',
+                              'scribscrob.latency_seconds_count:1|g',
+                              'scribscrob.wakeups_total.mpd_a:3|c'], list(pusher.lines()))
+        self.registry.counter('wakeups_total', "Wakeups", mpd="a").inc()
+        pusher.push()
+        received = [receiver.recv(1024).decode() for _ in range(4)]
+        self.assertEqual('scribscrob.wakeups_total.mpd_a:1|c', received[-1])
+        receiver.close()
+
+    def test_statsd_unsafe_labels(self):
+        registry = Registry()
+        registry.counter('wakeups_total', "Wakeups", mpd="localhost:6600").inc(5)
+        registry.gauge('pending_bytes', "Pending", callback=lambda: 1, user="bob smith")
+        pusher = StatsdPusher('127.0.0.1', 8125, registry=registry)
+        self.addCleanup(pusher.socket.close)
+        self.assertListEqual(['scribscrob.pending_bytes.user_bob_smith:1|g',
+                              'scribscrob.wakeups_total.mpd_localhost_6600:5|c'], list(pusher.lines()))
@@ -0,0 +1,65 @@
+import pickle
+from unittest import TestCase
+from scribscrob.model import Song, Status, PLAY, canonical
+from scribscrob.mpdlistener import SongReuser
+
+
+FILE = {'title': "Beyong The Sea", 'artist': "The Chessnuts ", 'file': "Track01.flac", 'time': "177", 'pos': "1"}
+STREAM = {'title': "Blip Blop", 'file': "http://rocknrollradio"}
+
+
+class TestSong(TestCase):
+    def test_derived(self):
+        song = Song(FILE)
+        self.assertFalse(song.isstream)
+        self.assertEqual(177000, song.length)
+        self.assertEqual(("chessnuts", "beyong the sea"), song.key)
+
+        stream = Song(STREAM)
+        self.assertTrue(stream.isstream)
+        self.assertIsNone(stream.length)
+        self.assertEqual((None, "blip blop"), stream.key)
+
+    def test_canonical(self):
+        key = ("daft punk", "get lucky")
+        for artist, title in [("Daft Punk", "Get Lucky"),
+                              (" daft  PUNK", "Get Lucky (feat. Pharrell Williams)"),
+                              ("Daft Punk feat. Pharrell Williams", "Get Lucky"),
+                              ("Ｄａｆｔ Punk", "Get Lucky [ft. P]"),
+                              ("Daft Punk Featuring Pharrell Williams", "get lucky")]:
+            self.assertEqual(key, canonical(artist, title), (artist, title))
+        self.assertEqual(("beatles", "let it be"), canonical("The Beatles", "Let It Be"))
+        self.assertEqual(("the", "feat of clay"), canonical("The", "Feat of Clay"))
+        self.assertEqual((None, "blip blop"), canonical(None, "Blip Blop"))
+
+    def test_immutable(self):
+        song = Song(FILE)
+        with self.assertRaises(AttributeError):
+            song.artist = "Bill Doggett"
+        with self.assertRaises(AttributeError):
+            Status({'state': PLAY, 'elapsed': "1.000"}).state = "stop"
+
+    def test_withtags(self):
+        song = Song(STREAM).withtags("Bill Doggett", "Blip Blop")
+        self.assertEqual(("bill doggett", "blip blop"), song.key)
+        self.assertTrue(song.isstream)
+        self.assertIsNone(Song(STREAM).artist)
+
+    def test_interned(self):
+        self.assertIs(Song(dict(FILE)).title, Song({k: "".join(list(v)) for k, v in FILE.items()}).title)
+
+    def test_roundtrip(self):
+        song = Song(FILE)
+        self.assertEqual(song, Song(song.asdict()))
+        self.assertEqual(song, pickle.loads(pickle.dumps(song)))
+        status = Status({'state': PLAY, 'elapsed': "1.000"})
+        self.assertEqual("play(1.000)", str(pickle.loads(pickle.dumps(status))))
+
+
+class TestSongReuser(TestCase):
+    def test_get(self):
+        songs = SongReuser()
+        song = songs.get(dict(FILE))
+        self.assertIs(song, songs.get(dict(FILE)))
+        self.assertIsNot(song, songs.get(dict(FILE, title="Real Fine Frame")))
+        self.assertIsNone(songs.get({}))
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase, mock
+from scribscrob.fakes import FakeMpd, playlist
+from scribscrob.mpdlistener import AsyncMpdListener, Backoff, MpdListener, connectionerrors, parseobject
+from scribscrob.scheduler import Scheduler
+from scribscrob.state import ScrobblingMachine
+import scribscrob.state
+
+
+class TestBackoff(TestCase):
+    def test_next(self):
+        backoff = Backoff(mindelay=1, maxdelay=8)
+        delays = [backoff.next() for _ in range(6)]
+        for delay, bound in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertTrue(bound / 2 <= delay <= bound)
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next(), 1)
+
+
+class TestAsyncMpdListener(TestCase):
+    def setUp(self):
+        self.original = scribscrob.state.current_time_millis
+        self.clock = [0]
+        scribscrob.state.current_time_millis = lambda: self.clock[0]
+
+    def tearDown(self):
+        scribscrob.state.current_time_millis = self.original
+
+    def serve(self, script, lockstep=False):
+        mpd = FakeMpd(script, clock=self.clock, lockstep=lockstep)
+        mpd.start()
+        self.addCleanup(mpd.stop)
+        return mpd
+
+    async def waitfor(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            await asyncio.sleep(0.01)
+
+    def test_listen_forever(self):
+        mpd = self.serve(playlist(2, pauses=1), lockstep=True)
+        scrobbler = mock.Mock()
+        machine = ScrobblingMachine(scrobbler=scrobbler)
+        events = []
+        ondisconnect = mock.Mock()
+
+        def onevent(status, song):
+            machine.onevent(status, song)
+            events.append(status.state)
+            mpd.handled()
+
+        async def main():
+            listener = AsyncMpdListener(*mpd.address)
+            task = asyncio.ensure_future(listener.listen_forever('player', onevent, machine.resync, ondisconnect,
+                                                                 machine.scheduler))
+            try:
+                await self.waitfor(mpd.done.is_set)
+                mpd.stop()
+                await self.waitfor(lambda: ondisconnect.called)
+            finally:
+                task.cancel()
+
+        asyncio.run(main())
+        self.assertListEqual(['play', 'pause', 'play'] * 2 + ['stop'], events)
+        self.assertListEqual([("Title 0", 0), ("Title 1", 180)],
+                             [(c.args[0].title, c.args[1]) for c in scrobbler.scrobble.call_args_list])
+
+    def test_timers_run_between_events(self):
+        mpd = self.serve([])
+        scheduler = Scheduler(lambda: int(time.monotonic() * 1000))
+        fired = []
+
+        async def main():
+            listener = AsyncMpdListener(*mpd.address)
+            task = asyncio.ensure_future(listener.listen_forever(
+                'player', mock.Mock(), lambda status, song: scheduler.schedule(scheduler.clock() + 10,
+                                                                              lambda: fired.append(status.state)),
+                mock.Mock(), scheduler))
+            try:
+                await self.waitfor(lambda: fired)
+            finally:
+                task.cancel()
+
+        asyncio.run(main())
+        self.assertListEqual(['stop'], fired)
+
+    def test_handler_error_is_not_disconnect(self):
+        mpd = self.serve(playlist(1))
+        events = []
+        ondisconnect = mock.Mock()
+
+        def onevent(status, song):
+            events.append(status.state)
+            raise OSError("No space left on device")
+
+        async def main():
+            listener = AsyncMpdListener(*mpd.address)
+            task = asyncio.ensure_future(listener.listen_forever('player', onevent, mock.Mock(), ondisconnect))
+            try:
+                await self.waitfor(mpd.done.is_set)
+                await self.waitfor(lambda: len(events) == 2)
+                self.assertFalse(ondisconnect.called)
+            finally:
+                task.cancel()
+
+        with self.assertLogs('mpd', 'ERROR'):
+            asyncio.run(main())
+        self.assertListEqual(['play', 'stop'], events)
+
+    def test_parseobject(self):
+        self.assertDictEqual({'artist': ["A", "B"], 'title': "T"},
+                             parseobject([('Artist', "A"), ('Title', "T"), ('Artist', "B")]))
+
+
+class TestMpdListener(TestCase):
+    def test_handler_error_is_not_disconnect(self):
+        mpd = FakeMpd(playlist(1))
+        mpd.start()
+        events = []
+
+        def onevent(status, song):
+            events.append(status.state)
+            raise OSError("No space left on device")
+
+        def listen():
+            listener = MpdListener(*mpd.address)
+            try:
+                listener.connect()
+                listener.listen('player', onevent)
+            except connectionerrors():
+                pass
+
+        thread = threading.Thread(target=listen, daemon=True)
+        with self.assertLogs('mpd', 'ERROR'):
+            thread.start()
+            self.assertTrue(mpd.done.wait(5))
+            deadline = time.monotonic() + 5
+            while len(events) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            mpd.stop()
+            thread.join(5)
+        self.assertListEqual(['play', 'stop'], events)
@@ -0,0 +1,31 @@
+from unittest import TestCase
+from scribscrob.scheduler import Scheduler
+
+
+class TestScheduler(TestCase):
+    def test_run_in_deadline_order(self):
+        now = [0]
+        run = []
+        scheduler = Scheduler(lambda: now[0])
+        scheduler.schedule(300, lambda: run.append(3))
+        scheduler.schedule(100, lambda: run.append(1))
+        scheduler.schedule(100, lambda: run.append(2))
+        scheduler.schedule(200, lambda: run.append(None)).cancel()
+        self.assertEqual(0.1, scheduler.timeout())
+        now[0] = 250
+        self.assertEqual(2, scheduler.runexpired())
+        self.assertListEqual([1, 2], run)
+        self.assertEqual(0.05, scheduler.timeout())
+        now[0] = 400
+        scheduler.runexpired()
+        self.assertListEqual([1, 2, 3], run)
+        self.assertIsNone(scheduler.timeout())
+
+    def test_wakeup(self):
+        wakeups = []
+        scheduler = Scheduler(lambda: 0)
+        scheduler.wakeup = lambda: wakeups.append(scheduler.next())
+        scheduler.schedule(200, print)
+        scheduler.schedule(300, print)
+        scheduler.schedule(100, print)
+        self.assertListEqual([200, 100], wakeups)
@@ -1,12 +1,22 @@
+import os
+import shutil
+import tempfile
 from configparser import ConfigParser
 from unittest import TestCase
-from scribscrob import ScribScrobFactory
+from scribscrob.__main__ import ScribScrobFactory
 
 
 class TestScribScrobFactory(TestCase):
-    config = ConfigParser(allow_no_value=True, strict=False)
-    config.read('scribscrob.ini')
-    factory = ScribScrobFactory(config)
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = ConfigParser(allow_no_value=True, strict=False)
+        config.read(os.path.join(os.path.dirname(__file__), 'scribscrob.ini'))
+        for section in ('last.fm', 'last.fm:alice', 'listenbrainz:alice', 'history:alice'):
+            config.set(section, 'cache', os.path.join(directory, section, "cache"))
+            config.set(section, 'dedup', os.path.join(directory, section, "dedup"))
+        config.set('history:alice', 'path', os.path.join(directory, "history.sqlite"))
+        self.factory = ScribScrobFactory(config)
 
     def test_get_mpd(self):
         mpd = self.factory.get_mpd()
@@ -17,6 +27,57 @@ class TestScribScrobFactory(TestCase):
         self.assertIsNotNone(lastfm)
 
     def test_get_transformer(self):
-        tagguesser = self.factory.get_transformer()
+        tagguesser, normalizer = self.factory.get_transformer().transformers
         self.assertIsNotNone(tagguesser)
         self.assertEqual(2, len(tagguesser.patterns))
+        self.assertEqual(16, normalizer.memosize)
+
+    def test_get_dispatcher(self):
+        dispatcher = self.factory.get_dispatcher(self.factory.get_lastfm())
+        self.assertEqual(16, dispatcher.queue.maxsize)
+        self.assertEqual(0.1, dispatcher.puttimeout)
+
+    def test_instances(self):
+        instances = dict(self.factory.instances())
+        self.assertListEqual(['kitchen', 'bedroom'], list(instances))
+        self.assertTrue(instances['bedroom'].isasync())
+        self.assertEqual(6601, instances['bedroom'].get_mpd().port)
+        self.assertEqual('alice', instances['bedroom'].get_lastfm().username)
+
+    def test_get_snapshots(self):
+        self.assertTrue(self.factory.get_snapshots().path.endswith("state.json"))
+        instances = dict(self.factory.instances())
+        self.assertTrue(instances['kitchen'].get_snapshots().path.endswith("state-kitchen.json"))
+
+    def test_get_metrics(self):
+        server, statsd = self.factory.get_metrics()
+        server.server.server_close()
+        self.assertEqual(('localhost', 8125), statsd.address)
+
+    def test_rate_limits(self):
+        lastfm = dict(self.factory.instances())['kitchen'].get_lastfm()
+        self.assertEqual(10, lastfm.nowplayingwindow)
+        self.assertEqual((1, 3), (lastfm.bucket.rate, lastfm.bucket.capacity))
+
+    def test_get_scrobbler(self):
+        self.assertEqual('last.fm', self.factory.get_scrobbler().scrobbler.service)
+        fanout = dict(self.factory.instances())['kitchen'].get_scrobbler()
+        self.assertListEqual(['last.fm', 'listenbrainz', 'history'], [d.scrobbler.service for d in fanout.dispatchers])
+        self.assertEqual("http://localhost:8100/1/submit-listens", fanout.dispatchers[1].scrobbler.url)
+
+    def test_get_streamdebounce(self):
+        self.assertEqual(3000, self.factory.get_streamdebounce())
+        self.assertEqual(1500, dict(self.factory.instances())['kitchen'].get_streamdebounce())
+
+    def test_get_logging(self):
+        pipeline = self.factory.get_logging()
+        self.assertEqual('WARNING', pipeline.level)
+        self.assertDictEqual({'mpd': 'DEBUG'}, pipeline.levels)
+        self.assertEqual(10, pipeline.sampledebug)
+
+    def test_get_supervisor(self):
+        supervisor = self.factory.get_supervisor()
+        self.addCleanup(supervisor.records.close)
+        self.assertEqual((2, 2), (supervisor.size, supervisor.interval))
+        self.assertDictEqual({'last.fm:alice': ['kitchen', 'bedroom']}, supervisor.accounts)
+        self.assertTrue(supervisor.controlpath.endswith("control.sock"))
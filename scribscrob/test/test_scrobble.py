@@ -0,0 +1,192 @@
+import shutil
+import tempfile
+import time
+from unittest import TestCase, mock
+import pylast
+from scribscrob.cache import ScrobbleCache, status as cachestatus
+from scribscrob.dedup import DedupIndex
+from scribscrob.model import Song
+from scribscrob.scrobble import LastfmScrobbler, TokenBucket, CircuitBreaker, CACHE_BATCH_SIZE
+
+
+def song(n: int):
+    return Song({'title': "Track {:d}".format(n), 'artist': "Artist", 'file': "Track.flac", 'time': "177"})
+
+
+class TestLastfmScrobblerCache(TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.scrobbler = LastfmScrobbler("user", password_hash="hash", cache=ScrobbleCache(self.cachedir))
+        self.scrobbler.network = mock.MagicMock()
+        for n in range(120):
+            self.scrobbler.scrobble_to_cache(song(n), n)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def cached_starts(self):
+        return [d['start'] for d, _ in ScrobbleCache(self.cachedir).plays()]
+
+    def test_flush_cache_in_batches(self):
+        self.assertEqual(120, self.scrobbler.flush_cache())
+        batches = [c[0][0] for c in self.scrobbler.network.scrobble_many.call_args_list]
+        self.assertListEqual([CACHE_BATCH_SIZE, CACHE_BATCH_SIZE, 20], [len(b) for b in batches])
+        self.assertEqual({'artist': "Artist", 'title': "Track 0", 'album': None, 'timestamp': 0}, batches[0][0])
+        self.assertListEqual([], self.cached_starts())
+        self.assertEqual(0, self.scrobbler.flush_cache())
+
+    def test_dedup(self):
+        dedupdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dedupdir)
+        self.scrobbler.dedup = DedupIndex(dedupdir)
+        self.scrobbler.scrobble(song(0), 0)
+        self.scrobbler.scrobble(song(0), 0)
+        self.assertEqual(1, self.scrobbler.network.scrobble.call_count)
+        # cached copy of the live scrobble is skipped
+        batches = [c[0][0] for c in self.scrobbler.network.scrobble_many.call_args_list]
+        self.assertEqual(119, sum(len(b) for b in batches))
+
+        # replay of the same plays submits nothing
+        for n in range(120):
+            self.scrobbler.scrobble_to_cache(song(n), n)
+        self.assertEqual(0, self.scrobbler.flush_cache())
+        self.assertEqual(len(batches), self.scrobbler.network.scrobble_many.call_count)
+        self.assertListEqual([], self.cached_starts())
+
+    def test_flush_cache_keeps_not_accepted(self):
+        self.scrobbler.network.scrobble_many.side_effect = [None, pylast.NetworkError(None, "down")]
+        self.assertEqual(CACHE_BATCH_SIZE, self.scrobbler.flush_cache())
+        self.assertListEqual(list(range(CACHE_BATCH_SIZE, 120)), self.cached_starts())
+
+    def test_interrupted_replay_resumes(self):
+        self.scrobbler.network.scrobble_many.side_effect = [None, pylast.NetworkError(None, "down")]
+        self.scrobbler.flush_cache()
+        status = cachestatus(self.cachedir)
+        self.assertEqual(CACHE_BATCH_SIZE, status['checkpoint']['play'])
+        self.assertEqual(120 - CACHE_BATCH_SIZE, status['pending_plays'])
+        self.assertEqual((CACHE_BATCH_SIZE, 120), (status['replay']['replayed'], status['replay']['target']))
+
+        # restarted daemon continues the replay from checkpoint
+        restarted = LastfmScrobbler("user", password_hash="hash", cache=ScrobbleCache(self.cachedir))
+        restarted.network = mock.MagicMock()
+        self.assertEqual(120 - CACHE_BATCH_SIZE, restarted.flush_cache())
+        self.assertEqual(CACHE_BATCH_SIZE, restarted.network.scrobble_many.call_args_list[0][0][0][0]['timestamp'])
+        status = cachestatus(self.cachedir)
+        self.assertEqual((120, 0, None), (status['checkpoint']['play'], status['pending_plays'], status['replay']))
+
+
+class TestNowPlaying(TestCase):
+    def setUp(self):
+        self.scrobbler = LastfmScrobbler("user", password_hash="hash", nowplayingwindow=0.2)
+        self.scrobbler.network = mock.MagicMock()
+
+    def sent(self):
+        return [c[0][1] for c in self.scrobbler.network.update_now_playing.call_args_list]
+
+    def test_coalescing(self):
+        for n in range(5):
+            self.scrobbler.nowplaying(song(n))
+        self.assertListEqual(["Track 0"], self.sent())
+        time.sleep(0.3)
+        self.assertListEqual(["Track 0", "Track 4"], self.sent())
+
+    def test_same_song_dropped(self):
+        self.scrobbler.nowplaying(song(0))
+        self.scrobbler.nowplaying(song(1))
+        self.scrobbler.nowplaying(song(0))
+        time.sleep(0.3)
+        self.assertListEqual(["Track 0"], self.sent())
+
+
+class TestTokenBucket(TestCase):
+    def test_acquire(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual(0, bucket.tryacquire())
+        self.assertEqual(0, bucket.tryacquire())
+        self.assertEqual(0.5, bucket.tryacquire())
+        bucket.acquire()
+        self.assertListEqual([0.5], sleeps)
+        now[0] += 10
+        for _ in range(2):
+            bucket.acquire()
+        self.assertListEqual([0.5], sleeps)
+
+
+class TestCircuitBreaker(TestCase):
+    def test_open_and_trial(self):
+        now = [0.0]
+        breaker = CircuitBreaker(threshold=2, resettimeout=10, clock=lambda: now[0])
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        now[0] += 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # single trial request
+        breaker.failure()
+        now[0] += 5
+        self.assertFalse(breaker.allow())
+        now[0] += 5
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.isopen())
+        self.assertTrue(breaker.allow())
+
+    def test_trial_raising_unlisted_exception(self):
+        now = [0.0]
+        scrobbler = LastfmScrobbler("user", password_hash="hash",
+                                    breaker=CircuitBreaker(threshold=1, resettimeout=10, clock=lambda: now[0]))
+        scrobbler.network = mock.MagicMock()
+        scrobbler.network.scrobble.side_effect = [pylast.NetworkError(None, "down"), KeyError('status'), None]
+        scrobbler.scrobble(song(0), 0)
+        now[0] += 10
+        with self.assertRaises(KeyError):
+            scrobbler.scrobble(song(1), 1)
+        # failed trial keeps breaker open for another resettimeout, then the next trial is let through
+        self.assertFalse(scrobbler.breaker.allow())
+        now[0] += 10
+        scrobbler.scrobble(song(2), 2)
+        self.assertEqual(3, scrobbler.network.scrobble.call_count)
+        self.assertFalse(scrobbler.breaker.isopen())
+
+    def test_open_circuit_goes_to_cache(self):
+        cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachedir)
+        scrobbler = LastfmScrobbler("user", password_hash="hash", cache=ScrobbleCache(cachedir),
+                                    breaker=CircuitBreaker(threshold=1))
+        scrobbler.network = mock.MagicMock()
+        scrobbler.network.scrobble.side_effect = pylast.NetworkError(None, "down")
+        scrobbler.scrobble(song(0), 0)
+        scrobbler.scrobble(song(1), 1)
+        self.assertEqual(1, scrobbler.network.scrobble.call_count)
+        self.assertListEqual([0, 1], [d['start'] for d, _ in ScrobbleCache(cachedir).plays()])
+
+    def test_open_circuit_with_duplicate_cache(self):
+        now = [0.0]
+        cachedir, dedupdir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachedir)
+        self.addCleanup(shutil.rmtree, dedupdir)
+        scrobbler = LastfmScrobbler("user", password_hash="hash", cache=ScrobbleCache(cachedir),
+                                    dedup=DedupIndex(dedupdir),
+                                    breaker=CircuitBreaker(threshold=1, resettimeout=10, clock=lambda: now[0]))
+        scrobbler.network = mock.MagicMock()
+        for n in range(3):
+            scrobbler.scrobble(song(n), n)
+            scrobbler.scrobble_to_cache(song(n), n)
+        scrobbler.breaker.failure()
+        self.assertEqual(0, scrobbler.flush_cache())
+        now[0] += 10
+        # replay drops every play as duplicate, no request is sent, so trial stays available
+        self.assertEqual(0, scrobbler.flush_cache())
+        self.assertListEqual([], [d['start'] for d, _ in ScrobbleCache(cachedir).plays()])
+        self.assertTrue(scrobbler.breaker.ready())
+        scrobbler.scrobble(song(3), 3)
+        self.assertEqual(4, scrobbler.network.scrobble.call_count)
+        self.assertFalse(scrobbler.breaker.isopen())
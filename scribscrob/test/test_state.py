@@ -1,6 +1,8 @@
+import os
+import tempfile
 from unittest import TestCase, mock
 from scribscrob.model import Song, Status, PLAY, STOP, PAUSE
-from scribscrob.state import ScrobblingMachine, State, eligibleforscrobbling
+from scribscrob.state import ScrobblingMachine, State, SnapshotStore, eligibleforscrobbling
 import scribscrob.state
 
 
@@ -127,6 +129,101 @@ class TestScrobblingMachine(TestCase):
         self.assertEqual(0, m.elapsed)
         m.scrobbler.assert_has_calls([mock.call.scrobble(songs[0], 2.0)])
 
+    def test_disconnect_resync_same_song(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), songs[0])
+
+        mocktime(70000)
+        m.disconnected()
+        self.assertEqual(State(PAUSE, 70000), m.state)
+        self.assertEqual(60000, m.elapsed)
+
+        # time being disconnected is not counted
+        mocktime(200000)
+        m.resync(seek(80), songs[0])
+        self.assertEqual(State(PLAY, 200000), m.state)
+        self.assertEqual(60000, m.elapsed)
+        m.scrobbler.scrobble.assert_not_called()
+
+        mocktime(230000)
+        m.onevent(play(), songs[1])
+        m.scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+
+    def test_disconnect_resync_stream(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        mocktime(70000)
+        m.disconnected()
+
+        mocktime(80000)
+        m.resync(play(), stream[0])
+        self.assertEqual(State(PLAY, 80000), m.state)
+        m.scrobbler.scrobble.assert_not_called()
+
+    def test_disconnect_resync_stopped(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), songs[0])
+        mocktime(110000)
+        m.disconnected()
+
+        mocktime(200000)
+        m.resync(stop(), None)
+        self.assertEqual(State(STOP, 200000), m.state)
+        m.scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+
+    def test_resync_other_song(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), songs[0])
+        mocktime(110000)
+        m.disconnected()
+
+        mocktime(200000)
+        m.resync(pause(20), songs[1])
+        self.assertEqual(State(PAUSE, 200000), m.state)
+        self.assertEqual(20000, m.elapsed)
+        self.assertIs(songs[1], m.song)
+        m.scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+
+
+class TestSnapshots(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_restart_during_play(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock(), snapshots=SnapshotStore(self.path))
+        m.onevent(play(), songs[0])
+        mocktime(70000)
+        m.onevent(seek(60), songs[0])
+
+        # restarted, MPD still plays the same song
+        mocktime(90000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock(), snapshots=SnapshotStore(self.path))
+        self.assertEqual(State(PLAY, 10000), m.state)
+        self.assertEqual(0, m.elapsed)
+        self.assertEqual(songs[0].asdict(), m.song.asdict())
+        m.resync(seek(80), songs[0])
+        self.assertEqual(State(PLAY, 10000), m.state)
+
+        # restarted again, MPD plays another song already
+        mocktime(300000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock(), snapshots=SnapshotStore(self.path))
+        self.assertEqual(State(PLAY, 10000), m.state)
+        m.resync(play(), songs[1])
+        self.assertEqual(1, m.scrobbler.scrobble.call_count)
+        self.assertEqual(10, m.scrobbler.scrobble.call_args[0][1])
+        self.assertIs(songs[1], m.song)
+
 
 class TestUtil(TestCase):
     def test_eligibleforscrobbling(self):
@@ -140,4 +237,102 @@ class TestUtil(TestCase):
             self.assertFalse(eligibleforscrobbling(s))
 
 
+class TestScrobbleTimer(TestCase):
+    def test_committed_at_threshold(self):
+        mocktime(10000)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), songs[0])
+        # paused for a minute, which doesn't count
+        mocktime(40000)
+        m.onevent(pause(30), songs[0])
+        mocktime(100000)
+        m.onevent(seek(30), songs[0])
+        self.assertEqual(100000 + 88500 - 30000 + 1, m.scheduler.next())
+
+        mocktime(m.scheduler.next() - 1)
+        self.assertEqual(0, m.scheduler.runexpired())
+        mocktime(m.scheduler.next())
+        self.assertEqual(1, m.scheduler.runexpired())
+        m.scrobbler.scrobble.assert_called_once_with(songs[0], 10)
+        self.assertIsNone(m.scheduler.next())
+
+        # the end of the play doesn't scrobble it again
+        mocktime(250000)
+        m.onevent(play(), songs[1])
+        m.onevent(stop(), None)
+        m.scrobbler.scrobble.assert_called_once_with(songs[0], 10)
 
+    def test_stream(self):
+        mocktime(0)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        mocktime(15001)
+        m.scheduler.runexpired()
+        m.scrobbler.scrobble.assert_called_once_with(stream[0], 0)
+        mocktime(200000)
+        m.onevent(play(), stream[1])
+        # new title settles first, its play is counted since it appeared
+        mocktime(203000)
+        m.scheduler.runexpired()
+        self.assertEqual(1, m.scrobbler.scrobble.call_count)
+        self.assertEqual(215001, m.scheduler.next())
+
+
+class TestStream(TestCase):
+    def test_same_title_skipped(self):
+        mocktime(0)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        mocktime(5000)
+        retagged = Song({'title': " blip blop", 'artist': "Bill Doggett", 'file': "http://rocknrollradio",
+                         'name': "Rock'n'roll radio"})
+        m.onevent(play(), retagged)
+        self.assertIs(stream[0], m.song)
+        self.assertEqual(State(PLAY, 0), m.state)
+        self.assertEqual([mock.call.nowplaying(stream[0])], m.scrobbler.mock_calls)
+
+    def test_resync_retagged(self):
+        mocktime(0)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        m.disconnected()
+        mocktime(60000)
+        retagged = Song({'title': "Blip blop ", 'artist': "bill doggett", 'file': "http://rocknrollradio"})
+        m.resync(play(), retagged)
+        self.assertIs(stream[0], m.song)
+        m.scrobbler.scrobble.assert_not_called()
+
+    def test_flapping_debounced(self):
+        mocktime(0)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        for t, song in [(20000, stream[1]), (21000, stream[0]), (22000, stream[1]), (23000, stream[0])]:
+            mocktime(t)
+            m.onevent(play(), song)
+            m.scheduler.runexpired()
+        self.assertIs(stream[0], m.song)
+        self.assertEqual(0, m.start)
+
+        mocktime(30000)
+        m.onevent(play(), stream[1])
+        mocktime(32000)
+        m.scheduler.runexpired()
+        self.assertIs(stream[0], m.song)
+        mocktime(33000)
+        m.scheduler.runexpired()
+        self.assertIs(stream[1], m.song)
+        self.assertEqual(30000, m.start)
+        self.assertEqual([mock.call.nowplaying(stream[0]), mock.call.scrobble(stream[0], 0),
+                          mock.call.nowplaying(stream[1])], m.scrobbler.mock_calls)
+
+    def test_stop_drops_pending_title(self):
+        mocktime(0)
+        m = ScrobblingMachine(scrobbler=mock.MagicMock())
+        m.onevent(play(), stream[0])
+        mocktime(10000)
+        m.onevent(play(), stream[1])
+        m.onevent(stop(), None)
+        mocktime(20000)
+        m.scheduler.runexpired()
+        self.assertEqual(State(STOP, 10000), m.state)
+        self.assertEqual([mock.call.nowplaying(stream[0])], m.scrobbler.mock_calls)
@@ -0,0 +1,208 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from configparser import ConfigParser
+from unittest import TestCase, mock
+from scribscrob.supervisor import HashRing, Supervisor, Worker, ControlServer, query, serveshard, ADD, LOAD, REMOVE, \
+    REMOVED
+from scribscrob.test.test_daemon import PLAYS, FakeInstances, fastclock, plainhttp, waitfor
+
+
+CONFIG = """
+[mpd:kitchen]
+host=kitchen
+port=6600
+account=alice
+
+[mpd:bedroom]
+host=bedroom
+port=6600
+account=alice
+
+[mpd:garage]
+host=garage
+port=6600
+account=carol
+"""
+
+
+class TestHashRing(TestCase):
+    def test_balanced(self):
+        ring = HashRing(range(4))
+        owners = [ring.node("last.fm:user{:d}".format(n)) for n in range(4000)]
+        for node in range(4):
+            self.assertGreater(owners.count(node), 700)
+
+    def test_minimal_movement(self):
+        keys = ["last.fm:user{:d}".format(n) for n in range(1000)]
+        ring = HashRing(range(4))
+        before = {key: ring.node(key) for key in keys}
+        ring.remove(2)
+        after = {key: ring.node(key) for key in keys}
+        # only keys of removed node move
+        self.assertListEqual([k for k in keys if before[k] == 2], [k for k in keys if before[k] != after[k]])
+        ring.add(2)
+        self.assertDictEqual(before, {key: ring.node(key) for key in keys})
+
+    def test_empty(self):
+        self.assertIsNone(HashRing().node("last.fm:alice"))
+
+
+class TestSupervisor(TestCase):
+    def setUp(self):
+        from scribscrob.__main__ import ScribScrobFactory
+        config = ConfigParser()
+        config.read_string(CONFIG)
+        self.supervisor = Supervisor(ScribScrobFactory(config), 2)
+        self.addCleanup(self.supervisor.records.close)
+        self.sent = []
+        self.supervisor.send = lambda shard, command, names: self.sent.append((shard, command, names))
+
+    def start(self, shard):
+        self.supervisor.workers[shard] = Worker(shard, mock.Mock(pid=100 + shard), mock.Mock())
+        self.supervisor.ring.add(shard)
+
+    def test_rebalance(self):
+        s = self.supervisor
+        self.start(0)
+        self.start(1)
+        s.rebalance()
+        self.assertListEqual(['bedroom', 'garage', 'kitchen'], sorted(n for _, c, names in self.sent for n in names))
+        self.assertEqual({0, 1}, set(s.owners.values()))  # 2 accounts, 2 workers
+        survivor = s.owners['last.fm:alice']
+        dead = 1 - survivor
+
+        # accounts of dead worker move to survivor, no one is told to remove them
+        del s.workers[dead]
+        s.ring.remove(dead)
+        self.sent.clear()
+        s.rebalance()
+        self.assertListEqual([(survivor, ADD, ['garage'])], self.sent)
+
+        # and move back when it is respawned, once survivor has stopped serving them
+        self.start(dead)
+        self.sent.clear()
+        s.rebalance()
+        self.assertListEqual([(survivor, REMOVE, ['garage'])], self.sent)
+        self.assertEqual(dead, s.owners['last.fm:carol'])
+        s.left(survivor, ['last.fm:carol'])
+        self.assertListEqual([(survivor, REMOVE, ['garage']), (dead, ADD, ['garage'])], self.sent)
+        self.assertDictEqual({}, s.leaving)
+
+    def test_leaving_worker_dies(self):
+        s = self.supervisor
+        self.start(0)
+        s.rebalance()
+        self.start(1)
+        self.sent.clear()
+        s.rebalance()
+        (leaving, command, names), = self.sent
+        self.assertEqual((0, REMOVE), (leaving, command))
+        # the new owner gets instances, that were not confirmed as removed, when the leaving worker's sentinel fires
+        with self.assertLogs('scribscrob.supervisor', 'ERROR'):
+            s.died(0)
+        self.assertIn((1, ADD, names), self.sent)
+        self.assertDictEqual({}, s.leaving)
+
+    def test_status(self):
+        s = self.supervisor
+        self.start(0)
+        s.rebalance()
+        status = s.status()
+        self.assertFalse(status['1']['alive'])
+        self.assertListEqual(['last.fm:alice', 'last.fm:carol'], status['0']['accounts'])
+
+
+class TestWorker(TestCase):
+    def test_serveshard(self):
+        fastclock(self)
+        fakes = FakeInstances(self)
+        plainhttp(self, fakes.lastfm)
+        conn, child = multiprocessing.Pipe()
+        reports = []
+
+        def loaded():
+            while conn.poll():
+                reports.append(conn.recv())
+            return reports and reports[-1][1]['events'] == 2 * (PLAYS + 1)
+
+        async def main():
+            task = asyncio.ensure_future(serveshard(0, fakes.factory, child, 0.05, None))
+            conn.send((ADD, ['kitchen', 'bedroom']))
+            await waitfor(lambda: fakes.lastfm.counts['scrobbles'] == 2 * PLAYS)
+            await waitfor(loaded)
+            conn.close()  # supervisor is gone
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(main())
+        message, report = reports[-1]
+        self.assertEqual(LOAD, message)
+        self.assertListEqual(['bedroom', 'kitchen'], report['instances'])
+
+    def test_worker_process(self):
+        # tracks are too short to be scrobbled, so spawned worker doesn't need plain HTTP last.fm
+        fakes = FakeInstances(self, length=20)
+        supervisor = Supervisor(fakes.factory, 1, interval=0.05, reload=False)
+        self.addCleanup(supervisor.records.close)
+        supervisor.spawn(0)
+        try:
+            supervisor.rebalance()
+            deadline = time.monotonic() + 30
+            while supervisor.workers[0].report.get('events') != 2 * (PLAYS + 1):
+                self.assertLess(time.monotonic(), deadline, "timed out")
+                supervisor.poll(0.1)
+            self.assertListEqual(['bedroom', 'kitchen'], supervisor.workers[0].report['instances'])
+        finally:
+            supervisor.stop()
+
+    def test_account_moves_between_workers(self):
+        fakes = FakeInstances(self, length=20)
+        supervisor = Supervisor(fakes.factory, 2, interval=0.05, reload=False)
+        self.addCleanup(supervisor.records.close)
+        log = []
+        send, left = supervisor.send, supervisor.left
+
+        def logsend(shard, command, names):
+            log.append((command, shard))
+            send(shard, command, names)
+
+        def logleft(shard, accounts):
+            log.append((REMOVED, shard))
+            left(shard, accounts)
+
+        supervisor.send, supervisor.left = logsend, logleft
+
+        def serving(shard, instances):
+            deadline = time.monotonic() + 30
+            while supervisor.workers[shard].report.get('instances') != instances:
+                self.assertLess(time.monotonic(), deadline, "timed out")
+                supervisor.poll(0.1)
+
+        supervisor.spawn(0)
+        supervisor.spawn(1)
+        try:
+            supervisor.rebalance()
+            old = supervisor.owners['last.fm:alice']
+            new = 1 - old
+            serving(old, ['bedroom', 'kitchen'])
+            log.clear()
+            supervisor.ring.remove(old)  # old worker keeps running, but doesn't own the account anymore
+            supervisor.rebalance()
+            serving(new, ['bedroom', 'kitchen'])
+            serving(old, [])
+            self.assertListEqual([(REMOVE, old), (REMOVED, old), (ADD, new)], log)
+        finally:
+            supervisor.stop()
+
+
+class TestControlServer(TestCase):
+    def test_query(self):
+        path = os.path.join(tempfile.mkdtemp(), "control.sock")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        server = ControlServer(path, lambda: {'0': {'alive': True, 'events': 42}})
+        server.start()
+        self.addCleanup(server.stop)
+        self.assertDictEqual({'0': {'alive': True, 'events': 42}}, query(path))
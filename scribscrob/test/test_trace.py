@@ -0,0 +1,47 @@
+import os
+import tempfile
+from unittest import TestCase
+from scribscrob.model import PLAY, STOP
+from scribscrob.test.test_state import mocktime
+from scribscrob.trace import TraceRecorder, load, replay
+import scribscrob.state
+
+
+SONG1 = {'title': "Beyong The Sea", 'artist': "The Chessnuts", 'file': "Track01.flac", 'time': "177"}
+SONG2 = {'title': "Real Fine Frame", 'artist': "Budy Johnson", 'file': "Track02.flac", 'time': "116"}
+
+
+class TestTrace(TestCase):
+    def setUp(self):
+        self.original = scribscrob.state.current_time_millis
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        scribscrob.state.current_time_millis = self.original
+        os.remove(self.path)
+
+    def test_record_replay(self):
+        recorder = TraceRecorder(self.path)
+        for t, status, song in [(0, {'state': STOP}, {}),
+                                (10000, {'state': PLAY, 'elapsed': "0.000"}, SONG1),
+                                (277000, {'state': PLAY, 'elapsed': "0.000"}, SONG2),
+                                (300000, {'state': STOP}, SONG2)]:
+            mocktime(t)
+            recorder.record(status, song)
+        recorder.close()
+        scribscrob.state.current_time_millis = self.original
+
+        events = load(self.path)
+        self.assertEqual(4, len(events))
+        decisions, report = replay(events)
+        self.assertListEqual([
+            {'t': 10000, 'op': 'nowplaying', 'artist': "The Chessnuts", 'title': "Beyong The Sea"},
+            # committed as soon as half of the song is played
+            {'t': 98501, 'op': 'scrobble', 'artist': "The Chessnuts", 'title': "Beyong The Sea", 'timestamp': 10},
+            {'t': 277000, 'op': 'nowplaying', 'artist': "Budy Johnson", 'title': "Real Fine Frame"},
+        ], decisions)
+        self.assertEqual(4, report['events'])
+        self.assertEqual(1, report['scrobbles'])
+        self.assertIn('peak_bytes_per_event', report)
+        self.assertIs(self.original, scribscrob.state.current_time_millis)
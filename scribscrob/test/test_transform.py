@@ -0,0 +1,61 @@
+from unittest import TestCase
+from scribscrob.model import Song
+from scribscrob.transform import TagGuesser, Normalizer, TransformerChain
+
+
+REGEXPS = ["(?P<artist>.+) - (?P<title>.+)",
+           "(?P<artist>.*)_(?P<title>.+)",
+           "(?P<artist>\\w+)-(?P<title>.+)"]
+
+
+def stream(title: str):
+    return Song({'title': title, 'artist': None, 'file': "http://rocknrollradio"})
+
+
+class TestTagGuesser(TestCase):
+    def test_transform(self):
+        for guesser in (TagGuesser(REGEXPS), uncombined(TagGuesser(REGEXPS))):
+            song = guesser.transform(stream("Bill Doggett - Blip Blop"))
+            self.assertEqual(("Bill Doggett", "Blip Blop"), (song.artist, song.title))
+
+            # second pattern matches with empty artist, third one should be tried
+            song = guesser.transform(stream("_Blip-Blop"))
+            self.assertEqual(("_Blip", "Blop"), (song.artist, song.title))
+            song = guesser.transform(stream("Bill-Blip_Blop"))
+            self.assertEqual(("Bill-Blip", "Blop"), (song.artist, song.title))
+            song = guesser.transform(stream("Bill-_Blop"))
+            self.assertEqual(("Bill-", "Blop"), (song.artist, song.title))
+
+            song = guesser.transform(stream("Advertisement"))
+            self.assertEqual((None, "Advertisement"), (song.artist, song.title))
+
+    def test_memo(self):
+        guesser = TagGuesser(REGEXPS, memosize=2)
+        for title in ("A - B", "A - B", "C - D", "Ad", "A - B"):
+            guesser.transform(stream(title))
+        self.assertEqual(1, guesser.hits)
+        self.assertEqual(4, guesser.misses)
+        self.assertListEqual(["Ad", "A - B"], list(guesser.memo))
+
+    def test_global_flags_fall_back(self):
+        guesser = TagGuesser(["(?i)(?P<artist>.+) - (?P<title>.+)", "(?P<artist>.+)~(?P<title>.+)"])
+        self.assertIsNone(guesser.combined)
+        song = guesser.transform(stream("A~B"))
+        self.assertEqual(("A", "B"), (song.artist, song.title))
+
+
+class TestNormalizer(TestCase):
+    def test_chain(self):
+        chain = TransformerChain([TagGuesser(REGEXPS), Normalizer(memosize=2)])
+        songs = [chain.transform(stream(title)) for title in
+                 ("The Beatles - Let It Be", "the beatles  -  let it be", "The Beatles - Let It Be", "Ad")]
+        self.assertEqual(1, len({song.key for song in songs[:3]}))
+        self.assertEqual(("the beatles ", " let it be"), (songs[1].artist, songs[1].title))  # tags are kept
+        normalizer = chain.transformers[1]
+        self.assertEqual((1, 3), (normalizer.hits, normalizer.misses))
+        self.assertEqual(2, len(normalizer.memo))
+
+
+def uncombined(guesser: TagGuesser):
+    guesser.combined = None
+    return guesser
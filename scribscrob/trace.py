@@ -0,0 +1,145 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import scribscrob.state
+from scribscrob.model import Status, Song
+from scribscrob.state import ScrobblingMachine
+from scribscrob.transform import SongTransformer, TagGuesser
+
+
+class TraceRecorder:
+    """
+    Records raw (timestamp, status, currentsong) tuples received from MPD as JSON lines
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, mode='a')
+
+    def record(self, status: dict, song: dict):
+        d = {'t': scribscrob.state.current_time_millis(),
+             'status': status,
+             'song': song}
+        json.dump(d, self.file, separators=(',', ':'), sort_keys=True)
+        self.file.write('\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load(path: str):
+    """
+    returns: list of (timestamp, status dict, song dict) tuples
+    """
+    with open(path, mode='r') as f:
+        return [(d['t'], d['status'], d['song']) for d in map(json.loads, f) if d]
+
+
+class DecisionRecorder:
+    """
+    Fake scrobbler, that records decisions of ScrobblingMachine along with virtual time they were made at
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.decisions = []
+
+    def scrobble(self, song: Song, timestamp):
+        self.decisions.append({'t': self.clock(), 'op': 'scrobble', 'artist': song.artist, 'title': song.title,
+                               'timestamp': timestamp})
+
+    def nowplaying(self, song: Song):
+        self.decisions.append({'t': self.clock(), 'op': 'nowplaying', 'artist': song.artist, 'title': song.title})
+
+
+def replay(events: list, transformer: SongTransformer=None, measurememory: bool=True):
+    """
+    Feeds recorded events through ScrobblingMachine at full speed. Machine sees recorded timestamps (virtual time)
+        returns: (decisions, report) pair
+    """
+    if not events:
+        return [], {'events': 0}
+
+    clock = [events[0][0]]
+    original = scribscrob.state.current_time_millis
+    scribscrob.state.current_time_millis = lambda: clock[0]
+    try:
+        decisions, elapsed = _replay(events, transformer, clock)
+        report = {'events': len(events),
+                  'seconds': elapsed,
+                  'events_per_second': len(events) / elapsed if elapsed else float('inf'),
+                  'scrobbles': sum(1 for d in decisions if d['op'] == 'scrobble'),
+                  'nowplayings': sum(1 for d in decisions if d['op'] == 'nowplaying')}
+        if measurememory:
+            # second pass under tracemalloc, which slows things down too much to be timed
+            tracemalloc.start()
+            try:
+                blocks = sys.getallocatedblocks()
+                _replay(events, transformer, clock)
+                report['retained_blocks_per_event'] = (sys.getallocatedblocks() - blocks) / len(events)
+                report['peak_bytes_per_event'] = tracemalloc.get_traced_memory()[1] / len(events)
+            finally:
+                tracemalloc.stop()
+        return decisions, report
+    finally:
+        scribscrob.state.current_time_millis = original
+
+
+def _replay(events, transformer, clock):
+    scrobbler = DecisionRecorder(lambda: clock[0])
+    transformer = transformer or SongTransformer()
+    t, status, song = events[0]
+    clock[0] = t
+    started = time.perf_counter()
+    machine = ScrobblingMachine(Status(status), Song(song) if song else None,
+                                transformer=transformer, scrobbler=scrobbler)
+    for t, status, song in events[1:]:
+        runtimers(machine.scheduler, clock, t)
+        clock[0] = t
+        machine.onevent(Status(status), Song(song) if song else None)
+    return scrobbler.decisions, time.perf_counter() - started
+
+
+def runtimers(scheduler, clock, until: int):
+    """
+    Runs timers due before until, every one at its deadline of virtual time
+    """
+    deadline = scheduler.next()
+    while deadline is not None and deadline < until:
+        clock[0] = deadline
+        scheduler.runexpired()
+        deadline = scheduler.next()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m scribscrob.trace",
+                                     description="Replays recorded MPD trace through ScrobblingMachine")
+    parser.add_argument('trace', help="trace recorded by TraceRecorder")
+    parser.add_argument('--regexps', help="JSON list of tag guessing regexps, as in config")
+    parser.add_argument('--golden', help="fail if decisions differ from ones stored in this file")
+    parser.add_argument('--write-golden', help="store decisions to this file")
+    args = parser.parse_args(argv)
+
+    transformer = TagGuesser(json.loads(args.regexps)) if args.regexps else None
+    decisions, report = replay(load(args.trace), transformer)
+    print(json.dumps(report, sort_keys=True))
+
+    if args.write_golden:
+        with open(args.write_golden, mode='w') as f:
+            for d in decisions:
+                f.write(json.dumps(d, sort_keys=True) + '\n')
+    if args.golden:
+        with open(args.golden, mode='r') as f:
+            golden = [json.loads(line) for line in f if line.strip()]
+        if golden != decisions:
+            mismatch = next((i for i, (a, b) in enumerate(zip(golden, decisions)) if a != b),
+                            min(len(golden), len(decisions)))
+            print("Decisions differ from golden at #{:d}".format(mismatch), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,14 @@
 import os
 import re
+from collections import OrderedDict
 
 
 #TODO consider support for external transformers (i.e. plugins)
-from scribscrob.model import Song
+from scribscrob.model import Song, canonical
+
+
+DEFAULT_MEMO_SIZE = 1024  # stream titles to remember guesses for
+DEFAULT_IDENTITY_MEMO_SIZE = 4096  # songs to remember canonical identities for
 
 
 class SongTransformer:
@@ -20,13 +25,83 @@ class SongTransformer:
         return song
 
 
+class TransformerChain(SongTransformer):
+    """
+    Applies transformers in order, each one gets song returned by the previous one
+    """
+
+    def __init__(self, transformers: list):
+        self.transformers = list(transformers)
+
+    def transform(self, song):
+        for transformer in self.transformers:
+            song = transformer.transform(song)
+        return song
+
+
+class Normalizer(SongTransformer):
+    """
+    Sets canonical identity (Song.key) of songs, that dedup, history and now playing coalescing compare songs by.
+    Tags themselves are left as they are. Identities are memoized per raw (artist, title, file), since the same
+    songs and stream titles come again and again. Goes after TagGuesser, which fills the tags in
+    """
+
+    def __init__(self, memosize: int=DEFAULT_IDENTITY_MEMO_SIZE):
+        self.memo = OrderedDict()
+        self.memosize = memosize
+        self.hits = 0
+        self.misses = 0
+
+    def transform(self, song: Song):
+        raw = song.artist, song.title, song.file
+        key = self.memo.get(raw)
+        if key is None:
+            self.misses += 1
+            key = canonical(song.artist, song.title)
+            self.memo[raw] = key
+            if len(self.memo) > self.memosize:
+                self.memo.popitem(last=False)
+        else:
+            self.hits += 1
+            self.memo.move_to_end(raw)
+        song.setkey(key)
+        return song
+
+
 class TagGuesser(SongTransformer):
     """
-    SongTransformer implementation, that guesses artist tag from title or filename
+    SongTransformer implementation, that guesses artist tag from title or filename.
+    Patterns are tried in order, the first one, that yields both artist and title, wins.
+    Guesses are memoized per name, since stream titles repeat a lot
     """
 
-    def __init__(self, regexes: list):
-        self.patterns = list(map(lambda r: re.compile(r), regexes))
+    def __init__(self, regexes: list, memosize: int=DEFAULT_MEMO_SIZE):
+        self.regexes = list(regexes)
+        self._patterns = None
+        self._combined = NOT_COMPILED
+        self.memo = OrderedDict()
+        self.memosize = memosize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def patterns(self):
+        """
+        Patterns are compiled on first use. Separate patterns are needed only when combined one can't decide
+        """
+        if self._patterns is None:
+            self._patterns = [re.compile(r) for r in self.regexes]
+        return self._patterns
+
+    @property
+    def combined(self):
+        if self._combined is NOT_COMPILED:
+            self._combined = combine(self.regexes)
+        return self._combined
+
+    @combined.setter
+    def combined(self, combined):
+        self._combined = combined
 
     def transform(self, song: Song):
         if song.title and song.artist:
@@ -34,13 +109,68 @@ class TagGuesser(SongTransformer):
             return song
 
         name = song.title if song.title else os.path.basename(song.file)
-        for p in self.patterns:
+        guess = self.memo.get(name, False)
+        if guess is False:
+            self.misses += 1
+            guess = self.guess(name)
+            self.memo[name] = guess
+            if len(self.memo) > self.memosize:
+                self.memo.popitem(last=False)
+        else:
+            self.hits += 1
+            self.memo.move_to_end(name)
+
+        if guess:
+            song = song.withtags(*guess)
+        return song  # either guessed or failed to guess
+
+    def guess(self, name: str):
+        """
+        returns: (artist, title) or None if no pattern matches
+        """
+        start = 0
+        if self.combined:
+            # single scan finds the first matching pattern
+            m = self.combined.match(name)
+            if not m:
+                return None
+            start = int(m.lastgroup[len(ALTERNATIVE_GROUP):])
+            artist = m.group(ARTIST_GROUP + str(start))
+            title = m.group(TITLE_GROUP + str(start))
+            if artist and title:
+                return artist, title
+            start += 1
+
+        for p in self.patterns[start:]:
             m = p.match(name)
             if m:
                 artist = m.group('artist')
                 title = m.group('title')
                 if artist and title:
-                    song.artist = artist
-                    song.title = title
-                    return song
-        return song  # failed to guess
\ No newline at end of file
+                    return artist, title
+        return None
+
+
+NOT_COMPILED = object()
+ALTERNATIVE_GROUP = "_alternative"
+ARTIST_GROUP = "_artist"
+TITLE_GROUP = "_title"
+GROUP_NAME = re.compile(r"\(\?P([<=])(artist|title)\b")
+
+
+def combine(regexes: list):
+    """
+    Compiles regexes into single alternation. Group names are made unique per alternative and every alternative is
+    wrapped in its own named group, so lastgroup of a match tells which regex matched
+        returns: compiled alternation or None if regexes can't be combined (e.g. they use global inline flags)
+    """
+    if not regexes:
+        return None
+    alternatives = []
+    for i, r in enumerate(regexes):
+        r = GROUP_NAME.sub(lambda m: "(?P{:s}_{:s}{:d}".format(m.group(1), m.group(2), i), r)
+        alternatives.append("(?P<{:s}{:d}>{:s})".format(ALTERNATIVE_GROUP, i, r))
+    try:
+        return re.compile("|".join(alternatives))
+    except re.error:
+        return None